@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from django.conf.urls import patterns, url, include
+
+urlpatterns = patterns(
+    '',
+    url(r'^plupload/', include('plupload.urls')),
+)
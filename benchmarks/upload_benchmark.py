@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+import httplib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+
+"""
+Load benchmark of the chunked upload path: N concurrent clients upload files of a given size, chunk by chunk, the way
+the widget does, to plupload.upload.do_upload, either through the Django test client (--server client, in process, no
+HTTP) or through a real WSGI server on localhost (--server wsgi, wsgiref, a thread per request).
+
+Reports throughput, per chunk latency percentiles, the time spent in each phase of the upload requests (from their
+Server-Timing header), DB queries per chunk and per widget render, peak RSS of the process (server and clients) and
+peak disk usage of the staging directory. Run it before and after a change, on the same machine, to catch regressions;
+--json prints the report as JSON, to compare runs with a script.
+
+By default it runs on a throwaway sqlite DB and MEDIA_ROOT; with --settings your project's settings are used instead
+(your DB, PLUPLOAD_* settings and plupload urls), to size a deployment. Requires Django 1.6 - 1.8.
+
+    python benchmarks/upload_benchmark.py --clients 20 --files 5 --file-size 10 --chunk-size 1 --server wsgi
+"""
+
+CSRF_TOKEN = 'plupload0benchmark0csrf0token000'  # any 32 alphanumeric characters
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--server', choices=('client', 'wsgi'), default='client',
+                      help="'client' (Django test client) or 'wsgi' (WSGI server on localhost), default %default")
+    parser.add_option('--clients', type='int', default=10, help="concurrent clients, default %default")
+    parser.add_option('--files', type='int', default=3, help="files uploaded by each client, default %default")
+    parser.add_option('--file-size', type='float', default=5, help="Mb, size of each file, default %default")
+    parser.add_option('--chunk-size', type='float', default=1,
+                      help="Mb, PLUPLOAD_CHUNK_SIZE (not with --settings), default %default")
+    parser.add_option('--renders', type='int', default=50, help="widget renders timed, default %default")
+    parser.add_option('--signed', action='store_true', default=False,
+                      help="PLUPLOAD_SIGNED_CONTROL_CODES = True (not with --settings)")
+    parser.add_option('--deduplicate', action='store_true', default=False,
+                      help="PLUPLOAD_DEDUPLICATE = True (not with --settings)")
+    parser.add_option('--raw', action='store_true', default=False,
+                      help="chunks sent as raw request bodies to the 'plupload_raw' url, PLUPLOAD_MULTIPART = False "
+                           "(not with --settings)")
+    parser.add_option('--cache-staging', action='store_true', default=False,
+                      help="PLUPLOAD_STAGING_BACKEND = CacheStagingBackend, on a local memory cache (not with "
+                           "--settings)")
+    parser.add_option('--settings', default=None, help="your project's settings module, instead of the built-in ones")
+    parser.add_option('--json', action='store_true', default=False, help="prints the report as JSON")
+    options, args = parser.parse_args()
+    return options
+
+
+def configure(options, work_dir):
+    """
+    Configures Django, before plupload (whose settings are read on import) is imported
+    """
+    from django.conf import settings
+    if options.settings:
+        os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+    else:
+        media_root = os.path.join(work_dir, 'media')
+        os.makedirs(media_root)
+        settings.configure(
+            DEBUG=False,
+            SECRET_KEY='plupload-benchmark',
+            ALLOWED_HOSTS=['*'],
+            DATABASES={'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(work_dir, 'benchmark.sqlite3'),
+                'OPTIONS': {'timeout': 60},
+            }},
+            INSTALLED_APPS=('plupload',),
+            MIDDLEWARE_CLASSES=(),
+            ROOT_URLCONF='benchmark_urls',
+            MEDIA_ROOT=media_root,
+            MEDIA_URL='/media/',
+            STATIC_URL='/static/',
+            PLUPLOAD_CHUNK_SIZE=options.chunk_size,
+            PLUPLOAD_STAGING_DIR=os.path.join(work_dir, 'staging'),
+            PLUPLOAD_SIGNED_CONTROL_CODES=options.signed,
+            PLUPLOAD_DEDUPLICATE=options.deduplicate,
+            PLUPLOAD_MULTIPART=not options.raw,
+            PLUPLOAD_STAGING_BACKEND='plupload.staging.%s' % (
+                'CacheStagingBackend' if options.cache_staging else 'FileStagingBackend'),
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()  # Django >= 1.7
+    if not options.settings:
+        from django.core.management import call_command
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of values (sorted)
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(math.ceil(p / 100.0 * len(values))) - 1))]
+
+
+def parse_server_timing(value):
+    """
+    {phase: seconds} from a Server-Timing header
+    """
+    timings = {}
+    for item in (value or '').split(','):
+        parts = item.strip().split(';')
+        for param in parts[1:]:
+            if param.strip().startswith('dur='):
+                timings[parts[0].strip()] = float(param.strip()[4:]) / 1000
+    return timings
+
+
+def multipart_body(boundary, params, filename, data):
+    """
+    A chunk request, parameters first and the 'file' part last, as plupload sends them
+    """
+    lines = []
+    for name, value in params:
+        lines.extend(['--' + boundary, 'Content-Disposition: form-data; name="%s"' % name, '', str(value)])
+    lines.extend(['--' + boundary, 'Content-Disposition: form-data; name="file"; filename="%s"' % filename,
+                  'Content-Type: application/octet-stream', '', data])
+    lines.extend(['--' + boundary + '--', ''])
+    return '\r\n'.join(lines)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []  # seconds, per chunk
+        self.queries = []  # per chunk
+        self.phases = {}  # seconds, summed
+        self.bytes = 0
+        self.chunks = 0
+        self.files = 0
+        self.errors = []
+
+    def add_chunk(self, latency, size, queries, timings, error):
+        with self.lock:
+            self.latencies.append(latency)
+            if queries is not None:
+                self.queries.append(queries)
+            for name, seconds in timings.items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.bytes += size
+            self.chunks += 1
+            if error:
+                self.errors.append(error)
+
+
+class DiskMonitor(threading.Thread):
+    """
+    Samples the disk space allocated in path (preallocated staging files count in full), keeps the peak
+    """
+
+    def __init__(self, path, interval=0.05):
+        super(DiskMonitor, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def usage(self):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    total += os.stat(os.path.join(dirpath, filename)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.usage())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class TestClientTransport(object):
+    """
+    Posts chunks through the Django test client, in the calling thread; queries are counted around the request
+    """
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client()
+
+    def post(self, path, body, content_type):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(path, data=body, content_type=content_type)
+        return response.status_code, response.get('Server-Timing'), len(queries), response.content
+
+    def close(self):
+        from django.db import connection
+        connection.close()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def counting_queries(application):
+    """
+    WSGI middleware sending the number of queries run by each request back in the X-Benchmark-Queries header
+    """
+    def application_wrapper(environ, start_response):
+        local_captured = []
+
+        def capture(status, headers, exc_info=None):
+            local_captured.extend([status, headers])
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            result = application(environ, capture)
+            try:
+                body = ''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()  # request_finished, closes the DB connection
+        start_response(local_captured[0], local_captured[1] + [('X-Benchmark-Queries', str(len(queries)))])
+        return [body]
+    return application_wrapper
+
+
+class WSGITransport(object):
+    """
+    Posts chunks over HTTP to the benchmark WSGI server, a connection per request (wsgiref speaks HTTP/1.0)
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def post(self, path, body, content_type):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=300)
+        try:
+            conn.request('POST', path, body, {
+                'Content-Type': content_type,
+                'Cookie': 'csrftoken=%s' % CSRF_TOKEN,
+                'X-CSRFToken': CSRF_TOKEN,
+                'X-Requested-With': 'XMLHttpRequest',
+            })
+            response = conn.getresponse()
+            content = response.read()
+            queries = response.getheader('X-Benchmark-Queries')
+            return (response.status, response.getheader('Server-Timing'), int(queries) if queries else None,
+                    content)
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+def upload_files(transport, stats, path, client_number, files, file_size, chunk_size, raw=False):
+    """
+    One client: uploads files one after the other, chunk by chunk, the way widget.html does (offset and total), as
+    multipart requests or as raw request bodies (the parameters in the query string)
+    """
+    from plupload.tokens import issue_control_code
+    from plupload.settings import UPLOAD_TO
+    try:
+        for file_number in xrange(files):
+            control_code = issue_control_code(UPLOAD_TO)
+            filename = 'benchmark_%s_%s.bin' % (client_number, file_number)
+            file_id = '%s_%s_%s' % (filename, file_size, random.random())
+            block = os.urandom(chunk_size or file_size)  # each file unique, no deduplication across clients
+            boundary = '----pluploadbenchmark%s' % random.randint(0, 1 << 30)
+            for offset in xrange(0, file_size, chunk_size or file_size):
+                data = block[:min(len(block), file_size - offset)]
+                params = [
+                    ('name', filename), ('offset', offset), ('total', file_size), ('control_code', control_code),
+                    ('file_id', file_id), ('show_thumbnail', ''), ('upload_chmod', ''),
+                ]
+                if raw:
+                    url, body = '%s?%s' % (path, urllib.urlencode(params)), data
+                    content_type = 'application/octet-stream'
+                else:
+                    url, body = path, multipart_body(boundary, params, filename, data)
+                    content_type = 'multipart/form-data; boundary=%s' % boundary
+                started = time.time()
+                try:
+                    status, server_timing, queries, content = transport.post(url, body, content_type)
+                except Exception, err:
+                    status, server_timing, queries, content = None, None, None, ''
+                    error = '%s: %s' % (err.__class__.__name__, err)
+                latency = time.time() - started
+                if status is not None:
+                    try:
+                        error = json.loads(content)['result'].get('error')
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        error = 'HTTP %s: not a plupload response' % status
+                stats.add_chunk(latency, len(data), queries, parse_server_timing(server_timing), error)
+                if error:
+                    break
+            else:
+                with stats.lock:
+                    stats.files += 1
+    finally:
+        transport.close()
+
+
+def benchmark_render(renders):
+    """
+    Renders the widget renders times, returns (mean seconds, mean queries) per render
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from plupload.forms import PluploadForm
+    if not renders:
+        return 0.0, 0.0
+    queries = 0
+    started = time.time()
+    for i in xrange(renders):
+        form = PluploadForm()
+        with CaptureQueriesContext(connection) as captured:
+            unicode(form['file'])
+        queries += len(captured)
+    return (time.time() - started) / renders, float(queries) / renders
+
+
+def run(options):
+    from django.core.urlresolvers import reverse
+    from django.core.wsgi import get_wsgi_application
+    from plupload.settings import CHUNK_SIZE, STAGING_DIR
+    from plupload import staging
+    staging.make_staging_dir()
+    path = str(reverse('plupload_raw' if options.raw else 'plupload'))
+    file_size = int(options.file_size * 1048576)
+    chunk_size = int(float(CHUNK_SIZE or 0) * 1048576)
+    render_seconds, render_queries = benchmark_render(options.renders)
+    server = None
+    if options.server == 'wsgi':
+        server = make_server('127.0.0.1', 0, counting_queries(get_wsgi_application()),
+                             server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+    stats = Stats()
+    monitor = DiskMonitor(STAGING_DIR)
+    monitor.start()
+    clients = []
+    started = time.time()
+    for client_number in xrange(options.clients):
+        transport = WSGITransport(server.server_port) if server else TestClientTransport()
+        client = threading.Thread(target=upload_files, args=(transport, stats, path, client_number, options.files,
+                                                             file_size, chunk_size, options.raw))
+        client.start()
+        clients.append(client)
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started
+    monitor.stop()
+    if server:
+        server.shutdown()
+    latencies = sorted(stats.latencies)
+    queries = sorted(stats.queries)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024  # kilobytes on linux
+    return {
+        'server': options.server,
+        'raw': options.raw,
+        'clients': options.clients,
+        'files_per_client': options.files,
+        'file_size': file_size,
+        'chunk_size': chunk_size,
+        'seconds': elapsed,
+        'files_uploaded': stats.files,
+        'chunks': stats.chunks,
+        'errors': len(stats.errors),
+        'first_error': stats.errors[0] if stats.errors else None,
+        'throughput_mb_s': stats.bytes / 1048576.0 / elapsed if elapsed else 0.0,
+        'chunks_s': stats.chunks / elapsed if elapsed else 0.0,
+        'chunk_latency_ms': dict(('p%s' % p, percentile(latencies, p) * 1000) for p in (50, 95, 99)),
+        'chunk_latency_max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'phases_ms_per_chunk': dict((name, seconds * 1000 / stats.chunks) for name, seconds in stats.phases.items())
+        if stats.chunks else {},
+        'queries_per_chunk': {
+            'mean': float(sum(queries)) / len(queries) if queries else None,
+            'max': queries[-1] if queries else None,
+        },
+        'render_ms': render_seconds * 1000,
+        'queries_per_render': render_queries,
+        'peak_rss_mb': max_rss / 1048576.0,
+        'peak_staging_disk_mb': monitor.peak / 1048576.0,
+    }
+
+
+def print_report(report):
+    print "server: %s%s, %s clients x %s files of %s bytes, chunks of %s bytes" % (
+        report['server'], ' (raw chunks)' if report['raw'] else '', report['clients'], report['files_per_client'],
+        report['file_size'], report['chunk_size'])
+    print "elapsed: %.2f s, files uploaded: %s, chunks: %s, errors: %s" % (
+        report['seconds'], report['files_uploaded'], report['chunks'], report['errors'])
+    if report['first_error']:
+        print "first error: %s" % report['first_error']
+    print "throughput: %.2f Mb/s, %.1f chunks/s" % (report['throughput_mb_s'], report['chunks_s'])
+    print "chunk latency: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        report['chunk_latency_ms']['p50'], report['chunk_latency_ms']['p95'], report['chunk_latency_ms']['p99'],
+        report['chunk_latency_max_ms'])
+    if report['phases_ms_per_chunk']:
+        print "server time per chunk: %s" % ', '.join(
+            '%s %.2f ms' % item for item in sorted(report['phases_ms_per_chunk'].items(), key=lambda x: -x[1]))
+    if report['queries_per_chunk']['mean'] is not None:
+        print "queries per chunk: mean %.2f, max %s" % (report['queries_per_chunk']['mean'],
+                                                        report['queries_per_chunk']['max'])
+    print "widget render: %.2f ms, %.2f queries" % (report['render_ms'], report['queries_per_render'])
+    print "peak RSS: %.1f Mb, peak staging disk usage: %.1f Mb" % (report['peak_rss_mb'],
+                                                                   report['peak_staging_disk_mb'])
+
+
+def main():
+    options = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # benchmark_urls
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # plupload
+    work_dir = tempfile.mkdtemp(prefix='plupload_benchmark_')
+    try:
+        configure(options, work_dir)
+        report = run(options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if options.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print_report(report)
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+from django.utils.translation import ugettext_lazy as _
+from plupload.settings import (STAGING_DIR, MAX_CONCURRENT_UPLOADS, MIN_FREE_SPACE, STAGING_QUOTA, RATE_LIMIT,
+                               RATE_LIMIT_BURST, MAX_CONCURRENT_REQUESTS, MAX_IN_FLIGHT, ADMISSION_CACHE)
+from plupload import staging
+import errno
+import hashlib
+import os
+import time
+
+
+"""
+Admission control of uploads: how many files each user (authenticated user, or session, or IP address) can upload at
+the same time, PLUPLOAD_MAX_CONCURRENT_UPLOADS, so that a single client (i.e. a bulk upload in several tabs) can't keep
+all the workers busy.
+
+The uploads in progress of each user are marker files in a directory of the staging area, one per upload, touched by
+each chunk: shared by all the processes, like the staging files. An upload that hasn't received chunks for STALE_AFTER
+seconds doesn't count anymore.
+
+New uploads are also refused, before their first chunk is written, if the staging area hasn't room for them: less than
+PLUPLOAD_MIN_FREE_SPACE left on its filesystem, or PLUPLOAD_STAGING_QUOTA exceeded. The space the uploads in progress
+will still take counts as used: staging files are preallocated where posix_fallocate is available (in os or the C
+library), otherwise they are sparse and what hasn't been written to them yet is subtracted from the free space.
+
+Finally chunk requests are limited before their body is read (see admit_request): bandwidth of each user
+(PLUPLOAD_RATE_LIMIT, a token bucket), chunk requests in flight of each user (PLUPLOAD_MAX_CONCURRENT_REQUESTS) and
+bytes in flight for all the users (PLUPLOAD_MAX_IN_FLIGHT). Their state is in the PLUPLOAD_ADMISSION_CACHE Django
+cache: shared by all the processes (and nodes) with memcached or redis, per process with the local memory cache.
+Over-limit requests are refused straight away, with the time to wait before retrying.
+"""
+
+STALE_AFTER = 300  # seconds
+COUNTER_TIMEOUT = 3600  # seconds, counters of requests in flight left behind by a crashed process expire
+
+
+class Throttled(Exception):
+    """
+    The request is over a limit, to be retried after retry_after seconds
+    """
+
+    def __init__(self, message, retry_after):
+        super(Throttled, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def upload_owner(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return 'user:%s' % user.pk
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        return 'session:%s' % session.session_key
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def owner_id(request):
+    return hashlib.sha1(upload_owner(request).encode('utf-8')).hexdigest()
+
+
+def owner_dir(request):
+    return os.path.join(staging.OWNERS_DIR, owner_id(request))
+
+
+def admit_upload(request, key):
+    """
+    True if the upload key can go on: it is already in progress, or the user has fewer uploads than
+    PLUPLOAD_MAX_CONCURRENT_UPLOADS in progress (the upload is counted from now on). Always True without a limit
+    """
+    if not MAX_CONCURRENT_UPLOADS:
+        return True
+    path = owner_dir(request)
+    marker = os.path.join(path, key)
+    try:
+        os.utime(marker, None)
+        return True  # in progress
+    except OSError:
+        pass
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+    in_progress = 0
+    stale = time.time() - STALE_AFTER
+    for name in os.listdir(path):
+        try:
+            if os.stat(os.path.join(path, name)).st_mtime >= stale:
+                in_progress += 1
+            else:
+                os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+    if in_progress >= MAX_CONCURRENT_UPLOADS:
+        return False
+    open(marker, 'a').close()
+    return True
+
+
+def release_upload(request, key):
+    """
+    The upload key is over (complete or failed), it doesn't count anymore
+    """
+    if not MAX_CONCURRENT_UPLOADS:
+        return
+    try:
+        os.remove(os.path.join(owner_dir(request), key))
+    except OSError:
+        pass
+
+
+def check_space(size):
+    """
+    Returns an error message if a new upload of size bytes doesn't fit in the staging area, None otherwise
+    """
+    statvfs = getattr(os, 'statvfs', None)  # not on windows
+    try:
+        staging.make_staging_dir()
+        if statvfs is not None:
+            st = statvfs(STAGING_DIR)
+            # sparse staging files of the uploads in progress will take the rest of their size
+            free = st.f_bavail * st.f_frsize - staging.unallocated()
+            if free - size < float(MIN_FREE_SPACE or 0) * 1048576:
+                return _(u"not enough disk space on the server, retry later")
+        if STAGING_QUOTA and staging.usage() + size > float(STAGING_QUOTA) * 1048576:
+            return _(u"too many uploads in progress on the server, retry later")
+    except OSError:
+        pass  # staging area not usable, the upload will fail writing its first chunk
+    return None
+
+
+def check_upload(request, key, size):
+    """
+    Returns an error message if the upload key can't go on (see admit_upload and check_space, for new uploads), None
+    otherwise. size is the total size of the upload, if known, or the size of the chunk
+    """
+    if not admit_upload(request, key):
+        return _(u"too many uploads in progress, retry once the others are complete")
+    if not os.path.exists(staging.staging_path(key)):
+        error = check_space(size)
+        if error:
+            release_upload(request, key)
+            return error
+    return None
+
+
+def _increment(cache, key, delta):
+    cache.add(key, 0, COUNTER_TIMEOUT)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # expired in between
+        cache.set(key, delta, COUNTER_TIMEOUT)
+        return delta
+
+
+def _decrement(cache, key, delta):
+    try:
+        cache.decr(key, delta)
+    except ValueError:
+        pass  # expired
+
+
+def take_tokens(cache, owner, size):
+    """
+    Token bucket of the user: returns 0 if size bytes can be sent now (taking them from the bucket), the seconds to
+    wait otherwise. The bucket fills at PLUPLOAD_RATE_LIMIT, up to PLUPLOAD_RATE_LIMIT_BURST (at least a chunk)
+    """
+    rate = float(RATE_LIMIT) * 1048576
+    burst = max(float(RATE_LIMIT_BURST or 0) * 1048576, rate, size)
+    key = 'plupload:bucket:%s' % owner
+    now = time.time()
+    tokens, last = cache.get(key) or (burst, now)
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens < size:
+        return (size - tokens) / rate
+    cache.set(key, (tokens - size, now), int(burst / rate) + 60)
+    return 0
+
+
+def content_length(request):
+    """
+    The Content-Length of the request: 0 if missing, None if invalid
+    """
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+def admit_request(request):
+    """
+    Checks the limits of chunk requests before their body is read, raises Throttled if the request is over one of them.
+    Admitted requests must be released with release_request once served
+    """
+    if not (RATE_LIMIT or MAX_CONCURRENT_REQUESTS or MAX_IN_FLIGHT):
+        return
+    cache = staging.get_cache(ADMISSION_CACHE)
+    size = content_length(request) or 0  # an invalid Content-Length is refused by the view
+    owner = owner_id(request)
+    admitted = []
+    try:
+        if MAX_IN_FLIGHT:
+            admitted.append(('plupload:in_flight', size))
+            if _increment(cache, 'plupload:in_flight', size) > float(MAX_IN_FLIGHT) * 1048576 + size:
+                # admitted while the bytes in flight before it are within the limit: bigger chunks get through too
+                raise Throttled(_(u"the server is busy, retrying shortly"), 1)
+        if MAX_CONCURRENT_REQUESTS:
+            admitted.append(('plupload:requests:%s' % owner, 1))
+            if _increment(cache, 'plupload:requests:%s' % owner, 1) > MAX_CONCURRENT_REQUESTS:
+                raise Throttled(_(u"too many uploads at the same time, retrying shortly"), 1)
+        if RATE_LIMIT:
+            wait = take_tokens(cache, owner, size)
+            if wait:
+                raise Throttled(_(u"upload rate limit exceeded, retrying shortly"), wait)
+    except Throttled:
+        for key, delta in admitted:
+            _decrement(cache, key, delta)
+        raise
+    request.plupload_admitted = admitted
+
+
+def release_request(request):
+    """
+    The request admitted by admit_request has been served
+    """
+    admitted = getattr(request, 'plupload_admitted', None)
+    if admitted:
+        cache = staging.get_cache(ADMISSION_CACHE)
+        for key, delta in admitted:
+            _decrement(cache, key, delta)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.utils.safestring import mark_safe
+from plupload.settings import JQUERY_URL, JQUERY_UI_URL, JQUERY_UI_CSS_URL
+import json
+
+
+"""
+The scripts and styles the widgets need, loaded by {% plupload_head_init %}.
+
+Bundled files are referenced through the staticfiles storage: with ManifestStaticFilesStorage (or
+CachedStaticFilesStorage) in STATICFILES_STORAGE their urls carry a hash of their content, so the web server can serve
+them with far future expiry headers. PLUPLOAD_JQUERY_URL and the like are either absolute urls (a CDN) or paths of
+static files, to self-host jquery too.
+
+The minified plupload bundle (html5 and html4 runtimes: the Flash and Silverlight ones are never used) takes a good part
+of a page: with PLUPLOAD_LAZY_LOAD the head gets just a small loader, which loads the assets the first time a widget is
+initialized. Pages without widgets don't load them at all.
+"""
+
+STYLES = (
+    'plupload/css/plupload.css',
+    'plupload/js/jquery.ui.plupload/css/jquery.ui.plupload.css',
+)
+
+SCRIPTS = (
+    'plupload/js/plupload.full.min.js',
+    'plupload/js/jquery.ui.plupload/jquery.ui.plupload.min.js',
+    'plupload/js/django.plupload.js',
+)
+
+_assets = []  # computed once, unless DEBUG
+
+
+def asset_url(path):
+    """
+    Url of the static file path, fingerprinted by the staticfiles storage; absolute urls are returned as they are
+    """
+    if not path or path.startswith('/') or '://' in path:
+        return path
+    return staticfiles_storage.url(path)
+
+
+def head_assets():
+    """
+    The urls of the assets for {% plupload_head_init %}: styles and scripts of plupload, and jquery and jquery-ui (each
+    loaded only if missing on the page)
+    """
+    if _assets and not settings.DEBUG:
+        return _assets[0]
+    assets = {
+        'styles': [asset_url(path) for path in STYLES],
+        'scripts': [asset_url(path) for path in SCRIPTS],
+        'jquery': asset_url(JQUERY_URL),
+        'jquery_ui': asset_url(JQUERY_UI_URL),
+        'jquery_ui_css': asset_url(JQUERY_UI_CSS_URL),
+    }
+    assets['json'] = mark_safe(json.dumps(assets).replace('<', '\\u003c'))
+    del _assets[:]
+    _assets.append(assets)
+    return assets
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from plupload.settings import (CHUNK_SIZE, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, CHUNK_TIME, ADAPTIVE_CHUNK_SIZE,
+                               ADMISSION_CACHE)
+from plupload.admission import owner_id
+from plupload import staging
+
+
+"""
+Adaptive chunk size: PLUPLOAD_CHUNK_SIZE is where each user starts from, then the server recommends a chunk size
+(result.recommended_chunk_size, in the response of each chunk and of upload_status) from the link of the user, measured
+on the chunks received: effective throughput (bytes of the request over its duration, server processing included) and
+latency (the idle time between the response to a chunk and the next chunk of the same user, a round trip plus the
+client's own work).
+
+A chunk should take about PLUPLOAD_CHUNK_TIME seconds: less and the requests (and their latency, and the work the
+server does for each of them) add up, more and a chunk that fails costs longer to send again. On links with a high
+latency chunks take at least LATENCY_RATIO round trips, so that waiting for the responses doesn't take more than a
+tenth of the time. The recommendation stays within PLUPLOAD_MIN_CHUNK_SIZE and PLUPLOAD_MAX_CHUNK_SIZE (the widget
+narrows them to the field's min_chunk_size and max_chunk_size) and changes at most by a factor of MAX_STEP at a time.
+
+The chunk map of an upload has a fixed chunk size (see plupload.staging), so the widget applies the recommendation to
+the next file it uploads, and resumes an interrupted upload with the chunk size it started with. The measures are
+kept in the PLUPLOAD_ADMISSION_CACHE Django cache, per user (see plupload.admission.owner_id).
+"""
+
+SMOOTHING = 0.3  # weight of the last chunk in the moving averages
+LATENCY_RATIO = 10  # chunk time over latency, at least
+MAX_LATENCY = 10  # seconds, longer idle times are the user pausing, not latency
+MAX_STEP = 4  # the recommendation changes at most by this factor from the chunk size measured
+ROUNDING = 64 * 1024  # bytes, recommended chunk sizes are a multiple of this
+STATS_TIMEOUT = 86400  # seconds
+
+
+def bounds():
+    """
+    (min, max) chunk size in bytes accepted by the server
+    """
+    low = int(float(MIN_CHUNK_SIZE or 0) * 1048576)
+    high = int(float(MAX_CHUNK_SIZE or 0) * 1048576) or None
+    return low, high
+
+
+def check_chunk_size(chunk_size):
+    """
+    Raises ValueError if the chunk size sent by the client is out of bounds: tiny chunks of a big file would mean a
+    huge chunk map
+    """
+    low, high = bounds()
+    if chunk_size < low or (high and chunk_size > high):
+        raise ValueError("chunk size out of bounds")
+
+
+def clamp(chunk_size):
+    low, high = bounds()
+    chunk_size = max(chunk_size, low, ROUNDING)
+    if high:
+        chunk_size = min(chunk_size, high)
+    return chunk_size
+
+
+def stats_key(request):
+    return 'plupload:link:%s' % owner_id(request)
+
+
+def record_chunk(request, size, started, ended):
+    """
+    Measures the link of the user with a chunk of size bytes (on the wire) received from started to ended (seconds
+    since the epoch): updates the moving averages of throughput and latency
+    """
+    if not ADAPTIVE_CHUNK_SIZE or size <= 0:
+        return
+    cache = staging.get_cache(ADMISSION_CACHE)
+    key = stats_key(request)
+    throughput, latency, last = cache.get(key) or (None, 0.0, None)
+    measured = size / max(ended - started, 0.001)
+    throughput = measured if throughput is None else (1 - SMOOTHING) * throughput + SMOOTHING * measured
+    if last is not None and 0 <= started - last <= MAX_LATENCY:
+        latency = (1 - SMOOTHING) * latency + SMOOTHING * (started - last)
+    cache.set(key, (throughput, latency, ended), STATS_TIMEOUT)
+
+
+def recommend(request, chunk_size=None):
+    """
+    Returns the chunk size (bytes) recommended for the next upload of the user, chunk_size being the one in use, if
+    any; PLUPLOAD_CHUNK_SIZE until the link has been measured. None with PLUPLOAD_ADAPTIVE_CHUNK_SIZE = False, or
+    without chunks
+    """
+    if not ADAPTIVE_CHUNK_SIZE or not CHUNK_SIZE:
+        return None
+    stats = staging.get_cache(ADMISSION_CACHE).get(stats_key(request))
+    if stats is None:
+        return clamp(chunk_size or int(float(CHUNK_SIZE) * 1048576))
+    throughput, latency = stats[:2]
+    recommended = throughput * max(float(CHUNK_TIME), LATENCY_RATIO * latency)
+    if chunk_size:
+        recommended = min(max(recommended, chunk_size / MAX_STEP), chunk_size * MAX_STEP)
+    return clamp(int(recommended) // ROUNDING * ROUNDING)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from plupload import metrics
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+"""
+Compressed chunks: the client may send a chunk compressed (the 'content_encoding' parameter, or the Content-Encoding
+header of a raw chunk, see plupload.upload.do_upload_raw), it is decompressed on the fly while it is written to the
+staging file, a block at a time: never a whole chunk in memory. Offsets, sizes and checksums are those of the
+uncompressed file.
+
+gzip and deflate (what browsers can compress with CompressionStream) are always accepted, zstd if the zstandard package
+is installed. The decompressed size of each chunk must be known in advance ('total' parameter) and is enforced, so a
+decompression bomb is stopped after at most BLOCK_SIZE bytes too many, and a truncated chunk is refused.
+"""
+
+BLOCK_SIZE = 64 * 1024  # most bytes decompressed at a time
+
+ENCODINGS = ('gzip', 'deflate') + (('zstd',) if zstandard is not None else ())
+
+ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class DecompressionError(ValueError):
+    pass
+
+
+def normalize_encoding(encoding):
+    """
+    Returns the content encoding of a chunk, None if it isn't compressed. Raises DecompressionError if the encoding
+    isn't supported
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding == 'x-gzip':
+        return 'gzip'
+    if encoding not in ENCODINGS:
+        raise DecompressionError("unsupported content encoding '%s'" % encoding)
+    return encoding
+
+
+def chunk_length(chunk_size, offset, total_size):
+    """
+    Size of the chunk at offset, uncompressed
+    """
+    if chunk_size > 0:
+        return min(chunk_size, total_size - offset)
+    return total_size - offset
+
+
+def counted(stream):
+    for data in stream:
+        metrics.count('bytes_compressed', len(data))
+        yield data
+
+
+def zlib_blocks(stream, wbits):
+    decompressor = zlib.decompressobj(wbits)
+    for data in stream:
+        while data:
+            with metrics.phase('decompress'):
+                block = decompressor.decompress(data, BLOCK_SIZE)
+            data = decompressor.unconsumed_tail
+            yield block
+    yield decompressor.flush()
+
+
+class StreamReader(object):
+    """
+    File-like read() over an iterable of strings, for zstandard's stream_reader
+    """
+
+    def __init__(self, stream):
+        self.stream = iter(stream)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.stream)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def zstd_blocks(stream):
+    reader = zstandard.ZstdDecompressor().stream_reader(StreamReader(stream), read_size=BLOCK_SIZE)
+    while True:
+        with metrics.phase('decompress'):
+            block = reader.read(BLOCK_SIZE)
+        if not block:
+            break
+        yield block
+
+
+def decompress(stream, encoding, size):
+    """
+    Decompresses stream (an iterable of strings, compressed with encoding) on the fly, yielding blocks of at most
+    BLOCK_SIZE bytes. size is the decompressed size of the chunk: more or less than that raises DecompressionError,
+    as does corrupted data
+    """
+    stream = counted(stream)
+    if encoding == 'zstd':
+        blocks = zstd_blocks(stream)
+    else:
+        blocks = zlib_blocks(stream, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+    decompressed = 0
+    try:
+        for block in blocks:
+            decompressed += len(block)
+            if decompressed > size:
+                raise DecompressionError("chunk larger than expected once decompressed")
+            if block:
+                yield block
+    except ERRORS, err:
+        raise DecompressionError("corrupted compressed chunk: %s" % err)
+    if decompressed != size:
+        raise DecompressionError("truncated compressed chunk")
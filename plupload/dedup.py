@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from django.utils.crypto import get_random_string
+from plupload.settings import BLOB_DIR
+from plupload import staging
+import errno
+import os
+import time
+
+
+"""
+Content addressed, deduplicating storage (PluploadField(..., deduplicate=True) or PLUPLOAD_DEDUPLICATE = True).
+
+Each uploaded file is stored once in BLOB_DIR (PLUPLOAD_BLOB_DIR), named after its sha256 digest, and the file at the
+path saved in the field is a hard link to the blob: uploading a file already stored costs just a new link, no data is
+moved. The link count of the blob is its reference count: removing an uploaded file (see release) never touches the
+other files sharing the same blob, and blobs nothing links to anymore are removed by collect_garbage (management
+command plupload_clearblobs). BLOB_DIR has to be on the same filesystem as MEDIA_ROOT. Links share the mode of their
+blob: upload_chmod is not applied to them.
+"""
+
+GRACE_PERIOD = 3600  # seconds, unreferenced blobs younger than this are kept, they might be being linked right now
+
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def link(src, dest_path):
+    """
+    Hard links src to dest_path, replacing dest_path atomically if it exists
+    """
+    tmp_path = os.path.join(os.path.dirname(dest_path), '.plupload.%s' % get_random_string(12))
+    os.link(src, tmp_path)
+    try:
+        staging.replace(tmp_path, dest_path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def store(key, digest, dest_path):
+    """
+    Moves a complete upload to dest_path. If the blob for digest already exists dest_path just becomes a link to it
+    and 'dedup' is returned (the staging file is left to be discarded); otherwise the staging file is moved to
+    dest_path (see staging.finalize, whose return value is returned) and becomes the blob for digest. If the blob store
+    is not usable (i.e. BLOB_DIR on another filesystem) dest_path is left as a plain file
+    """
+    path = blob_path(digest)
+    try:
+        link(path, dest_path)
+        os.utime(path, None)  # keeps it away from the garbage collector for a while
+        return 'dedup'
+    except OSError:
+        pass  # no such blob yet, or blob store not usable
+    method = staging.finalize(key, dest_path)
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        link(dest_path, path)
+    except OSError:
+        pass  # not deduplicated, but uploaded anyway
+    return method
+
+
+def is_linked(path):
+    """
+    True if the file at path shares its content with other files (a blob, probably)
+    """
+    try:
+        return os.stat(path).st_nlink > 1
+    except OSError:
+        return False
+
+
+def release(path):
+    """
+    Removes an uploaded file stored as a link to a blob: other files linking the same blob are not affected, the blob
+    itself is removed by collect_garbage once nothing links to it. Files not linked to a blob are left alone. The link
+    count says nothing about the values referring to path: the caller checks no value does anymore (see
+    plupload.models.path_in_use). Returns True if the file has been removed
+    """
+    if is_linked(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def collect_garbage(grace_period=GRACE_PERIOD):
+    """
+    Removes the blobs no uploaded file links to anymore, returns the number of blobs removed
+    """
+    removed = 0
+    now = time.time()
+    for dirpath, dirnames, filenames in os.walk(BLOB_DIR):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+                if st.st_nlink == 1 and st.st_mtime < now - grace_period:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
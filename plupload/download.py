@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified, FileResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_unicode
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag, urlquote
+from plupload.settings import MEDIA_ROOT, SENDFILE, SENDFILE_URL
+import os
+import re
+
+
+"""
+Downloads of the files uploaded to PluploadFields that aren't public (MEDIA_ROOT not served by the web server, or not
+all of it): the download view (plupload_download url) serves the file of a field of an object, if the field's
+download_access hook allows it (see PluploadField). The path comes from the object, not from the request, and is
+served only if it lies under the upload_to directory of the field (not i.e. '../settings.py', or a symlink elsewhere).
+
+The transfer is handed to the web server when possible, the worker is free as soon as the headers are sent:
+PLUPLOAD_SENDFILE = 'x-accel-redirect' (nginx, an internal location at PLUPLOAD_SENDFILE_URL serving MEDIA_ROOT) or
+'x-sendfile' (Apache mod_xsendfile, lighttpd), which handle ranges themselves. Otherwise the view streams the file
+(through wsgi.file_wrapper, i.e. sendfile(2), when the server has it), with single byte ranges (resumed downloads,
+seeking in videos) and conditional GET (ETag, the checksum recorded by plupload.fileinfo if any, and Last-Modified).
+"""
+
+BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def authenticated(request, instance, path):
+    """
+    download_access hook: any logged in user can download
+    """
+    return request.user.is_authenticated()
+
+
+def can_change(request, instance, path):
+    """
+    download_access hook: users who can change the object can download its files
+    """
+    opts = instance._meta
+    return request.user.has_perm('%s.change_%s' % (opts.app_label, opts.model_name))
+
+
+class RangeFile(object):
+    """
+    The bytes from offset to offset + length of an open file, for FileResponse
+    """
+
+    def __init__(self, f, offset, length):
+        self.file = f
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def byte_range(request, size, etag, mtime):
+    """
+    Returns (start, end) of the byte range requested (end included), None for the whole file (no Range header, or
+    one this view doesn't handle, or an If-Range that doesn't match). Raises ValueError if the range can't be satisfied
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').replace(' ', ''))
+    if match is None:
+        return None  # several ranges are allowed to get the whole file
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != int(mtime):
+        return None  # the file has changed
+    first, last = match.groups()
+    if not first:
+        if not last or not int(last):
+            raise ValueError("empty suffix range")
+        start, end = max(size - int(last), 0), size - 1  # the last bytes
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def serve_file(request, plupload_file, attachment=False):
+    """
+    Response serving plupload_file (a PluploadFile, see plupload.fileinfo): by the web server with PLUPLOAD_SENDFILE,
+    otherwise streamed, honoring Range and conditional GET
+    """
+    info = plupload_file.info
+    if info is None:
+        raise Http404("file not found")
+    mtime, size = info.mtime, info.size
+    etag = quote_etag(info.checksum.split(':')[-1] if info.checksum else '%x-%x' % (int(mtime), size))
+    filename = os.path.basename(force_unicode(plupload_file.name))
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(mtime),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': "%s; filename*=UTF-8''%s" % ('attachment' if attachment else 'inline',
+                                                            urlquote(filename)),
+    }
+    if not_modified(request, etag, mtime):
+        response = HttpResponseNotModified()
+    elif SENDFILE:
+        response = HttpResponse(content_type=info.content_type or 'application/octet-stream')
+        if SENDFILE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = SENDFILE_URL.rstrip('/') + '/' + urlquote(plupload_file.name.lstrip('/'))
+        else:
+            response['X-Sendfile'] = plupload_file.path.encode('utf-8')
+    else:
+        try:
+            requested = byte_range(request, size, etag, mtime)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+        try:
+            f = plupload_file.open()
+        except IOError:
+            raise Http404("file not found")
+        if requested is None:
+            response = FileResponse(f, content_type=info.content_type or 'application/octet-stream')
+            response['Content-Length'] = size
+        else:
+            start, end = requested
+            response = FileResponse(RangeFile(f, start, end - start + 1), status=206,
+                                    content_type=info.content_type or 'application/octet-stream')
+            response.block_size = BLOCK_SIZE
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+    for name, value in headers.items():
+        response[name] = value
+    patch_cache_control(response, private=True)  # not for shared caches, access is checked for each download
+    return response
+
+
+def in_upload_dir(field, plupload_file):
+    """
+    True if plupload_file is under the upload_to directory of field, symlinks resolved
+    """
+    upload_dir = os.path.realpath(os.path.join(MEDIA_ROOT, field.upload_to))
+    return os.path.realpath(plupload_file.path).startswith(os.path.join(upload_dir, ''))
+
+
+def download(request, model, pk, field_name, index=None):
+    """
+    Serves the file uploaded to field_name of the object pk of model ('app_label.model_name'), the index-th file of a
+    multi-file field, if the download_access hook of the field allows it. ?attachment=1 to have browsers save it
+    """
+    from plupload.models import PluploadField
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        model_class = apps.get_model(model)
+        field = model_class._meta.get_field(field_name)
+    except (LookupError, ValueError, FieldDoesNotExist):
+        raise Http404("no such field")
+    if not isinstance(field, PluploadField) or not field.download_access:
+        raise Http404("no such field")
+    try:
+        instance = get_object_or_404(model_class, pk=pk)
+    except ValueError:
+        raise Http404("no such object")  # not a valid primary key
+    files = getattr(instance, field.file_attname)
+    if not field.multiple:
+        files = [files] if files and index is None else []
+    try:
+        plupload_file = files[int(index or 0)]
+    except IndexError:
+        raise Http404("no such file")
+    if not in_upload_dir(field, plupload_file):
+        raise Http404("no such file")
+    if not field.can_download(request, instance, plupload_file.name):
+        raise PermissionDenied
+    return serve_file(request, plupload_file, attachment=bool(request.GET.get('attachment')))
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+from plupload.settings import MEDIA_ROOT, MEDIA_URL, HASH_ALGORITHMS, FILE_INFO
+import mimetypes
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Metadata of the uploaded files: with PLUPLOAD_FILE_INFO = True size, modification time, content type, checksum and
+image dimensions of each file are saved in PluploadFileInfo when its upload is complete, so that pages showing many
+PluploadField values (i.e. admin changelists) read them from the DB, in one query, instead of hitting the filesystem
+(slow on NFS) for each file. The widget and the form field check that the files exist the same way.
+
+Models expose them through PluploadFile (see PluploadField, the <name>_file attribute, or <name>_files for multi-file
+fields), loading them the first time they are needed or in bulk for a queryset (see
+plupload.models.prefetch_file_info). Files not recorded (uploaded before, or while PLUPLOAD_FILE_INFO was off) are read
+from disk once, then recorded, without checksum.
+
+Paths are relative to MEDIA_ROOT, as stored in PluploadField values.
+"""
+
+LOOKUP_BATCH = 500  # paths per query
+
+
+def normalize(path):
+    return os.path.normpath(path).lstrip('/') if path else ''
+
+
+def read_metadata(path, checksums=None):
+    """
+    Returns an unsaved PluploadFileInfo for the file at path (relative to MEDIA_ROOT), None if it doesn't exist.
+    checksums is {algorithm: hex digest} if known, the first of PLUPLOAD_HASH_ALGORITHMS is kept. Image dimensions
+    need Pillow, which reads just the image header
+    """
+    from plupload.models import PluploadFileInfo
+    path = normalize(path)
+    abs_path = os.path.join(MEDIA_ROOT, path)
+    try:
+        st = os.stat(abs_path)
+    except OSError:
+        return None
+    info = PluploadFileInfo(path=path, size=st.st_size, mtime=st.st_mtime,
+                            content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    for algorithm in HASH_ALGORITHMS:
+        if checksums and checksums.get(algorithm):
+            info.checksum = '%s:%s' % (algorithm, checksums[algorithm])
+            break
+    if Image is not None and info.content_type.startswith('image/'):
+        try:
+            image = Image.open(abs_path)
+            info.width, info.height = image.size
+            info.content_type = Image.MIME.get(image.format, info.content_type)
+        except (IOError, ValueError):
+            pass  # not an image after all
+    return info
+
+
+def save(info):
+    """
+    Saves the metadata read by read_metadata, replacing what was recorded for the same path
+    """
+    from plupload.models import PluploadFileInfo
+    fields = ('size', 'mtime', 'content_type', 'checksum', 'width', 'height')
+    PluploadFileInfo.objects.update_or_create(path=info.path,
+                                              defaults=dict((name, getattr(info, name)) for name in fields))
+
+
+def record(path, checksums=None):
+    """
+    Reads and saves the metadata of the file at path; returns them, None if the file doesn't exist
+    """
+    info = read_metadata(path, checksums)
+    if info is not None and FILE_INFO:
+        save(info)
+    return info
+
+
+def refresh(abs_path):
+    """
+    Records the file at abs_path again, checksum included, once it has been modified (i.e. resized, see
+    plupload.resize). Called by a background thread
+    """
+    from django.db import connection
+    from plupload.hashing import digests
+    try:
+        record(os.path.relpath(abs_path, MEDIA_ROOT), digests(None, abs_path))
+    finally:
+        connection.close()  # this thread's own connection
+
+
+def forget(path):
+    """
+    The file at path has been removed
+    """
+    from plupload.models import PluploadFileInfo
+    if FILE_INFO:
+        PluploadFileInfo.objects.filter(path=normalize(path)).delete()
+
+
+def lookup(paths):
+    """
+    Returns {path: PluploadFileInfo} for the paths recorded, in a query per LOOKUP_BATCH paths; empty without
+    PLUPLOAD_FILE_INFO
+    """
+    from plupload.models import PluploadFileInfo
+    if not FILE_INFO:
+        return {}
+    by_path = {}
+    for path in paths:
+        if path:
+            by_path.setdefault(normalize(path), []).append(path)
+    normalized = list(by_path)
+    found = {}
+    for i in xrange(0, len(normalized), LOOKUP_BATCH):
+        for info in PluploadFileInfo.objects.filter(path__in=normalized[i:i + LOOKUP_BATCH]):
+            for path in by_path.get(info.path, ()):
+                found[path] = info
+    return found
+
+
+class PluploadFile(object):
+    """
+    A file uploaded to a PluploadField: name is its path relative to MEDIA_ROOT (the field value). The metadata are
+    loaded the first time one is needed, unless prefetched; size, mtime and the others are None if the file doesn't
+    exist
+    """
+    _missing = object()
+    owner = None  # (field, instance, index), set by PluploadField.files
+
+    def __init__(self, name, info=_missing):
+        self.name = name
+        self._info = info
+
+    def __unicode__(self):
+        return self.name
+
+    def __str__(self):
+        return self.name.encode('utf-8') if isinstance(self.name, unicode) else self.name
+
+    def __repr__(self):
+        return '<PluploadFile: %s>' % self
+
+    def __eq__(self, other):
+        return self.name == getattr(other, 'name', other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @property
+    def info(self):
+        """
+        The PluploadFileInfo of the file, None if it doesn't exist
+        """
+        if self._info is self._missing:
+            self._info = lookup([self.name]).get(self.name) or record(self.name)
+        return self._info
+
+    @property
+    def path(self):
+        return os.path.join(MEDIA_ROOT, normalize(self.name))
+
+    @property
+    def url(self):
+        return os.path.join(MEDIA_URL, normalize(self.name))
+
+    @property
+    def download_url(self):
+        """
+        Url of the file served by the download view, checking access (see plupload.download); None if the field doesn't
+        allow downloads
+        """
+        if self.owner is None:
+            return None
+        field, instance, index = self.owner
+        return field.download_url(instance, index)
+
+    @property
+    def exists(self):
+        return self.info is not None
+
+    def _get(name):
+        return property(lambda self: getattr(self.info, name) if self.info is not None else None)
+
+    size = _get('size')
+    mtime = _get('mtime')
+    content_type = _get('content_type')
+    checksum = _get('checksum')
+    width = _get('width')
+    height = _get('height')
+    del _get
+
+    def open(self, mode='rb'):
+        return open(self.path, mode)
@@ -3,16 +3,33 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext_lazy as _
 from django.forms import Form
 from django.forms.fields import FilePathField
 from django.forms.util import flatatt
 from django.forms.widgets import Input
-from django.template.loader import render_to_string
+from django.core.urlresolvers import reverse
+from django.template import Context
+from django.template.loader import get_template, render_to_string
 from django.template.defaultfilters import capfirst
 from plupload.settings import (UPLOAD_TO, EXTENSIONS, MAX_FILE_SIZE, UNIQUE_NAMES, UPLOAD_CHMOD,
                                SHOW_REMOVE, SHOW_THUMBNAIL, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, RESIZE_WIDTH,
-                               RESIZE_HEIGHT, RESIZE_QUALITY, AUTO_START, STATIC_URL, CHUNK_SIZE)
+                               RESIZE_HEIGHT, RESIZE_QUALITY, AUTO_START, CHUNK_SIZE,
+                               DEDUPLICATE, SERVER_RESIZE, MULTIPART, COMPRESS, ADAPTIVE_CHUNK_SIZE, MIN_CHUNK_SIZE,
+                               MAX_CHUNK_SIZE)
+from plupload.tokens import issue_control_code
+from plupload.utils import split_paths
+from plupload.assets import asset_url
+from plupload import chunking, fileinfo, thumbnails
+import django
+import json
 import os
+import sys
+import time
+
+CONFIG_OPTIONS = ('upload_to', 'resize_width', 'resize_height', 'resize_quality', 'extensions', 'max_file_size',
+                  'unique_names', 'upload_chmod', 'show_remove', 'show_thumbnail', 'deduplicate', 'server_resize',
+                  'max_files', 'compress', 'min_chunk_size', 'max_chunk_size')
 
 
 def convert_bytes(bytes):
@@ -36,83 +53,185 @@ def convert_bytes(bytes):
     return str(size)
 
 
+FILE_CHECK_TTL = 10  # seconds, how long the existence of the uploaded file shown by a widget is cached
+
+_file_checks = {}  # absolute path: (exists, time checked)
+_widget_template = []  # compiled widget.html, unless DEBUG
+
+
+def file_exists(path):
+    """
+    os.path.isfile, cached for FILE_CHECK_TTL seconds: many widgets rendered at once (i.e. formsets, admin changelists)
+    don't stat the same files over and over
+    """
+    now = time.time()
+    checked = _file_checks.get(path)
+    if checked is None or now - checked[1] > FILE_CHECK_TTL:
+        if len(_file_checks) > 10000:
+            _file_checks.clear()
+        checked = _file_checks[path] = (os.path.isfile(path), now)
+    return checked[0]
+
+
+def render_widget_template(context):
+    if settings.DEBUG:
+        return render_to_string('plupload/widget.html', context)
+    if not _widget_template:
+        _widget_template.append(get_template('plupload/widget.html'))
+    if django.VERSION >= (1, 8):
+        return _widget_template[0].render(context)
+    return _widget_template[0].render(Context(context))
+
+
+class PluploadWidgetConfig(object):
+    """
+    The configuration of a plupload widget, computed once, when the field is built: Django copies fields and widgets
+    for each form instance, this is shared by all the copies. Rendering a widget just adds the value and a new control
+    code
+    """
+
+    def __init__(self, upload_to=UPLOAD_TO, resize_width=RESIZE_WIDTH, resize_height=RESIZE_HEIGHT,
+                 resize_quality=RESIZE_QUALITY, extensions=EXTENSIONS, max_file_size=MAX_FILE_SIZE,
+                 unique_names=UNIQUE_NAMES, upload_chmod=UPLOAD_CHMOD, show_remove=SHOW_REMOVE,
+                 show_thumbnail=SHOW_THUMBNAIL, deduplicate=DEDUPLICATE, server_resize=SERVER_RESIZE, max_files=1,
+                 compress=COMPRESS, min_chunk_size=MIN_CHUNK_SIZE, max_chunk_size=MAX_CHUNK_SIZE):
+        self.upload_to = (upload_to or '').rstrip('/')  # relative to MEDIA_ROOT
+        self.resize_width = resize_width
+        self.resize_height = resize_height
+        self.resize_quality = resize_quality
+        self.extensions = extensions  # allowed extensions for this field
+        self.max_file_size = max_file_size  # max allowed file size in Mb
+        self.unique_names = unique_names  # change uploaded file name to make it unique
+        self.upload_chmod = upload_chmod  # attempt chmod once file is uploaded
+        self.show_remove = show_remove  # shows 'remove' checkbox
+        self.show_thumbnail = show_thumbnail  # shows as thumbnail of uploaded image
+        self.deduplicate = deduplicate  # content addressed storage
+        self.server_resize = server_resize  # resize_to enforced on the server too
+        self.max_files = max_files  # more than 1 (0 = no limit): multi-file, the input holds a JSON list of paths
+        self.multiple = max_files != 1
+        self.compress = compress  # extensions of the files gzipped by the browser before upload
+        self.min_chunk_size = min_chunk_size  # Mb, bounds of the chunk size recommended by the server
+        self.max_chunk_size = max_chunk_size
+        self.resize = None
+        if server_resize and (resize_width or resize_height):
+            self.resize = (int(resize_width or 0), int(resize_height or 0), int(resize_quality or 0))
+        self.thumbnail_style = ''  # width/height of the uploaded image thumbnail
+        if THUMBNAIL_WIDTH:
+            self.thumbnail_style += 'max-width:%spx;' % THUMBNAIL_WIDTH
+        if THUMBNAIL_HEIGHT:
+            self.thumbnail_style += 'max-height:%spx;' % THUMBNAIL_HEIGHT
+        self._js_config = None
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def issue_control_code(self):
+        return issue_control_code(self.upload_to, max_file_size=self.max_file_size, extensions=self.extensions,
+                                  deduplicate=self.deduplicate, resize=self.resize)
+
+    def js_config(self):
+        """
+        Settings for django_plupload.init (see django.plupload.js), as a JSON object safe to put in a <script>.
+        Computed at the first render, the urls can't be reversed while the url configuration is being loaded
+        """
+        if self._js_config is None:
+            config = {
+                'upload_url': reverse('plupload') if MULTIPART else reverse('plupload_raw'),
+                'multipart': bool(MULTIPART),
+                'raw_upload_url': reverse('plupload_raw'),
+                'compress': [x.strip().lower() for x in self.compress if x] if self.compress else None,
+                'status_url': reverse('plupload_status'),
+                'loading_image_url': asset_url('plupload/img/loading_small.gif'),
+                'upload_to': self.upload_to,
+                'auto_start': AUTO_START,
+                'max_files': self.max_files,
+                'multiple': self.multiple,
+                'unique_names': bool(self.unique_names),
+                'show_thumbnail': bool(self.show_thumbnail),
+                'upload_chmod': self.upload_chmod or '',
+                # a string formatted for max_file_size setting, i.e. '2mb' '1000kb' '500000b', etc.:
+                'max_file_size': convert_bytes(float(self.max_file_size) * 1048576) if self.max_file_size else '',
+                'chunk_size': '%smb' % CHUNK_SIZE if CHUNK_SIZE else '',
+                # bytes, the chunk size recommended by the server is narrowed to the field's bounds
+                'adaptive_chunk_size': bool(ADAPTIVE_CHUNK_SIZE and CHUNK_SIZE),
+                'min_chunk_size': chunking.clamp(int(float(self.min_chunk_size or 0) * 1048576)),
+                'max_chunk_size': chunking.clamp(int(float(self.max_chunk_size or 0) * 1048576) or sys.maxint),
+                'resize': None,
+                'extensions': None,
+            }
+            if self.resize_width or self.resize_height:
+                config['resize'] = {'width': int(self.resize_width or 1000000),
+                                    'height': int(self.resize_height or 1000000)}
+                if self.resize_quality:
+                    config['resize']['quality'] = int(self.resize_quality)
+            if self.extensions:
+                # plupload extensions are case sensitive
+                config['extensions'] = [x.strip().lower() for x in self.extensions if x] + \
+                                       [x.strip().upper() for x in self.extensions if x] + \
+                                       [capfirst(x.strip().lower()) for x in self.extensions if x]
+            self._js_config = mark_safe(json.dumps(config, default=force_unicode).replace('<', '\\u003c'))
+        return self._js_config
+
+
 class PluploadInputWidget(Input):
     """
     Renders an input tag (hidden) and the plupload window connected to it
     """
     input_type = 'text'
 
-    def __init__(self, attrs=None):
+    def __init__(self, attrs=None, config=None):
         if attrs is not None:
             self.attrs = attrs.copy()
         else:
             self.attrs = {}
+        # configuration passed as attributes, the old way
+        options = dict((name, self.attrs.pop(name)) for name in CONFIG_OPTIONS if name in self.attrs)
+        self.config = config or PluploadWidgetConfig(**options)
 
     def render(self, name, value, attrs=None):
-        from plupload.models import PluploadControlCode
         if value is None:
             value = ''
         final_attrs = self.build_attrs(attrs, type=self.input_type, name=name)
         final_attrs['class'] = '%s pluploader' % final_attrs['class'] if final_attrs.get('class') else 'pluploader'
         id = final_attrs.get('id', '')
-        self.upload_to = final_attrs.pop('upload_to', UPLOAD_TO).rstrip('/')  # UPLOAD_TO relative to MEDIA_ROOT
-        self.resize_width = final_attrs.pop('resize_width', RESIZE_WIDTH)
-        self.resize_height = final_attrs.pop('resize_height', RESIZE_HEIGHT)
-        self.resize_quality = final_attrs.pop('resize_quality', RESIZE_QUALITY)
-        self.extensions = final_attrs.pop('extensions', EXTENSIONS)  # allowed extensions for this field
-        self.max_file_size = final_attrs.pop('max_file_size', MAX_FILE_SIZE)  # max allowed file size in Mb
-        self.unique_names = final_attrs.pop('unique_names', UNIQUE_NAMES)  # change uploaded file name to make it unique
-        self.upload_chmod = final_attrs.pop('upload_chmod', UPLOAD_CHMOD)  # attempt chmod once file is uploaded
-        self.show_remove = final_attrs.pop('show_remove', SHOW_REMOVE)  # shows 'remove' checkbox
-        self.show_thumbnail = final_attrs.pop('show_thumbnail', SHOW_THUMBNAIL)  # shows as thumbnail of uploaded image
-        if value != '':
+        config = self.config
+        if config.multiple:
+            paths = [force_unicode(path) for path in split_paths(value)]
+            if paths:
+                final_attrs['value'] = json.dumps(paths)  # the list of paths uploaded, upload_to + filename
+        elif value != '':
             # Only add the 'value' attribute if a value is non-empty.
             final_attrs['value'] = force_unicode(self._format_value(value))  # upload_to + filename
-        self.uploaded_filename = ''
-        self.uploaded_url = os.path.join(settings.MEDIA_URL, final_attrs['value']) if final_attrs.get('value') else ''
-        thumbnail_style = ''  # width/height of the uploaded image thumbnail
+            paths = [final_attrs['value']]
+        else:
+            paths = []
+        uploaded_files = []
         error = ''
-        if final_attrs.get('value'):
-            self.uploaded_filename = final_attrs['value'].replace(self.upload_to, '', 1).strip('/')
-            if os.path.isfile(os.path.join(settings.MEDIA_ROOT, final_attrs['value'].lstrip('/'))):
-                if self.show_thumbnail:
-                    if THUMBNAIL_WIDTH or THUMBNAIL_HEIGHT:
-                        thumbnail_style = ''
-                        if THUMBNAIL_WIDTH:
-                            thumbnail_style += 'width:%spx;' % THUMBNAIL_WIDTH
-                        if THUMBNAIL_HEIGHT:
-                            thumbnail_style += 'height:%spx;' % THUMBNAIL_HEIGHT
+        recorded = fileinfo.lookup(paths)  # with PLUPLOAD_FILE_INFO, no need to check they exist on disk
+        for path in paths:
+            uploaded_file = {
+                'value': path,
+                'filename': path.replace(config.upload_to, '', 1).strip('/'),
+                'url': os.path.join(settings.MEDIA_URL, path),
+            }
+            uploaded_file['thumbnail_url'] = uploaded_file['url']
+            if path in recorded or file_exists(os.path.join(settings.MEDIA_ROOT, path.lstrip('/'))):
+                if config.show_thumbnail:
+                    # cached thumbnail, if ready, otherwise the image itself (and the thumbnail is generated)
+                    if thumbnails.is_fresh(path):
+                        uploaded_file['thumbnail_url'] = thumbnails.thumbnail_url(path)
+                    else:
+                        thumbnails.schedule(path)
             else:
                 error = u'Warning: file does not exist! It has probably been moved or deleted.'
-        control_code = PluploadControlCode()
-        control_code.upload_to = self.upload_to
-        control_code.save()
-        if self.extensions:
-            self.extensions = [x.strip().lower() for x in self.extensions if x] + \
-                              [x.strip().upper() for x in self.extensions if x] + \
-                              [capfirst(x.strip().lower()) for x in self.extensions if x]
-        html = render_to_string('plupload/widget.html', {
+            uploaded_files.append(uploaded_file)
+        html = render_widget_template({
             'id': id,
             'final_attrs': flatatt(final_attrs),
-            'upload_to': self.upload_to,
-            'uploaded_url': self.uploaded_url,
-            'uploaded_filename': self.uploaded_filename,
-            'thumbnail_style': thumbnail_style,
+            'config': config,
+            'uploaded_files': uploaded_files,
             'error': error,
-            'control_code': control_code.code,
-            'auto_start': AUTO_START,
-            'STATIC_URL': STATIC_URL,
-            'chunk_size': CHUNK_SIZE,
-            'resize_width': str(self.resize_width),  # to avoid 1024 becoming 1.024
-            'resize_height': str(self.resize_height),
-            'resize_quality': self.resize_quality,
-            'extensions': self.extensions,
-            # a string formatted for max_file_size setting, i.e. '2mb' '1000kb' '500000b', etc.:
-            'max_file_size': convert_bytes(float(self.max_file_size)*1048576) if self.max_file_size else '',
-            'unique_names': self.unique_names,
-            'upload_chmod': self.upload_chmod,
-            'show_remove': self.show_remove,
-            'show_thumbnail': self.show_thumbnail,
+            'control_code': config.issue_control_code(),
         })
         return mark_safe(html)
 
@@ -122,11 +241,15 @@ class PluploadFormField(FilePathField):
     A subclass of forms.FilePathField that renders a plupload window
     """
     widget = PluploadInputWidget
+    default_error_messages = {
+        'max_files': _(u"Too many files, %(max_files)s at most."),
+    }
 
     def __init__(self, upload_to, match=None, recursive=False, allow_files=True, allow_folders=False, required=True,
                  widget=None, label=None, initial=None, help_text=None, resize_width=None, resize_height=None,
                  resize_quality=None, extensions=[], max_file_size=None, unique_names=False, upload_chmod=None,
-                 show_remove=False, show_thumbnail=False, *args, **kwargs):
+                 show_remove=False, show_thumbnail=False, deduplicate=False, server_resize=False, max_files=1,
+                 compress=None, min_chunk_size=None, max_chunk_size=None, *args, **kwargs):
         self.match, self.recursive = match, recursive
         widget = widget or self.widget(attrs={'readonly': 'readonly'})
         if isinstance(widget, type):
@@ -136,42 +259,49 @@ class PluploadFormField(FilePathField):
         # while FilePathField's 'path' is an absolute path: we use the absolute path, since we are subclassing
         # FilePathField
         self.path = kwargs.pop('path', os.path.join(settings.MEDIA_ROOT, upload_to.rstrip('/')))
-        # resize_to = None
-        # if 'resize_to' in kwargs.keys():
-            # resize_to = kwargs.pop('resize_to') or None
-        widget.attrs['resize_width'] = ''
-        widget.attrs['resize_height'] = ''
-        widget.attrs['resize_quality'] = ''
-        if resize_width:
-            widget.attrs['resize_width'] = resize_width
-        if resize_height:
-            widget.attrs['resize_height'] = resize_height
-        if resize_quality:
-            widget.attrs['resize_quality'] = resize_quality
-        widget.attrs['upload_to'] = upload_to
-        widget.attrs['extensions'] = extensions  # allowed extensions for this field
-        widget.attrs['max_file_size'] = max_file_size  # max allowed file size in Mb
-        widget.attrs['unique_names'] = unique_names  # change uploaded file name to make it unique
-        widget.attrs['upload_chmod'] = upload_chmod  # attempt chmod once file is uploaded
-        widget.attrs['show_remove'] = show_remove  # shows 'remove' checkbox
-        widget.attrs['show_thumbnail'] = show_thumbnail  # shows as thumbnail of the uploaded image
+        widget.config = PluploadWidgetConfig(
+            upload_to=upload_to, resize_width=resize_width or '', resize_height=resize_height or '',
+            resize_quality=resize_quality or '', extensions=extensions, max_file_size=max_file_size,
+            unique_names=unique_names, upload_chmod=upload_chmod, show_remove=show_remove,
+            show_thumbnail=show_thumbnail, deduplicate=deduplicate, server_resize=server_resize, max_files=max_files,
+            compress=compress, min_chunk_size=min_chunk_size or MIN_CHUNK_SIZE,
+            max_chunk_size=max_chunk_size or MAX_CHUNK_SIZE,
+        )
+        self.max_files = max_files  # more than 1 (0 = no limit): multi-file, the value is a list of paths
         super(FilePathField, self).__init__(choices=(), required=required, widget=widget, label=label, initial=initial,
                                             help_text=help_text, *args, **kwargs)
 
+    def to_python(self, value):
+        if self.max_files != 1:
+            return [force_unicode(path) for path in split_paths(value)]
+        value = super(PluploadFormField, self).to_python(value)
+        if value == '$remove$':
+            return ''  # file removed
+        return value
+
     def validate(self, value):
         """
         Validates that the input is in self.choices.
         """
-        if value:
+        if self.max_files != 1:
+            if self.max_files and len(value) > self.max_files:
+                raise ValidationError(self.error_messages['max_files'] % {'max_files': self.max_files})
+            recorded = fileinfo.lookup(value)
+            for path in value:
+                if path not in recorded and not self.check_file_is_uploaded(path):
+                    raise ValidationError(self.error_messages['invalid_choice'] % {'value': path})
+        elif value:
             if not self.valid_value(value) or value != '$remove$':
                 if not self.check_file_is_uploaded(value):
                     raise ValidationError(self.error_messages['invalid_choice'] % {'value': value})
 
     def check_file_is_uploaded(self, file_rel_path):
         """
-        Checks if file has really been transferred
+        Checks if file has really been transferred: recorded (see plupload.fileinfo) or on disk
         """
         # file_rel_path path relative to settings.MEDIA_ROOT
+        if file_rel_path and fileinfo.lookup([file_rel_path]):
+            return True
         if file_rel_path and os.path.isfile(os.path.join(settings.MEDIA_ROOT, file_rel_path)):
             return True
         return False
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.http import QueryDict
+from django.http.multipartparser import ChunkIter, LazyStream, Parser, FIELD, FILE, exhaust
+from django.utils.datastructures import MultiValueDict
+from django.utils.encoding import force_unicode
+from plupload.tokens import resolve_control_code, InvalidControlCode
+from plupload.compression import DecompressionError
+from plupload import admission, compression, metrics, staging
+
+
+class StagedChunk(UploadedFile):
+    """
+    The 'file' part of a plupload chunk request, as parsed by PluploadUploadHandler: its content has already been
+    written to the staging file of the upload (if staged is True), so there's nothing left to read
+    """
+
+    def __init__(self, name, content_type, size, charset, key=None, offset=None, ticket=None, error=None,
+                 rejected=None):
+        super(StagedChunk, self).__init__(None, name, content_type, size, charset)
+        self.key = key
+        self.offset = offset
+        self.ticket = ticket  # resolved control code, so the view doesn't resolve it again
+        self.error = error  # exception raised writing the staging file
+        self.rejected = rejected  # why the upload has been refused by admission control
+
+    @property
+    def staged(self):
+        return self.key is not None and self.error is None
+
+    def chunks(self, chunk_size=None):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class PluploadUploadHandler(FileUploadHandler):
+    """
+    Parses plupload chunk requests (multipart, the 'file' part coming after the other parameters, as plupload sends
+    them) and writes the 'file' part straight into the staging file of the upload, at its offset, as it is read from
+    the request: no buffering in memory or in a temporary file, and no further copy. Installed on the upload view only.
+    Requests that can't be staged (i.e. wrong control code) are parsed anyway, the file part being discarded, so the
+    view can report the error. If the parameters saying where the chunk goes come after the 'file' part (see
+    can_stage), the part is spooled to a temporary file instead, and the view writes it once it has all of them
+    """
+    chunk_size = 64 * 1024
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        encoding = encoding or 'utf-8'
+        self.content_length = content_length
+        post = QueryDict('', mutable=True)
+        files = MultiValueDict()
+        stream = LazyStream(ChunkIter(input_data, self.chunk_size))
+        for item_type, meta_data, field_stream in Parser(stream, boundary):
+            try:
+                disposition = meta_data['content-disposition'][1]
+                field_name = force_unicode(disposition['name'].strip(), encoding, errors='replace')
+            except (KeyError, IndexError, AttributeError):
+                continue
+            if item_type == FIELD:
+                post.appendlist(field_name, force_unicode(field_stream.read(), encoding, errors='replace'))
+            elif item_type == FILE:
+                file_name = force_unicode(disposition.get('filename', ''), encoding, errors='replace')
+                content_type = meta_data.get('content-type', ('',))[0].strip()
+                files.appendlist(field_name, self.stage(post, field_name, file_name, content_type, field_stream))
+            else:
+                exhaust(stream)
+        exhaust(input_data)
+        post._mutable = False
+        return post, files
+
+    def stage(self, post, field_name, file_name, content_type, field_stream):
+        """
+        Writes the file part to the staging file the parameters received so far point to, returns a StagedChunk
+        """
+        if field_name != 'file':
+            return stage_chunk(self.request, {}, file_name, content_type, field_stream)
+        params = self.request.GET.copy()
+        params.update(post)
+        if not can_stage(params):
+            return spool(file_name, content_type, field_stream)
+        return stage_chunk(self.request, params, file_name, content_type, field_stream, self.content_length)
+
+    def receive_data_chunk(self, raw_data, start):
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def can_stage(params):
+    """
+    True if params (those received before the 'file' part) tell where the chunk goes: the upload (control code and file
+    id or name) and the offset ('offset', or 'chunk' with 'chunk_size' past the first chunk, since the offset depends
+    on it). A part coming before any of them can't be written to the staging file yet: written at the wrong offset, it
+    would overwrite the chunks of the upload already stored
+    """
+    if not params.get('control_code') or not (params.get('file_id') or params.get('name')):
+        return False
+    if 'offset' in params:
+        return True
+    return 'chunk' in params and (params.get('chunk') in ('', '0') or 'chunk_size' in params)
+
+
+def spool(file_name, content_type, stream):
+    """
+    Copies a chunk (stream, an iterable of strings) to a temporary file, for the view to write to the staging file
+    """
+    spooled = TemporaryUploadedFile(file_name, content_type, 0, None)
+    size = 0
+    for data in stream:
+        with metrics.phase('write'):
+            spooled.write(data)
+        size += len(data)
+    spooled.flush()
+    spooled.seek(0)
+    spooled.size = size
+    return spooled
+
+
+def stage_chunk(request, params, file_name, content_type, stream, content_length=None):
+    """
+    Writes a chunk (stream, an iterable of strings) to the staging file the request parameters point to, returns a
+    StagedChunk. Chunks that can't be staged are read and discarded, the view will report the error
+    """
+    code = params.get('control_code')
+    key = offset = ticket = rejected = None
+    if code:
+        try:
+            with metrics.phase('lookup'):
+                ticket = resolve_control_code(code)
+            chunk, chunks, chunk_size, offset, total_size = staging.get_chunk_position(params)
+            filename = params.get('name', '') or file_name
+            if total_size and ticket.check_limits(filename, total_size):
+                raise ValueError("limits exceeded")
+            encoding = compression.normalize_encoding(params.get('content_encoding'))
+            if encoding and not total_size:
+                raise ValueError("compressed chunks need the total size")
+        except (InvalidControlCode, ValueError):
+            pass  # not staging this one, the view will report the error
+        else:
+            key = staging.upload_key(code, params.get('file_id', '') or filename)
+            rejected = admission.check_upload(request, key, total_size or content_length or 0)
+            if rejected:
+                key = None  # too many uploads in progress or no room for this one, the view will report it
+    size = 0
+    if key is None:
+        for data in stream:
+            size += len(data)
+        return StagedChunk(file_name, content_type, size, None, rejected=rejected)
+    content = stream
+    if encoding:
+        content = compression.decompress(stream, encoding, compression.chunk_length(chunk_size, offset, total_size))
+    try:
+        size = staging.store_chunk(key, offset, total_size, content)
+    except DecompressionError, err:
+        exhaust(stream)
+        return StagedChunk(file_name, content_type, size, None, rejected=err.args[0])
+    except (IOError, OSError), err:
+        exhaust(stream)
+        return StagedChunk(file_name, content_type, size, None, key=key, offset=offset, ticket=ticket, error=err)
+    return StagedChunk(file_name, content_type, size, None, key=key, offset=offset, ticket=ticket)
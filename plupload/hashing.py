@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from plupload.settings import HASH_ALGORITHMS
+import hashlib
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+"""
+Incremental hashing of uploads: digests are updated while chunks are written to the staging file, so no extra pass
+over the file is needed once the upload is complete.
+
+The hash state of an upload lives in the memory of the process handling its chunks (hashlib objects can't be saved
+elsewhere): chunks written in order by the same process are hashed as they are written. Whatever couldn't be hashed
+that way (chunks coming out of order, or handled by other processes) is read back from the staging file when the upload
+is finalized (see digests).
+"""
+
+MAX_STATES = 1000  # hash states kept in memory, the oldest ones are dropped (and hashed from disk when finalized)
+
+_states = {}
+_lock = threading.Lock()
+
+
+def new_hash(algorithm):
+    if algorithm.startswith('xxh'):
+        if xxhash is None:
+            raise ValueError("xxhash is not installed")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+class UploadHasher(object):
+    """
+    Hash objects for each of HASH_ALGORITHMS, and the offset of the next byte to hash
+    """
+
+    def __init__(self, algorithms=None):
+        self.hashes = [(algorithm, new_hash(algorithm)) for algorithm in (algorithms or HASH_ALGORITHMS)]
+        self.offset = 0
+        self.busy = False
+        self.touched = time.time()
+
+    def update(self, data):
+        for algorithm, h in self.hashes:
+            h.update(data)
+
+    def hexdigests(self):
+        return dict((algorithm, h.hexdigest()) for algorithm, h in self.hashes)
+
+
+def claim(key, offset):
+    """
+    Returns the hasher of the upload if the chunk starting at offset is the next one to hash (the caller then feeds it
+    the chunk data and calls release), None otherwise
+    """
+    if not HASH_ALGORITHMS:
+        return None
+    with _lock:
+        hasher = _states.get(key)
+        if hasher is None and offset == 0:
+            if len(_states) >= MAX_STATES:
+                oldest = min(_states, key=lambda k: _states[k].touched)
+                del _states[oldest]
+            hasher = _states[key] = UploadHasher()
+        if hasher is None or hasher.busy or hasher.offset != offset:
+            return None
+        hasher.busy = True
+        hasher.touched = time.time()
+        return hasher
+
+
+def release(key, hasher, written, ok=True):
+    """
+    Releases a hasher returned by claim, once written bytes have been fed to it; if something went wrong writing the
+    chunk (ok=False) the state is dropped, since it might have been fed partial data
+    """
+    if hasher is None:
+        return
+    with _lock:
+        hasher.busy = False
+        if ok:
+            hasher.offset += written
+        elif _states.get(key) is hasher:
+            del _states[key]
+
+
+def digests(key, path):
+    """
+    Returns a dict {algorithm: hex digest} for the complete upload, hashing from the staging file at path just what
+    hasn't been hashed while writing the chunks
+    """
+    if not HASH_ALGORITHMS:
+        return {}
+    with _lock:
+        hasher = _states.pop(key, None)
+    if hasher is None or hasher.busy:
+        hasher = UploadHasher()
+    f = open(path, 'rb')
+    try:
+        f.seek(hasher.offset)
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        f.close()
+    return hasher.hexdigests()
+
+
+def discard(key):
+    with _lock:
+        _states.pop(key, None)
+
+
+def check_checksum(checksum, hexdigests):
+    """
+    Compares a checksum sent by the client, '<algorithm>:<hex digest>' or just '<hex digest>' for the first of
+    HASH_ALGORITHMS, with the digests of the upload. Returns False on mismatch or if the algorithm was not computed
+    """
+    if ':' in checksum:
+        algorithm, digest = checksum.split(':', 1)
+    else:
+        algorithm, digest = (HASH_ALGORITHMS[0] if HASH_ALGORITHMS else ''), checksum
+    return hexdigests.get(algorithm.strip().lower()) == digest.strip().lower()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from plupload import dedup
+
+
+class Command(BaseCommand):
+    """
+    Removes the blobs of the deduplicating storage that no uploaded file links to anymore, to be run periodically
+    """
+    help = "Removes unreferenced plupload blobs"
+    option_list = BaseCommand.option_list + (
+        make_option('--grace-period', dest='grace_period', type='int', default=dedup.GRACE_PERIOD,
+                    help="Seconds, unreferenced blobs younger than this are kept (default %s)" % dedup.GRACE_PERIOD),
+    )
+
+    def handle(self, *args, **options):
+        removed = dedup.collect_garbage(options.get('grace_period', dedup.GRACE_PERIOD))
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write("%s unreferenced blobs removed\n" % removed)
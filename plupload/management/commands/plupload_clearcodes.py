@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from plupload.models import PluploadControlCode
+import time
+
+
+class Command(BaseCommand):
+    """
+    Removes expired control codes (older than PLUPLOAD_CONTROL_CODE_TTL), to be run periodically i.e. by cron:
+
+        python manage.py plupload_clearcodes --batch-size=1000
+
+    Rows are deleted in batches of bounded size, so the table is never locked for long.
+    """
+    help = "Removes expired plupload control codes, in batches"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help="Number of control codes deleted per query (default 1000)"),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+                    help="Seconds to wait between batches (default 0)"),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size') or 1000
+        deleted = 0
+        while True:
+            pks = list(PluploadControlCode.expired().values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            PluploadControlCode.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            if options.get('sleep'):
+                time.sleep(options['sleep'])
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write("%s expired control codes removed\n" % deleted)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from plupload import staging
+from plupload.settings import STAGING_MAX_AGE
+
+
+class Command(BaseCommand):
+    """
+    Removes the staging files of the uploads abandoned by their clients, to be run periodically (unless
+    PLUPLOAD_STAGING_SWEEP_INTERVAL is set)
+    """
+    help = "Removes abandoned plupload uploads from the staging area"
+    option_list = BaseCommand.option_list + (
+        make_option('--max-age', dest='max_age', type='int', default=STAGING_MAX_AGE,
+                    help="Seconds, uploads that haven't received chunks for this long are removed (default %s)" %
+                         STAGING_MAX_AGE),
+    )
+
+    def handle(self, *args, **options):
+        removed, freed = staging.sweep(options.get('max_age', STAGING_MAX_AGE))
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write("%s abandoned uploads removed, %s bytes freed\n" % (removed, freed))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from contextlib import contextmanager
+from plupload.settings import STAGING_DIR
+import os
+import threading
+import time
+
+
+"""
+Instrumentation of the upload view: where the time of each chunk request goes, and how many bytes, chunks and uploads
+went through.
+
+Each phase of a chunk request (see PHASES) is timed: the timings of the current request are sent back in the
+Server-Timing response header (shown by the browser developer tools, next to the request), passed to the receivers of
+the plupload.signals signals, and added up, per process, with the counters below. With PLUPLOAD_METRICS = True the
+plupload_metrics url serves them in the Prometheus text format.
+
+Phases overlap: 'parse' is reading and parsing the whole request body, including 'lookup', 'open' and 'write' when
+the chunk is streamed to the staging file while parsing (see plupload.handlers); what's left is mostly waiting for the
+client.
+"""
+
+PHASES = (
+    ('parse', "reading and parsing the request body"),
+    ('validate', "form validation"),
+    ('lookup', "control code lookup"),
+    ('open', "opening (and preallocating) the staging file"),
+    ('decompress', "decompressing compressed chunks"),
+    ('write', "writing the chunk to disk"),
+    ('mark', "updating the chunk map"),
+    ('hash', "computing the checksums left to compute"),
+    ('finalize', "moving (or copying) the staging file to its final position"),
+    ('chmod', "changing permissions of the uploaded file"),
+    ('metadata', "recording the metadata of the uploaded file"),
+    ('cleanup', "removing the staging files"),
+    ('track', "saving the upload done status"),
+)
+
+COUNTERS = (
+    ('bytes_received', "bytes of chunks received"),
+    ('bytes_compressed', "bytes of compressed chunks received, before decompression"),
+    ('chunks_received', "chunks received"),
+    ('uploads_completed', "files uploaded"),
+    ('uploads_failed', "upload requests failed"),
+    ('requests_throttled', "upload requests refused by the rate limits, to be retried"),
+)
+
+_local = threading.local()  # greenlet local when monkey patched
+_lock = threading.Lock()
+_counters = dict((name, 0) for name, help_text in COUNTERS)
+_phase_seconds = dict((name, 0.0) for name, help_text in PHASES)
+_phase_count = dict((name, 0) for name, help_text in PHASES)
+_in_progress = [0]
+
+
+class RequestTimer(object):
+    """
+    Timings of the phases of a chunk request, in seconds
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = OrderedDict()
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.time() - self.start
+
+    def server_timing(self):
+        """
+        Value of the Server-Timing header, durations in milliseconds
+        """
+        timings = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in self.timings.items()]
+        timings.append('total;dur=%.3f' % (self.total() * 1000))
+        return ', '.join(timings)
+
+
+def start():
+    """
+    Starts timing the request handled by the current (green) thread, returns its RequestTimer
+    """
+    _local.timer = RequestTimer()
+    with _lock:
+        _in_progress[0] += 1
+    return _local.timer
+
+
+def stop():
+    _local.timer = None
+    with _lock:
+        _in_progress[0] -= 1
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Times the enclosed block as phase name, for the current request if any and in the totals of the process. Phases
+    repeated in the same request (i.e. each write of a chunk) add up
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - started
+        timer = current()
+        if timer is not None:
+            timer.add(name, seconds)
+        with _lock:
+            _phase_seconds[name] = _phase_seconds.get(name, 0.0) + seconds
+            _phase_count[name] = _phase_count.get(name, 0) + 1
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def active_uploads():
+    """
+    Uploads in progress, of all processes: the staging files of uploads not finalized yet (or abandoned)
+    """
+    from plupload.staging import PART_SUFFIX, DONE_SUFFIX
+    try:
+        names = os.listdir(STAGING_DIR)
+    except OSError:
+        return 0
+    done = set(name[:-len(DONE_SUFFIX)] for name in names if name.endswith(DONE_SUFFIX))
+    return len([name for name in names if name.endswith(PART_SUFFIX) and name[:-len(PART_SUFFIX)] not in done])
+
+
+def prometheus_text():
+    """
+    The metrics of this process, in the Prometheus text exposition format
+    """
+    with _lock:
+        counters = dict(_counters)
+        phase_seconds = dict(_phase_seconds)
+        phase_count = dict(_phase_count)
+        in_progress = _in_progress[0]
+    lines = []
+    for name, help_text in COUNTERS:
+        lines.append('# HELP plupload_%s_total Number of %s' % (name, help_text))
+        lines.append('# TYPE plupload_%s_total counter' % name)
+        lines.append('plupload_%s_total %s' % (name, counters[name]))
+    lines.append('# HELP plupload_phase_seconds Time spent in each phase of the upload requests')
+    lines.append('# TYPE plupload_phase_seconds summary')
+    for name, help_text in PHASES:
+        lines.append('plupload_phase_seconds_sum{phase="%s"} %.6f' % (name, phase_seconds[name]))
+        lines.append('plupload_phase_seconds_count{phase="%s"} %s' % (name, phase_count[name]))
+    lines.append('# HELP plupload_requests_in_progress Upload requests being handled by this process')
+    lines.append('# TYPE plupload_requests_in_progress gauge')
+    lines.append('plupload_requests_in_progress %s' % in_progress)
+    lines.append('# HELP plupload_active_uploads Uploads in progress, staging files not finalized yet')
+    lines.append('# TYPE plupload_active_uploads gauge')
+    lines.append('plupload_active_uploads %s' % active_uploads())
+    return '\n'.join(lines) + '\n'
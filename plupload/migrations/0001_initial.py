@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PluploadControlCode',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('upload_to', models.CharField(max_length=100, null=True, verbose_name='Upload path', blank=True)),
+                ('code', models.CharField(max_length=100, verbose_name='Control code')),
+                ('upload_done', models.BooleanField(default=False, verbose_name='Upload done?')),
+                ('date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
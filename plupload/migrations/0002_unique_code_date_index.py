@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plupload', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pluploadcontrolcode',
+            name='code',
+            field=models.CharField(unique=True, max_length=100, verbose_name='Control code'),
+        ),
+        migrations.AlterField(
+            model_name='pluploadcontrolcode',
+            name='date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plupload', '0002_unique_code_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pluploadcontrolcode',
+            name='deduplicate',
+            field=models.BooleanField(default=False, verbose_name='Deduplicating storage'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plupload', '0003_deduplicate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pluploadcontrolcode',
+            name='resize_height',
+            field=models.PositiveIntegerField(null=True, verbose_name='Server resize height', blank=True),
+        ),
+        migrations.AddField(
+            model_name='pluploadcontrolcode',
+            name='resize_quality',
+            field=models.PositiveSmallIntegerField(null=True, verbose_name='Server resize quality', blank=True),
+        ),
+        migrations.AddField(
+            model_name='pluploadcontrolcode',
+            name='resize_width',
+            field=models.PositiveIntegerField(null=True, verbose_name='Server resize width', blank=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plupload', '0004_server_resize'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PluploadFileInfo',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.CharField(unique=True, max_length=255, verbose_name='Path')),
+                ('size', models.BigIntegerField(verbose_name='Size')),
+                ('mtime', models.FloatField(verbose_name='Modification time')),
+                ('content_type', models.CharField(max_length=100, verbose_name='Content type', blank=True)),
+                ('checksum', models.CharField(max_length=200, verbose_name='Checksum', blank=True)),
+                ('width', models.PositiveIntegerField(null=True, verbose_name='Image width', blank=True)),
+                ('height', models.PositiveIntegerField(null=True, verbose_name='Image height', blank=True)),
+                ('date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
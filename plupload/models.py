@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.urlresolvers import reverse
+from django.core.validators import MaxLengthValidator
 from django.db import models
+from django.db.models import signals
+from django.utils import timezone
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 from plupload.settings import (UPLOAD_TO, MEDIA_ROOT, EXTENSIONS, MAX_FILE_SIZE, UNIQUE_NAMES, UPLOAD_CHMOD,
-                               SHOW_REMOVE, SHOW_THUMBNAIL)
-from plupload.utils import split_resize_to
+                               SHOW_REMOVE, SHOW_THUMBNAIL, CONTROL_CODE_TTL, DEDUPLICATE, SERVER_RESIZE,
+                               COMPRESS, DOWNLOAD_ACCESS)
+from plupload.utils import split_resize_to, split_paths
 from plupload.forms import PluploadFormField
-from random import choice
+from plupload.fileinfo import PluploadFile
+from plupload import dedup, fileinfo, thumbnails
+from importlib import import_module
+from random import SystemRandom
 from types import StringType, IntType
 import os
 import datetime
 import re
 
+choice = SystemRandom().choice  # os.urandom based, forked workers don't share the random state
+
 
 """
 Usage example
@@ -26,12 +38,30 @@ In models:
         image3 = PluploadField("Picture 3", upload_to='my_upload_dir/', resize_to='640x480', resize_quality='85',
                                extensions=['jpg', 'jpeg', 'png', 'gif', 'tiff'],
                                max_file_size=10, show_remove=False, unique_names=False, upload_chmod='660',
-                               show_thumbnail=True)
+                               show_thumbnail=True, server_resize=True)
         # Django >= 1.5:
         image4 = PluploadField("Picture 4", allow_files/allow_folders=True/False, upload_to='my_upload_dir/',
                                resize_to='800', resize_quality='90')
         attachment = PluploadField("Some attachment", upload_to='my_upload_dir/', extensions=['rar', 'zip', 'pdf'])
                                    # no 'resize_to' 'resize_quality' for non image files
+        photos = PluploadField("Photos", upload_to='my_upload_dir/', max_files=100, show_thumbnail=True)
+                               # multi-file: a list of paths, stored one per line in a text column
+
+        objects = PluploadQuerySet.as_manager()
+
+    obj.attachment is the path of the file, obj.attachment_file a PluploadFile: its url, size, content type, checksum,
+    image dimensions (obj.photos_files is the list of PluploadFiles of a multi-file field). With PLUPLOAD_FILE_INFO
+    they are read from the DB; to read those of a whole list in one query:
+
+    for obj in MyModel.objects.prefetch_file_info('image1', 'attachment'):  # or prefetch_file_info(objects, ...)
+        print obj.image1_file.url, obj.image1_file.width, obj.attachment_file.size
+
+    Files not served publicly from MEDIA_URL are downloaded through the 'plupload_download' url, if the download_access
+    option of the field allows it (see plupload.download):
+
+    contract = PluploadField("Contract", upload_to='contracts/', download_access='plupload.download.can_change')
+
+    obj.contract_file.download_url  # or obj._meta.get_field('contract').download_url(obj)
 
 
 In forms:
@@ -45,6 +75,53 @@ In forms:
 """
 
 
+class PluploadFilesDescriptor(object):
+    """
+    The value of a multi-file PluploadField is always a list of paths, whatever it is set to (a list, or the paths one
+    per line, as stored in the DB)
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__[self.field.attname]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = split_paths(value)
+
+
+class PluploadFileDescriptor(object):
+    """
+    The <name>_file attribute of a PluploadField (<name>_files for multi-file fields): the PluploadFile of the value,
+    None if empty (a list for multi-file fields). Kept until the value changes
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = getattr(instance, self.field.attname)
+        cached = instance.__dict__.setdefault('_plupload_files', {}).get(self.field.attname)
+        if cached is None or cached[0] != value:
+            cached = (value, self.field.files(value, instance=instance))
+            instance.__dict__['_plupload_files'][self.field.attname] = cached
+        return cached[1]
+
+    def prefetched(self, instance, infos):
+        """
+        Sets the PluploadFiles of the instance, with the metadata in infos ({path: PluploadFileInfo}), the files
+        without metadata are read from disk when needed
+        """
+        value = getattr(instance, self.field.attname)
+        files = self.field.files(value, infos, instance)
+        instance.__dict__.setdefault('_plupload_files', {})[self.field.attname] = (value, files)
+
+
 class PluploadField(models.FilePathField):
     default_error_messages = {
         'invalid_choice': _(u'''%(value)s is not one of the available choices.
@@ -75,10 +152,37 @@ class PluploadField(models.FilePathField):
         self.upload_chmod = kwargs.pop('upload_chmod', UPLOAD_CHMOD)  # attempt chmod once file is uploaded
         self.show_remove = kwargs.pop('show_remove', SHOW_REMOVE)  # show the remove checkbox
         self.show_thumbnail = kwargs.pop('show_thumbnail', SHOW_THUMBNAIL)  # shows as thumbnail of the uploaded image
+        self.deduplicate = kwargs.pop('deduplicate', DEDUPLICATE)  # content addressed storage, see plupload.dedup
+        self.server_resize = kwargs.pop('server_resize', SERVER_RESIZE)  # resize_to enforced on the server too
+        self.max_files = kwargs.pop('max_files', 1)  # more than 1 (0 = no limit): multi-file, a list of paths
+        self.compress = kwargs.pop('compress', COMPRESS)  # extensions of the files gzipped by the browser
+        self.download_access = kwargs.pop('download_access', DOWNLOAD_ACCESS)  # who can download, see can_download
         super(PluploadField, self).__init__(
             verbose_name=verbose_name, name=name, path=path, match=match, recursive=recursive, allow_files=allow_files,
             allow_folders=allow_folders, **kwargs
         )
+        if self.multiple:
+            # a text column, max_length doesn't apply
+            self.validators = [v for v in self.validators if not isinstance(v, MaxLengthValidator)]
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(PluploadField, self).deconstruct()
+        # the options that differ from their defaults (the settings): migrations rebuild the field with them, max_files
+        # included (multi-file fields are text columns)
+        options = (
+            ('upload_to', UPLOAD_TO), ('extensions', EXTENSIONS), ('max_file_size', MAX_FILE_SIZE),
+            ('unique_names', UNIQUE_NAMES), ('upload_chmod', UPLOAD_CHMOD), ('show_remove', SHOW_REMOVE),
+            ('show_thumbnail', SHOW_THUMBNAIL), ('deduplicate', DEDUPLICATE), ('server_resize', SERVER_RESIZE),
+            ('max_files', 1), ('compress', COMPRESS), ('download_access', DOWNLOAD_ACCESS),
+        )
+        for option, default in options:
+            if getattr(self, option) != default:
+                kwargs[option] = getattr(self, option)
+        if self.resize_to is not None:
+            kwargs['resize_to'] = self.resize_to
+        if self.resize_quality != '':
+            kwargs['resize_quality'] = self.resize_quality
+        return name, path, args, kwargs
 
     def formfield(self, **kwargs):
         """
@@ -101,31 +205,226 @@ class PluploadField(models.FilePathField):
             'upload_chmod': self.upload_chmod,
             'show_remove': self.show_remove,
             'show_thumbnail': self.show_thumbnail,
+            'deduplicate': self.deduplicate,
+            'server_resize': self.server_resize,
+            'max_files': self.max_files,
+            'compress': self.compress,
         }
         defaults.update(kwargs)
         return super(PluploadField, self).formfield(**defaults)
 
+    @property
+    def multiple(self):
+        return self.max_files != 1
+
+    def get_internal_type(self):
+        return 'TextField' if self.multiple else super(PluploadField, self).get_internal_type()
+
+    def to_python(self, value):
+        if self.multiple:
+            return split_paths(value)
+        return super(PluploadField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        if self.multiple:
+            return '\n'.join(split_paths(value))
+        return super(PluploadField, self).get_prep_value(value)
+
+    def value_to_string(self, obj):
+        if self.multiple:
+            return self.get_prep_value(self._get_val_from_obj(obj))
+        return super(PluploadField, self).value_to_string(obj)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(PluploadField, self).contribute_to_class(cls, name, *args, **kwargs)
+        if self.multiple:
+            setattr(cls, self.attname, PluploadFilesDescriptor(self))
+        setattr(cls, self.file_attname, PluploadFileDescriptor(self))
+        if self.deduplicate or self.show_thumbnail:
+            signals.post_init.connect(self.remember_value, sender=cls, weak=False)
+            signals.post_save.connect(self.release_replaced, sender=cls, weak=False)
+
+    @property
+    def file_attname(self):
+        return '%s_%s' % (self.name, 'files' if self.multiple else 'file')
+
+    def files(self, value, infos=None, instance=None):
+        """
+        The PluploadFile (a list for multi-file fields) of value, with the metadata in infos ({path: PluploadFileInfo});
+        with the instance the field value belongs to, they have a download_url
+        """
+        def new_file(path, index=None):
+            plupload_file = PluploadFile(path, infos[path]) if infos and path in infos else PluploadFile(path)
+            if instance is not None:
+                plupload_file.owner = (self, instance, index)
+            return plupload_file
+        if self.multiple:
+            return [new_file(path, index) for index, path in enumerate(split_paths(value))]
+        return new_file(value) if value else None
+
+    def can_download(self, request, instance, path):
+        """
+        If the request can download the file at path of this field of instance, according to download_access: True, or
+        a function (request, instance, path), or its dotted path (see plupload.download)
+        """
+        access = self.download_access
+        if not access:
+            return False
+        if access is True:
+            return True
+        if isinstance(access, basestring):
+            module_name, function_name = access.rsplit('.', 1)
+            access = getattr(import_module(module_name), function_name)
+        return bool(access(request, instance, path))
+
+    def download_url(self, instance, index=None):
+        """
+        Url of the file of this field of instance (the index-th for multi-file fields) served by the download view,
+        None if the field can't be downloaded or instance isn't saved
+        """
+        if not self.download_access or instance.pk is None:
+            return None
+        kwargs = {
+            'model': '%s.%s' % (instance._meta.app_label, instance._meta.model_name),
+            'pk': force_unicode(instance.pk),
+            'field_name': self.name,
+        }
+        if self.multiple:
+            kwargs['index'] = index or 0
+        return reverse('plupload_download', kwargs=kwargs)
+
+    def remember_value(self, instance, **kwargs):
+        # from __dict__: a deferred field is not loaded (it can't be replaced without being set first)
+        if self.attname in instance.__dict__:
+            instance.__dict__.setdefault('_plupload_saved', {})[self.attname] = split_paths(
+                instance.__dict__[self.attname])
+
+    def release_replaced(self, instance, **kwargs):
+        """
+        Once the object is saved, if the file the field pointed to has been replaced or removed, removes its thumbnail
+        and, with deduplicating storage, the file itself, unless another value still refers to it (see
+        path_in_use): it is just a link to a blob, files with the same content are not affected (see
+        plupload.dedup.release)
+        """
+        if self.attname not in instance.__dict__:
+            return  # deferred, not changed
+        saved = instance.__dict__.setdefault('_plupload_saved', {})
+        current = split_paths(instance.__dict__[self.attname])
+        for previous in set(saved.get(self.attname) or []) - set(current):
+            thumbnails.invalidate(previous)
+            if (self.deduplicate and not path_in_use(previous) and
+                    dedup.release(os.path.join(MEDIA_ROOT, previous.lstrip('/')))):
+                fileinfo.forget(previous)
+        saved[self.attname] = current
+
+
+def path_in_use(path):
+    """
+    True if a PluploadField of any model still holds path, in a query per PluploadField
+    """
+    for model in apps.get_models():
+        for field in model._meta.fields:
+            if not isinstance(field, PluploadField):
+                continue
+            if not field.multiple:
+                if model._default_manager.filter(**{field.attname: path}).exists():
+                    return True
+                continue
+            # paths one per line: candidates containing it, then an exact match
+            values = model._default_manager.filter(**{'%s__contains' % field.attname: path}).values_list(
+                field.attname, flat=True)
+            if any(path in split_paths(value) for value in values):
+                return True
+    return False
+
+
+def prefetch_file_info(instances, *field_names):
+    """
+    Loads the metadata of the files of the PluploadFields field_names (all of them if none) of instances, in a query
+    per fileinfo.LOOKUP_BATCH files (see plupload.fileinfo): <name>_file of each instance is then ready. Returns
+    instances
+    """
+    instances = [instance for instance in instances if isinstance(instance, models.Model)]
+    descriptors = []
+    for model in set(type(instance) for instance in instances):
+        for field in model._meta.fields:
+            if isinstance(field, PluploadField) and (not field_names or field.name in field_names):
+                descriptors.append((model, getattr(model, field.file_attname)))
+    paths = []
+    for instance in instances:
+        for model, descriptor in descriptors:
+            if isinstance(instance, model):
+                paths.extend(split_paths(getattr(instance, descriptor.field.attname)))
+    infos = fileinfo.lookup(paths)
+    for instance in instances:
+        for model, descriptor in descriptors:
+            if isinstance(instance, model):
+                descriptor.prefetched(instance, infos)
+    return instances
+
+
+class PluploadQuerySet(models.QuerySet):
+    """
+    QuerySet with prefetch_file_info, for the managers of models with PluploadFields (PluploadQuerySet.as_manager())
+    """
+    _file_info_fields = None
+
+    def prefetch_file_info(self, *field_names):
+        """
+        The metadata of the files of the PluploadFields field_names (all of them if none) are loaded in bulk with the
+        objects, see plupload.models.prefetch_file_info
+        """
+        clone = self._clone()
+        clone._file_info_fields = field_names
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(PluploadQuerySet, self)._clone(*args, **kwargs)
+        clone._file_info_fields = self._file_info_fields
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(PluploadQuerySet, self)._fetch_all()
+        if fetched and self._file_info_fields is not None:
+            prefetch_file_info(self._result_cache, *self._file_info_fields)
+
+
+class PluploadFileInfo(models.Model):
+    """
+    Metadata of an uploaded file, see plupload.fileinfo
+    """
+    path = models.CharField(u"Path", max_length=255, unique=True)  # relative to MEDIA_ROOT
+    size = models.BigIntegerField(u"Size")
+    mtime = models.FloatField(u"Modification time")  # seconds since the epoch
+    content_type = models.CharField(u"Content type", max_length=100, blank=True)
+    checksum = models.CharField(u"Checksum", max_length=200, blank=True)  # '<algorithm>:<hex digest>'
+    width = models.PositiveIntegerField(u"Image width", blank=True, null=True)
+    height = models.PositiveIntegerField(u"Image height", blank=True, null=True)
+    date = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s' % self.path
+
 
 class PluploadControlCode(models.Model):
     upload_to = models.CharField(u"Upload path", max_length=100, blank=True, null=True)
-    code = models.CharField(u"Control code", max_length=100)
+    code = models.CharField(u"Control code", max_length=100, unique=True)
     upload_done = models.BooleanField(u"Upload done?", default=False)
-    date = models.DateTimeField(auto_now_add=True)
+    deduplicate = models.BooleanField(u"Deduplicating storage", default=False)
+    resize_width = models.PositiveIntegerField(u"Server resize width", blank=True, null=True)
+    resize_height = models.PositiveIntegerField(u"Server resize height", blank=True, null=True)
+    resize_quality = models.PositiveSmallIntegerField(u"Server resize quality", blank=True, null=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __unicode__(self):
         return u'%s' % (self.code)
 
-    def save(self, *args, **kwargs):
-        # removing control codes older that 24 hours
-        PluploadControlCode.objects.filter(date__lt=datetime.datetime.now() - datetime.timedelta(days=1)).delete()
-        super(PluploadControlCode, self).save(*args, **kwargs)
-
     def __init__(self, *args, **kwargs):
         super(PluploadControlCode, self).__init__(*args, **kwargs)
         if not self.code:
+            # 100 random characters, uniqueness is enforced by the unique index
             self.code = self.generate_control_code()
-            while PluploadControlCode.objects.filter(code=self.code):
-                self.code = self.generate_control_code()
 
     def generate_control_code(self):
         # better not using &, it is escaped to &amp;
@@ -133,5 +432,12 @@ class PluploadControlCode(models.Model):
             choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^*(-_=+)') for i in range(100)
         ])
 
+    @classmethod
+    def expired(cls):
+        """
+        Control codes older than PLUPLOAD_CONTROL_CODE_TTL, removed by the plupload_clearcodes management command
+        """
+        return cls.objects.filter(date__lt=timezone.now() - datetime.timedelta(seconds=CONTROL_CODE_TTL))
+
     class Meta:
         pass
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from plupload import staging, workers
+import os
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Server side resizing of uploaded images (PLUPLOAD_SERVER_RESIZE), enforcing the field's resize_to and resize_quality
+even when the client didn't resize (old browsers, API uploads).
+
+Images larger than resize_to are resized to fit in it, keeping their aspect ratio (as plupload does client side), and
+re-encoded at resize_quality, in a pool of processes once the upload is complete. Decoding is memory bounded: JPEGs are
+decoded in draft mode, straight at the smallest scale still larger than the target size, and Pillow's reducing_gap
+(where available) shrinks other images by integer factors before resampling.
+"""
+
+UNBOUNDED = 1000000  # px, for a missing resize_to dimension
+
+
+def resize_image(path, width, height, quality):
+    """
+    Resizes the image at path to fit in width x height, if it is larger, replacing it atomically (the new file is a
+    new inode: deduplicated blobs are not modified). Returns True if the image has been resized, False if it didn't
+    need it or the file is not an image
+    """
+    size = (int(width or UNBOUNDED), int(height or UNBOUNDED))
+    try:
+        image = Image.open(path)
+    except IOError:
+        return False  # not an image (or not one Pillow can read)
+    if image.size[0] <= size[0] and image.size[1] <= size[1]:
+        return False
+    image_format = image.format
+    image.draft(image.mode if image.mode in ('RGB', 'L') else 'RGB', size)
+    try:
+        image.thumbnail(size, Image.ANTIALIAS, reducing_gap=2.0)
+    except TypeError:
+        image.thumbnail(size, Image.ANTIALIAS)  # Pillow < 7, no reducing_gap
+    options = {}
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        options['quality'] = int(quality or 90)
+        options['optimize'] = True
+    elif image_format == 'PNG':
+        options['optimize'] = True
+    mode = os.stat(path).st_mode & 0777
+    fd, tmp_path = tempfile.mkstemp(prefix='.plupload.', dir=os.path.dirname(path))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            image.save(f, image_format, **options)
+        finally:
+            f.close()
+        os.chmod(tmp_path, mode)
+        staging.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def resize_then(path, width, height, quality, callback):
+    """
+    resize_image, then callback(path) if the image has been resized (its metadata recorded before are outdated)
+    """
+    if workers.call_in_process(resize_image, path, width, height, quality):
+        callback(path)
+
+
+def schedule(path, width, height, quality, callback=None):
+    """
+    Queues the resizing of the uploaded image at path in the process pool; callback(path), if given, is called by a
+    background thread once the image has been resized (not if it didn't need it). Returns False if images can't be
+    resized (Pillow not installed) or no size limit is set
+    """
+    if Image is None or not (width or height):
+        return False
+    if callback is None:
+        workers.run_in_process(resize_image, path, width, height, quality)
+    else:
+        workers.run_in_background(resize_then, path, width, height, quality, callback)
+    return True
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
 from plupload.utils import split_resize_to
+import os
+import tempfile
 
 """
 Some settings you might want to include in your project's settings file.
@@ -11,7 +13,117 @@ PLUPLOAD_UPLOAD_TO: path relative to MEDIA_ROOT, where files will be uploaded. G
 PLUPLOAD_MAX_FILE_SIZE: Mb, maximum allowed file size for upload. General setting, you can also use 'max_file_size'
 field attribute. Default None
 
-PLUPLOAD_CHUNK_SIZE: Mb, dimension of each chunk the file is split into during upload, default 1 Mb
+PLUPLOAD_CHUNK_SIZE: Mb, dimension of each chunk the file is split into during upload, default 1 Mb. With
+PLUPLOAD_ADAPTIVE_CHUNK_SIZE this is the size each user starts from, see plupload.chunking
+
+PLUPLOAD_ADAPTIVE_CHUNK_SIZE: if True the server recommends a chunk size to each user, measuring throughput and latency
+of the chunks received (see plupload.chunking), and the widget uses it for the next file. Default True
+
+PLUPLOAD_MIN_CHUNK_SIZE, PLUPLOAD_MAX_CHUNK_SIZE: Mb, bounds of the chunk size, chunk sizes sent by the clients out of
+them are refused; the fields can narrow them with their min_chunk_size and max_chunk_size options. Make sure the web
+server accepts request bodies of PLUPLOAD_MAX_CHUNK_SIZE (i.e. nginx client_max_body_size). Default 0.25 and 16
+
+PLUPLOAD_CHUNK_TIME: seconds, how long a chunk should take to upload, with PLUPLOAD_ADAPTIVE_CHUNK_SIZE. Default 2
+
+PLUPLOAD_STAGING_DIR: absolute path of the directory where chunks are assembled while a file is being uploaded. Put it
+on the same filesystem as MEDIA_ROOT (i.e. a directory under MEDIA_ROOT not served by the web server) so that a
+completed upload is moved to its final position with an atomic rename, instead of being copied. Default a 'plupload'
+directory in the system temp directory
+
+PLUPLOAD_STAGING_BACKEND: where the bookkeeping of uploads in progress (chunks received, finalize claim) is kept:
+'plupload.staging.FileStagingBackend' in files next to the staging file, under POSIX locks, or
+'plupload.staging.CacheStagingBackend' in the PLUPLOAD_STAGING_CACHE Django cache (memcached or redis). To spread the
+chunks of an upload across several nodes, PLUPLOAD_STAGING_DIR must be on a filesystem they share, and so must the
+cache. Default 'plupload.staging.FileStagingBackend'
+
+PLUPLOAD_STAGING_CACHE: the Django cache (alias in CACHES) used by CacheStagingBackend. Default 'default'
+
+PLUPLOAD_STAGING_MAX_AGE: seconds, the staging files of uploads that haven't received chunks for this long are removed
+as abandoned, by the `plupload_clearstaging` management command or by the sweeper thread. Default
+PLUPLOAD_CONTROL_CODE_TTL, once they can't be resumed anymore
+
+PLUPLOAD_STAGING_SWEEP_INTERVAL: seconds, if set each process serving uploads sweeps the staging area this often in a
+background thread, removing abandoned uploads; 0 to rely on the `plupload_clearstaging` management command instead.
+Default 0
+
+PLUPLOAD_MIN_FREE_SPACE: Mb, new uploads are refused (with a 'retry later' error) if they would leave less than this
+free on the filesystem of the staging area. Default 0
+
+PLUPLOAD_STAGING_QUOTA: Mb, new uploads are refused (with a 'retry later' error) if the uploads in progress would take
+more than this in the staging area. Default None = no quota
+
+PLUPLOAD_MULTIPART: if False, the widget sends each chunk as the raw body of the request (application/octet-stream,
+parameters in the query string) to the 'plupload_raw' url, which streams it to disk without multipart parsing: less CPU
+per chunk. Requires the html5 runtime. Default True
+
+PLUPLOAD_SIGNED_CONTROL_CODES: if True, the control code tying each upload to its widget is a signed, expiring token
+carrying upload_to and the field limits, verified without any DB access; if False a PluploadControlCode row is saved
+for each widget rendered and looked up for each chunk uploaded. Default False
+
+PLUPLOAD_CONTROL_CODE_TTL: seconds, how long a control code stays valid; expired DB control codes are removed by the
+`plupload_clearcodes` management command, which you should run periodically. Default 86400 (24 hours)
+
+PLUPLOAD_TRACK_UPLOADS: with signed control codes, save a PluploadControlCode row (upload_done=True) for each completed
+upload, if you need to keep track of them. Default False
+
+PLUPLOAD_HASH_ALGORITHMS: digests computed for each uploaded file while its chunks are written, returned in the upload
+response ('checksums') and checked against the 'checksum' parameter if the client sends one
+('<algorithm>:<hex digest>'). Any hashlib algorithm, or 'xxh64'/'xxh32' if the xxhash package is installed.
+Default ('sha256',)
+
+PLUPLOAD_DEDUPLICATE: if True, uploaded files are stored once per content (by sha256 digest, which must be in
+PLUPLOAD_HASH_ALGORITHMS) in PLUPLOAD_BLOB_DIR, the uploaded file being a hard link to it: uploading the same file again
+costs no disk space. General setting, you can also use 'deduplicate' field attribute. Default False
+
+PLUPLOAD_BLOB_DIR: absolute path of the deduplicating storage, on the same filesystem as MEDIA_ROOT and not served by
+the web server. Unreferenced blobs are removed by the plupload_clearblobs management command. Default a
+'.plupload_blobs' directory in MEDIA_ROOT
+
+PLUPLOAD_IO_THREADS: when the upload view is served by green thread workers (gevent or eventlet, i.e. gunicorn -k
+gevent), disk writes are done by a pool of this many OS threads, so slow disks don't stall the other requests of the
+worker; 0 to write from the request greenlet. Default 10
+
+PLUPLOAD_METRICS: if True, upload metrics (bytes, chunks and files uploaded, failures, time spent in each phase of the
+upload requests) are served in the Prometheus text format at the 'plupload_metrics' url (metrics/ under plupload's
+urls), for the process serving the request. Don't expose it publicly. Default False
+
+PLUPLOAD_BACKGROUND_FINALIZE: if True, once the last chunk of a file is received the upload is finalized (checksums,
+move to its final position, chmod, ...) by the background threads, the response saying it's 'processing': the widget
+polls the 'plupload_status' url until it's done. For large files behind a proxy with a short timeout. Default False
+
+PLUPLOAD_MAX_CONCURRENT_UPLOADS: how many files each user (authenticated user, or session, or IP address) can upload
+at the same time, further uploads are rejected until the others are complete; 0 for no limit. Default 0
+
+PLUPLOAD_MAX_CONCURRENT_REQUESTS: how many chunk requests each user can have in flight at the same time, further
+requests are refused (status 429, the widget retries them later) before their body is read; 0 for no limit. Default 0
+
+PLUPLOAD_RATE_LIMIT: Mb/s, upload bandwidth of each user: chunk requests over it are refused (status 429, with the
+time to wait before retrying) before their body is read. None for no limit. Default None
+
+PLUPLOAD_RATE_LIMIT_BURST: Mb, how much each user can upload at once, before PLUPLOAD_RATE_LIMIT applies. Default
+one second worth of PLUPLOAD_RATE_LIMIT (at least a chunk)
+
+PLUPLOAD_MAX_IN_FLIGHT: Mb, total size of the chunk requests in flight, of all users: further requests are refused
+(status 429, the widget retries them later) before their body is read. None for no limit. Default None
+
+PLUPLOAD_ADMISSION_CACHE: the Django cache (alias in CACHES) keeping the state of the limits above: shared by all
+the processes with memcached or redis, per process with the local memory cache. Default PLUPLOAD_STAGING_CACHE
+
+PLUPLOAD_FILE_INFO: if True size, modification time, content type, checksum and image dimensions of the uploaded files
+are saved in the DB (PluploadFileInfo) and read from there, in bulk, by the <name>_file attribute of PluploadFields,
+the widget and the form field, instead of hitting the filesystem (see plupload.fileinfo). Run migrate to create its
+table before turning it on. Default False
+
+PLUPLOAD_DOWNLOAD_ACCESS: who can download the files of the PluploadFields through the 'plupload_download' url (see
+plupload.download), for the fields without a download_access option: a function (request, instance, path) returning
+True if the request can download the file at path of the field of instance, or its dotted path (i.e.
+'plupload.download.can_change'), or True for everyone. Default None = fields can't be downloaded through the view
+
+PLUPLOAD_SENDFILE: how the download view hands the file to the web server, instead of streaming it from Python:
+'x-accel-redirect' (nginx) or 'x-sendfile' (Apache mod_xsendfile, lighttpd). Default None = served by Django
+
+PLUPLOAD_SENDFILE_URL: with 'x-accel-redirect', the url of the nginx internal location serving MEDIA_ROOT.
+Default '/protected/'
 
 PLUPLOAD_UNIQUE_NAMES: if True unique random names will be used for uploaded files; if False the original file name
 will be kept, but if a file with the same name exists it will be overwritten without advice. General setting, you can
@@ -19,8 +131,9 @@ also use 'unique_names' field attribute. Default True
 
 PLUPLOAD_UPLOAD_CHMOD: tries to change file permissions to the uploaded file, after the file has been uploaded, must be
 an integer or a string (if it has leading zeros) representing the permissions; if set i.e. to '640', tries to chmod
-uploaded file to 0640 after upload is done. General setting, you can also use 'upload_chmod' field attribute.
-Default None
+uploaded file to 0640 after upload is done. Not applied to deduplicated files (PLUPLOAD_DEDUPLICATE), links to a blob
+shared with other uploads, which keep the mode of the blob. General setting, you can also use 'upload_chmod' field
+attribute. Default None
 
 PLUPLOAD_RESIZE_TO: image size, if the uploaded image is larger that this value, a resize will be tried. General
 setting, you can also use 'resize_to' field attribute
@@ -33,6 +146,15 @@ setting, you can also use 'resize_to' field attribute
 PLUPLOAD_RESIZE_QUALITY: image quality, where applies. General setting, you can also use 'unique_names' field attribute.
 Default 90
 
+PLUPLOAD_SERVER_RESIZE: if True, once uploaded, images larger than resize_to are resized on the server too (keeping
+their aspect ratio) and re-encoded at resize_quality, so the field limits hold even when the client couldn't resize.
+Requires Pillow. General setting, you can also use 'server_resize' field attribute. Default False
+
+PLUPLOAD_COMPRESS: a list of file extensions (i.e. ['csv', 'log', 'txt']) of the files the widget gzips in the browser,
+chunk by chunk, before sending them: the server decompresses each chunk while writing it. For highly compressible files
+on slow uplinks; needs a browser with CompressionStream, the others send the files uncompressed. General setting, you
+can also use 'compress' field attribute. Default None
+
 PLUPLOAD_EXTENSIONS: a list of valid file extensions for upload, case insensitive, if you haven't defined an
 'extensions' attribute on field definition -> well, plupload extensions ARE case sensitive: but if you write
 'jpg' here, 'jpg', 'JPG' and 'Jpg' will be added as valid file extensions.. General setting, you can also use
@@ -50,15 +172,28 @@ PLUPLOAD_THUMBNAIL_WIDTH: uploaded thumbnail width. Default 80 (px)
 
 PLUPLOAD_THUMBNAIL_HEIGHT: uploaded thumbnail height. Default 80 (px)
 
+PLUPLOAD_THUMBNAIL_DIR: where thumbnails are cached, relative to MEDIA_ROOT. Thumbnails are generated in the background
+once the upload is complete, if Pillow is installed. Default 'plupload_thumbnails'
+
+PLUPLOAD_BACKGROUND_THREADS: number of threads doing background work, like generating thumbnails: a pool of their own,
+apart from the PLUPLOAD_IO_THREADS under gevent or eventlet. Default 2
+
+PLUPLOAD_PROCESSES: number of worker processes doing CPU bound background work, like resizing images on the server; 0
+to use the background threads instead. Default 2
+
+PLUPLOAD_LAZY_LOAD: if True {% plupload_head_init %} adds just a small loader to the page, which loads the plupload
+scripts and styles once a widget is initialized: pages without widgets don't load them. If False they are all in the
+head. Default True
+
 PLUPLOAD_JQUERY_URL: set a default jquery version to load in case jquery is not present at the moment plupload is being
-loaded. Default "https://ajax.googleapis.com/ajax/libs/jquery/1.10.3/jquery.min.js") # set a default jquery version to
-load in case jquery is not present at the moment plupload is being loaded
+loaded: an absolute url, or the path of a static file to self-host it. Default
+"https://ajax.googleapis.com/ajax/libs/jquery/1.10.3/jquery.min.js"
 
 PLUPLOAD_JQUERY_UI_URL: same as above for jquery-ui.
-Default "http://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/jquery-ui.min.js")
+Default "https://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/jquery-ui.min.js"
 
 PLUPLOAD_JQUERY_UI_CSS_URL: same as above for jquery-ui css; indicating a theme here you can change the look of the
-plupload js box. Default "http://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/themes/smoothness/jquery-ui.min.css")
+plupload js box. Default "https://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/themes/smoothness/jquery-ui.min.css"
 
 """
 
@@ -70,6 +205,37 @@ STATIC_URL = getattr(settings, 'STATIC_URL', '')
 
 MAX_FILE_SIZE = getattr(settings, 'PLUPLOAD_MAX_FILE_SIZE', None)  # Mb
 CHUNK_SIZE = getattr(settings, 'PLUPLOAD_CHUNK_SIZE', 1)  # Mb
+ADAPTIVE_CHUNK_SIZE = getattr(settings, 'PLUPLOAD_ADAPTIVE_CHUNK_SIZE', True)
+MIN_CHUNK_SIZE = getattr(settings, 'PLUPLOAD_MIN_CHUNK_SIZE', 0.25)  # Mb
+MAX_CHUNK_SIZE = getattr(settings, 'PLUPLOAD_MAX_CHUNK_SIZE', 16)  # Mb
+CHUNK_TIME = getattr(settings, 'PLUPLOAD_CHUNK_TIME', 2)  # seconds
+STAGING_DIR = getattr(settings, 'PLUPLOAD_STAGING_DIR', '') or os.path.join(tempfile.gettempdir(), 'plupload')
+MULTIPART = getattr(settings, 'PLUPLOAD_MULTIPART', True)
+SIGNED_CONTROL_CODES = getattr(settings, 'PLUPLOAD_SIGNED_CONTROL_CODES', False)
+CONTROL_CODE_TTL = getattr(settings, 'PLUPLOAD_CONTROL_CODE_TTL', 86400)  # seconds
+STAGING_BACKEND = getattr(settings, 'PLUPLOAD_STAGING_BACKEND', 'plupload.staging.FileStagingBackend')
+STAGING_CACHE = getattr(settings, 'PLUPLOAD_STAGING_CACHE', 'default')
+STAGING_MAX_AGE = getattr(settings, 'PLUPLOAD_STAGING_MAX_AGE', CONTROL_CODE_TTL)  # seconds
+STAGING_SWEEP_INTERVAL = getattr(settings, 'PLUPLOAD_STAGING_SWEEP_INTERVAL', 0)  # seconds
+MIN_FREE_SPACE = getattr(settings, 'PLUPLOAD_MIN_FREE_SPACE', 0)  # Mb
+STAGING_QUOTA = getattr(settings, 'PLUPLOAD_STAGING_QUOTA', None)  # Mb
+TRACK_UPLOADS = getattr(settings, 'PLUPLOAD_TRACK_UPLOADS', False)
+HASH_ALGORITHMS = tuple(getattr(settings, 'PLUPLOAD_HASH_ALGORITHMS', ('sha256',)))
+DEDUPLICATE = getattr(settings, 'PLUPLOAD_DEDUPLICATE', False)
+BLOB_DIR = getattr(settings, 'PLUPLOAD_BLOB_DIR', '') or os.path.join(MEDIA_ROOT, '.plupload_blobs')
+IO_THREADS = getattr(settings, 'PLUPLOAD_IO_THREADS', 10)
+METRICS = getattr(settings, 'PLUPLOAD_METRICS', False)
+BACKGROUND_FINALIZE = getattr(settings, 'PLUPLOAD_BACKGROUND_FINALIZE', False)
+MAX_CONCURRENT_UPLOADS = getattr(settings, 'PLUPLOAD_MAX_CONCURRENT_UPLOADS', 0)
+MAX_CONCURRENT_REQUESTS = getattr(settings, 'PLUPLOAD_MAX_CONCURRENT_REQUESTS', 0)
+RATE_LIMIT = getattr(settings, 'PLUPLOAD_RATE_LIMIT', None)  # Mb/s
+RATE_LIMIT_BURST = getattr(settings, 'PLUPLOAD_RATE_LIMIT_BURST', None)  # Mb
+MAX_IN_FLIGHT = getattr(settings, 'PLUPLOAD_MAX_IN_FLIGHT', None)  # Mb
+ADMISSION_CACHE = getattr(settings, 'PLUPLOAD_ADMISSION_CACHE', STAGING_CACHE)
+FILE_INFO = getattr(settings, 'PLUPLOAD_FILE_INFO', False)
+DOWNLOAD_ACCESS = getattr(settings, 'PLUPLOAD_DOWNLOAD_ACCESS', None)
+SENDFILE = getattr(settings, 'PLUPLOAD_SENDFILE', None)
+SENDFILE_URL = getattr(settings, 'PLUPLOAD_SENDFILE_URL', '/protected/')
 UNIQUE_NAMES = getattr(settings, 'PLUPLOAD_UNIQUE_NAMES', True)
 UPLOAD_TO = getattr(settings, 'PLUPLOAD_UPLOAD_TO', '').lstrip('/')  # relative to MEDIA_ROOT
 UPLOAD_CHMOD = getattr(settings, 'PLUPLOAD_UPLOAD_CHMOD', None)
@@ -77,22 +243,28 @@ UPLOAD_CHMOD = getattr(settings, 'PLUPLOAD_UPLOAD_CHMOD', None)
 RESIZE_TO = getattr(settings, 'PLUPLOAD_RESIZE_TO', '')
 RESIZE_WIDTH, RESIZE_HEIGHT = split_resize_to(RESIZE_TO)
 RESIZE_QUALITY = getattr(settings, 'PLUPLOAD_RESIZE_QUALITY', 90)  # %
+SERVER_RESIZE = getattr(settings, 'PLUPLOAD_SERVER_RESIZE', False)
 
 EXTENSIONS = getattr(settings, 'PLUPLOAD_EXTENSIONS', None)
+COMPRESS = getattr(settings, 'PLUPLOAD_COMPRESS', None)
 
 AUTO_START = getattr(settings, 'PLUPLOAD_AUTO_START', True)
 SHOW_REMOVE = getattr(settings, 'PLUPLOAD_SHOW_REMOVE', True)
 SHOW_THUMBNAIL = getattr(settings, 'PLUPLOAD_SHOW_THUMBNAIL', False)
 THUMBNAIL_WIDTH = getattr(settings, 'PLUPLOAD_THUMBNAIL_WIDTH', 80)  # px
 THUMBNAIL_HEIGHT = getattr(settings, 'PLUPLOAD_THUMBNAIL_HEIGHT', 80)  # px
+THUMBNAIL_DIR = getattr(settings, 'PLUPLOAD_THUMBNAIL_DIR', 'plupload_thumbnails').strip('/')  # relative to MEDIA_ROOT
+BACKGROUND_THREADS = getattr(settings, 'PLUPLOAD_BACKGROUND_THREADS', 2)
+PROCESSES = getattr(settings, 'PLUPLOAD_PROCESSES', 2)
 
-# JQUERY URLS
+# ASSETS
+LAZY_LOAD = getattr(settings, 'PLUPLOAD_LAZY_LOAD', True)
 JQUERY_URL = getattr(settings,
                      'PLUPLOAD_JQUERY_URL',
                      "https://ajax.googleapis.com/ajax/libs/jquery/1.10.3/jquery.min.js")
 JQUERY_UI_URL = getattr(settings,
                         'PLUPLOAD_JQUERY_UI_URL',
-                        "http://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/jquery-ui.min.js")
+                        "https://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/jquery-ui.min.js")
 JQUERY_UI_CSS_URL = getattr(settings,
                             'PLUPLOAD_JQUERY_UI_CSS_URL',
-                            "http://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/themes/smoothness/jquery-ui.min.css")
+                            "https://ajax.googleapis.com/ajax/libs/jqueryui/1.10.3/themes/smoothness/jquery-ui.min.css")
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+
+"""
+Signals sent by the upload view (sender is the view function), timings being the phases of the request so far, in
+seconds (see plupload.metrics).
+
+chunk_received: a chunk has been stored; size in bytes, chunk/chunks its position.
+upload_complete: all the chunks have been received and the file moved to path; size in bytes.
+upload_failed: the request failed with error (the message sent back to the widget).
+"""
+
+chunk_received = Signal(providing_args=['request', 'chunk', 'chunks', 'size', 'timings'])
+upload_complete = Signal(providing_args=['request', 'path', 'size', 'timings'])
+upload_failed = Signal(providing_args=['request', 'error', 'timings'])
@@ -15,6 +15,7 @@ rules = [
             "upload_to": ["upload_to", {'default': None}],
             "resize_to": ["resize_to", {'default': None}],
             "resize_quality": ["resize_quality", {'default': None}],
+            "max_files": ["max_files", {'default': 1}],
         },
     ),
 ]
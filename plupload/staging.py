@@ -0,0 +1,704 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import json
+from importlib import import_module
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from django.utils.encoding import force_unicode
+from plupload.settings import (STAGING_DIR, CHUNK_SIZE, STAGING_MAX_AGE, STAGING_SWEEP_INTERVAL, STAGING_BACKEND,
+                               STAGING_CACHE)
+from plupload import hashing, metrics, workers
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    get_cache = caches.__getitem__
+
+
+"""
+Staging area for chunked uploads.
+
+Each upload is keyed by its control code plus the plupload file id (see upload_key), so several files can be uploaded
+side by side, even from the same browser session. Chunks are written in place, at their own offset, into a staging
+file preallocated to the total size of the upload: they can arrive out of order and several chunks of the same file can
+be sent at once. Alongside the staging file, a chunk map keeps track of the chunks received so far: it is used to resume
+interrupted uploads, sending just the missing chunks (see chunk_status).
+Once complete, the staging file is renamed to its final position (see finalize).
+
+The staging files are shared by all the processes, and by all the nodes if STAGING_DIR is on a shared filesystem, so
+the chunks of an upload can be served by any of them: no sticky sessions. The bookkeeping (chunk map and finalize
+claim) is kept by the staging backend, PLUPLOAD_STAGING_BACKEND: in files next to the staging file
+(FileStagingBackend) or in the Django cache (CacheStagingBackend).
+"""
+
+O_BINARY = getattr(os, 'O_BINARY', 0)  # windows only
+
+replace = getattr(os, 'replace', os.rename)  # os.replace on python >= 3.3, os.rename already replaces on posix
+
+PART_SUFFIX = '.part'  # the staging file
+MAP_SUFFIX = '.map'  # chunk map, a bitmap of the chunks received
+DONE_SUFFIX = '.done'  # created by the request finalizing the upload
+RESULT_SUFFIX = '.result'  # result of the upload finalized in the background, JSON
+SUFFIXES = (PART_SUFFIX, MAP_SUFFIX, DONE_SUFFIX, RESULT_SUFFIX)
+
+MAP_HEADER = struct.Struct('>QI')  # chunk size, number of chunks
+
+OWNERS_DIR = os.path.join(STAGING_DIR, 'owners')  # uploads in progress of each user, see plupload.admission
+
+
+def upload_key(control_code, file_id):
+    """
+    Returns the key identifying an upload in the staging area, a hash of the control code and the plupload file id
+    """
+    return hashlib.sha1((u'%s:%s' % (control_code, file_id)).encode('utf-8')).hexdigest()
+
+
+def get_chunk_position(params):
+    """
+    Returns (chunk, chunks, chunk_size, offset, total_size) for the chunk being uploaded, given the request parameters
+    (a dict-like object). Plupload sends either 'offset' and 'total' (send_chunk_number: false, the way widget.html
+    does) or 'chunk' and 'chunks', in which case the offset is chunk * chunk size; total_size is None if unknown.
+    The chunk size is the 'chunk_size' parameter (see plupload.chunking), PLUPLOAD_CHUNK_SIZE if missing. Raises
+    ValueError on invalid parameters
+    """
+    from plupload.chunking import check_chunk_size
+    if params.get('chunk_size'):
+        chunk_size = int(params['chunk_size'])
+        check_chunk_size(chunk_size)
+    else:
+        chunk_size = int(float(CHUNK_SIZE or 0) * 1048576)  # bytes, 0 = no chunks
+    total_size = int(params.get('total', 0)) or None
+    if 'offset' in params:
+        offset = int(params['offset'])
+        if offset and (chunk_size <= 0 or offset % chunk_size):
+            raise ValueError("offset is not a multiple of the chunk size")
+        chunk = offset // chunk_size if offset else 0
+        chunks = -(-total_size // chunk_size) if total_size and chunk_size > 0 else 1
+    else:
+        chunk = int(params.get('chunk', 0))
+        chunks = int(params.get('chunks', 0))
+        if chunk and chunk_size <= 0:
+            raise ValueError("chunk size unknown")
+        offset = chunk * chunk_size
+    chunks = max(chunks, 1)  # not a chunked upload
+    if chunk < 0 or chunk >= chunks or offset < 0:
+        raise ValueError("chunk out of range")
+    return chunk, chunks, chunk_size, offset, total_size
+
+
+def staging_path(key, suffix=PART_SUFFIX):
+    return os.path.join(STAGING_DIR, key + suffix)
+
+
+def make_staging_dir():
+    try:
+        os.makedirs(STAGING_DIR, 0700)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+_fallocate = False  # not looked up yet
+
+
+def _libc_fallocate():
+    """
+    posix_fallocate of the C library through ctypes, for pythons without it in os (python 2). posix_fallocate64 of
+    glibc, for 64 bit offsets on 32 bit systems too
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None)
+    except (ImportError, OSError, TypeError):
+        return None
+    c_fallocate = getattr(libc, 'posix_fallocate64', None)
+    if c_fallocate is None:
+        return None
+    c_fallocate.restype = ctypes.c_int
+    c_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+    def fallocate(fd, offset, length):
+        err = c_fallocate(fd, offset, length)  # returns the error number, errno isn't set
+        if err:
+            raise OSError(err, os.strerror(err))
+    return fallocate
+
+
+def fallocate_function():
+    """
+    posix_fallocate(fd, offset, length) of os (python >= 3.3), or of the C library through ctypes. None if unavailable
+    """
+    global _fallocate
+    if _fallocate is False:
+        _fallocate = getattr(os, 'posix_fallocate', None) or _libc_fallocate()
+    return _fallocate
+
+
+def preallocate(f, size):
+    """
+    Makes sure the file is at least size bytes long, so chunks can be written at any offset. Reserves the disk blocks at
+    once with posix_fallocate where available (see fallocate_function), otherwise extends the file sparsely (see
+    unallocated)
+    """
+    if os.fstat(f.fileno()).st_size >= size:
+        return
+    fallocate = fallocate_function()
+    if fallocate is not None:
+        try:
+            fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # not supported by the filesystem
+    f.truncate(size)
+
+
+def open_staging_file(key, total_size=None):
+    """
+    Opens the staging file of the upload for writing, creating it if needed: it is never truncated, since other chunks
+    might have been written already
+    """
+    make_staging_dir()
+    fd = os.open(staging_path(key), os.O_RDWR | os.O_CREAT | O_BINARY, 0600)
+    f = os.fdopen(fd, 'r+b')
+    if total_size:
+        try:
+            preallocate(f, total_size)
+        except (IOError, OSError):
+            f.close()
+            raise
+    return f
+
+
+def write_chunk(f, offset, content, hasher=None):
+    """
+    Writes content (an iterable of strings, i.e. UploadedFile.chunks()) to the staging file starting at offset, feeding
+    it to hasher too, if any. Returns the number of bytes written. Reading content may wait for the client, writing
+    to disk is done by workers.run_blocking
+    """
+    def write(data):
+        f.write(data)
+        if hasher is not None:
+            hasher.update(data)
+
+    f.seek(offset)
+    written = 0
+    for data in content:
+        with metrics.phase('write'):
+            workers.run_blocking(write, data)
+        written += len(data)
+    return written
+
+
+def store_chunk(key, offset, total_size, content):
+    """
+    Writes a chunk of the upload to its staging file, hashing it on the way if it is the next one to hash (see
+    plupload.hashing). Returns the number of bytes written, raises IOError or OSError
+    """
+    with metrics.phase('open'):
+        f = workers.run_blocking(open_staging_file, key, total_size)  # preallocating might take a while
+    hasher = hashing.claim(key, offset)
+    try:
+        written = write_chunk(f, offset, content, hasher)
+    except Exception:
+        hashing.release(key, hasher, 0, ok=False)
+        f.close()
+        raise
+    f.close()
+    hashing.release(key, hasher, written)
+    return written
+
+
+def lock(fd, shared=False):
+    """
+    Locks the whole file (released when fd is closed): POSIX record locks, working on network filesystems too. No
+    locking where fcntl is not available
+    """
+    if fcntl is not None:
+        fcntl.lockf(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+
+def read_all(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = b''
+    while True:
+        block = os.read(fd, 65536)
+        if not block:
+            return data
+        data += block
+
+
+def unpack_chunk_map(data):
+    """
+    Returns (chunk_size, chunks, bitmap) from the content of a chunk map file, None if it is empty or corrupted
+    """
+    if len(data) < MAP_HEADER.size:
+        return None
+    chunk_size, chunks = MAP_HEADER.unpack(data[:MAP_HEADER.size])
+    bitmap = bytearray(data[MAP_HEADER.size:])
+    if len(bitmap) < (chunks + 7) // 8:
+        return None
+    return chunk_size, chunks, bitmap
+
+
+def count_received(bitmap, chunks):
+    return sum(1 for chunk in xrange(chunks) if bitmap[chunk >> 3] & (1 << (chunk & 7)))
+
+
+class FileStagingBackend(object):
+    """
+    Keeps the bookkeeping of uploads in files next to the staging file: the chunk map (a header, chunk size and number
+    of chunks, followed by a bitmap, one bit per chunk received) updated under POSIX record locks, and the finalize
+    claim, created with O_EXCL. Both work on a shared filesystem (NFS) mounted by all the nodes serving uploads
+    """
+
+    def mark_chunk_received(self, key, chunk, chunks, chunk_size):
+        make_staging_dir()
+        fd = os.open(staging_path(key, MAP_SUFFIX), os.O_RDWR | os.O_CREAT | O_BINARY, 0600)
+        try:
+            lock(fd)
+            chunk_map = unpack_chunk_map(read_all(fd))
+            if chunk_map is None or chunk_map[:2] != (chunk_size, chunks):
+                bitmap = bytearray((chunks + 7) // 8)  # new upload, or chunking changed: starting over
+            else:
+                bitmap = chunk_map[2]
+            bitmap[chunk >> 3] |= 1 << (chunk & 7)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, MAP_HEADER.pack(chunk_size, chunks) + bytes(bitmap))
+        finally:
+            os.close(fd)
+        return count_received(bitmap, chunks) >= chunks
+
+    def chunk_status(self, key):
+        try:
+            fd = os.open(staging_path(key, MAP_SUFFIX), os.O_RDONLY | O_BINARY)
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            lock(fd, shared=True)
+            chunk_map = unpack_chunk_map(read_all(fd))
+        finally:
+            os.close(fd)
+        if chunk_map is None:
+            return None
+        chunk_size, chunks, bitmap = chunk_map
+        return chunk_size, chunks, [chunk for chunk in xrange(chunks) if not bitmap[chunk >> 3] & (1 << (chunk & 7))]
+
+    def claim_finalize(self, key):
+        try:
+            fd = os.open(staging_path(key, DONE_SUFFIX), os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_BINARY, 0600)
+        except OSError, err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        os.close(fd)
+        return True
+
+    def discard(self, key):
+        for suffix in (MAP_SUFFIX, DONE_SUFFIX):
+            try:
+                os.remove(staging_path(key, suffix))
+            except OSError:
+                pass
+
+    def set_result(self, key, data):
+        make_staging_dir()
+        fd, tmp_path = tempfile.mkstemp(prefix='.result.', dir=STAGING_DIR)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        replace(tmp_path, staging_path(key, RESULT_SUFFIX))
+
+    def get_result(self, key):
+        try:
+            with open(staging_path(key, RESULT_SUFFIX), 'rb') as f:
+                return f.read()
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+
+    def discard_result(self, key):
+        try:
+            os.remove(staging_path(key, RESULT_SUFFIX))
+        except OSError:
+            pass
+
+
+class CacheStagingBackend(object):
+    """
+    Keeps the bookkeeping of uploads in the Django cache PLUPLOAD_STAGING_CACHE (memcached or redis, shared by all the
+    nodes; not the local memory cache): a key per chunk received, added atomically, and a counter of the chunks received
+    (each chunk counted once, by the request adding its key); the finalize claim is an atomic add. Entries expire
+    after PLUPLOAD_STAGING_MAX_AGE seconds, like the abandoned staging files. The staging files themselves still have
+    to be on a filesystem shared by the nodes
+    """
+
+    def __init__(self):
+        self.timeout = STAGING_MAX_AGE
+
+    @property
+    def cache(self):
+        return get_cache(STAGING_CACHE)
+
+    def prefix(self, key):
+        return 'plupload:%s' % key
+
+    def mark_chunk_received(self, key, chunk, chunks, chunk_size):
+        cache = self.cache
+        prefix = '%s:%s:%s' % (self.prefix(key), chunk_size, chunks)  # chunking changed: starting over
+        cache.set('%s:m' % self.prefix(key), (chunk_size, chunks), self.timeout)
+        if cache.add('%s:%s' % (prefix, chunk), 1, self.timeout):
+            cache.add('%s:n' % prefix, 0, self.timeout)
+            try:
+                return cache.incr('%s:n' % prefix) >= chunks
+            except ValueError:
+                pass  # the counter expired in between
+        # a chunk sent again (the request of its first copy might have died before counting it): counting the chunk keys
+        return len(cache.get_many(['%s:%s' % (prefix, i) for i in xrange(chunks)])) >= chunks
+
+    def chunk_status(self, key):
+        cache = self.cache
+        chunk_map = cache.get('%s:m' % self.prefix(key))
+        if chunk_map is None:
+            return None
+        chunk_size, chunks = chunk_map
+        prefix = '%s:%s:%s' % (self.prefix(key), chunk_size, chunks)
+        received = cache.get_many(['%s:%s' % (prefix, i) for i in xrange(chunks)])
+        return chunk_size, chunks, [i for i in xrange(chunks) if '%s:%s' % (prefix, i) not in received]
+
+    def claim_finalize(self, key):
+        return self.cache.add('%s:done' % self.prefix(key), 1, self.timeout)
+
+    def discard(self, key):
+        cache = self.cache
+        chunk_map = cache.get('%s:m' % self.prefix(key))
+        keys = ['%s:m' % self.prefix(key)]  # the finalize claim stays until it expires: the upload is over
+        if chunk_map is not None:
+            prefix = '%s:%s:%s' % ((self.prefix(key),) + tuple(chunk_map))
+            keys += ['%s:n' % prefix] + ['%s:%s' % (prefix, i) for i in xrange(chunk_map[1])]
+        cache.delete_many(keys)
+
+    def set_result(self, key, data):
+        self.cache.set('%s:result' % self.prefix(key), data, self.timeout)
+
+    def get_result(self, key):
+        return self.cache.get('%s:result' % self.prefix(key))
+
+    def discard_result(self, key):
+        self.cache.delete('%s:result' % self.prefix(key))
+
+
+_backend = []
+
+
+def get_backend():
+    """
+    The staging backend, PLUPLOAD_STAGING_BACKEND, instantiated once
+    """
+    if not _backend:
+        module_name, class_name = STAGING_BACKEND.rsplit('.', 1)
+        _backend.append(getattr(import_module(module_name), class_name)())
+    return _backend[0]
+
+
+def mark_chunk_received(key, chunk, chunks, chunk_size):
+    """
+    Marks chunk as received, returns True if all the chunks of the upload have been received
+    """
+    return get_backend().mark_chunk_received(key, chunk, chunks, chunk_size)
+
+
+def chunk_status(key):
+    """
+    Returns (chunk_size, chunks, missing) for the upload, missing being the list of the indexes of the chunks not
+    received yet; None if nothing has been received for this upload
+    """
+    return get_backend().chunk_status(key)
+
+
+def claim_finalize(key):
+    """
+    Returns True for just one of the requests asking, the one in charge of finalizing the upload (several chunks might
+    complete the upload at the same time)
+    """
+    return get_backend().claim_finalize(key)
+
+
+def set_upload_result(key, result):
+    """
+    Keeps the result (a dict) of an upload finalized in the background, for upload_status; until it expires with the
+    abandoned uploads (PLUPLOAD_STAGING_MAX_AGE)
+    """
+    get_backend().set_result(key, json.dumps(result, default=force_unicode))
+
+
+def upload_result(key):
+    """
+    The result set by set_upload_result, None if there's none
+    """
+    data = get_backend().get_result(key)
+    return json.loads(data) if data is not None else None
+
+
+_copy_functions = None
+
+
+def _libc_copy_functions():
+    """
+    copy_file_range (glibc >= 2.27) and sendfile of the C library through ctypes, for pythons without them in os
+    (python 2). Linux only, the BSD sendfile is another system call
+    """
+    if not sys.platform.startswith('linux'):
+        return {}
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return {}
+
+    def check(n):
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+    functions = {}
+    offset_p = ctypes.POINTER(ctypes.c_int64)
+    c_copy_file_range = getattr(libc, 'copy_file_range', None)
+    if c_copy_file_range is not None:
+        c_copy_file_range.restype = ctypes.c_ssize_t
+        c_copy_file_range.argtypes = [ctypes.c_int, offset_p, ctypes.c_int, offset_p, ctypes.c_size_t, ctypes.c_uint]
+
+        def copy_file_range(src_fd, dst_fd, count, offset):
+            src_offset, dst_offset = ctypes.c_int64(offset), ctypes.c_int64(offset)
+            return check(c_copy_file_range(src_fd, ctypes.byref(src_offset), dst_fd, ctypes.byref(dst_offset), count,
+                                           0))
+        functions['copy_file_range'] = copy_file_range
+    c_sendfile = getattr(libc, 'sendfile64', None)  # 64 bit offsets on 32 bit systems too
+    if c_sendfile is not None:
+        c_sendfile.restype = ctypes.c_ssize_t
+        c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, offset_p, ctypes.c_size_t]
+
+        def sendfile(src_fd, dst_fd, count, offset):
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return check(c_sendfile(dst_fd, src_fd, ctypes.byref(ctypes.c_int64(offset)), count))
+        functions['sendfile'] = sendfile
+    return functions
+
+
+def copy_functions():
+    """
+    The in-kernel copies available, [(method, function(src_fd, dst_fd, count, offset))], each copying up to count bytes
+    from offset in src to the same offset in dst and returning the bytes copied: copy_file_range and sendfile of os
+    (python >= 3.8 and 3.3), or of the C library through ctypes
+    """
+    global _copy_functions
+    if _copy_functions is None:
+        functions = _libc_copy_functions()
+        if hasattr(os, 'copy_file_range'):
+            functions['copy_file_range'] = lambda src_fd, dst_fd, count, offset: os.copy_file_range(
+                src_fd, dst_fd, count, offset, offset)
+        if hasattr(os, 'sendfile'):
+            def sendfile(src_fd, dst_fd, count, offset):
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, offset, count)
+            functions['sendfile'] = sendfile
+        _copy_functions = [(method, functions[method]) for method in ('copy_file_range', 'sendfile')
+                           if method in functions]
+    return _copy_functions
+
+
+def kernel_copy(src, dst, size):
+    """
+    Copies size bytes from the src file object to the dst file object, letting the kernel move the data where possible
+    (copy_file_range, then sendfile, see copy_functions), falling back to a plain read/write copy. Returns the method
+    used
+    """
+    for method, func in copy_functions():
+        copied = 0
+        try:
+            while copied < size:
+                n = func(src.fileno(), dst.fileno(), size - copied, copied)
+                if not n:
+                    break
+                copied += n
+        except OSError, err:
+            if copied or err.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            continue  # not supported for these files, trying next method
+        if copied == size:
+            return method
+    src.seek(0)
+    dst.seek(0)
+    shutil.copyfileobj(src, dst)
+    return 'copy'
+
+
+def finalize(key, dest_path):
+    """
+    Moves the staging file of a completed upload to dest_path, returns the way it was done: 'rename' (atomic, no data
+    copied) when the staging dir and dest_path are on the same filesystem, otherwise the kernel_copy method used to copy
+    it into a temp file next to dest_path, which is then renamed over dest_path
+    """
+    src_path = staging_path(key)
+    try:
+        replace(src_path, dest_path)
+        return 'rename'
+    except OSError, err:
+        if err.errno != errno.EXDEV:
+            raise
+    fd, tmp_path = tempfile.mkstemp(prefix='.plupload.', dir=os.path.dirname(dest_path))
+    try:
+        dst = os.fdopen(fd, 'wb')
+        try:
+            src = open(src_path, 'rb')
+            try:
+                method = kernel_copy(src, dst, os.fstat(src.fileno()).st_size)
+            finally:
+                src.close()
+        finally:
+            dst.close()
+        replace(tmp_path, dest_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(src_path)
+    return method
+
+
+def discard(key):
+    """
+    Removes the staging file and the bookkeeping files of the upload
+    """
+    hashing.discard(key)
+    get_backend().discard(key)
+    try:
+        os.remove(staging_path(key))
+    except OSError:
+        pass
+
+
+def usage():
+    """
+    Bytes taken by the staging files (preallocated: the total size of each upload in progress)
+    """
+    used = 0
+    for name in os.listdir(STAGING_DIR):
+        if name.endswith(PART_SUFFIX):
+            try:
+                used += os.stat(os.path.join(STAGING_DIR, name)).st_size
+            except OSError:
+                pass
+    return used
+
+
+def unallocated():
+    """
+    Bytes of the staging files not allocated on disk yet: sparse staging files (not preallocated, see preallocate) get
+    their blocks as the chunks are written, the free space of the filesystem doesn't account for the rest yet
+    """
+    reserved = 0
+    for name in os.listdir(STAGING_DIR):
+        if name.endswith(PART_SUFFIX):
+            try:
+                st = os.stat(os.path.join(STAGING_DIR, name))
+            except OSError:
+                continue
+            blocks = getattr(st, 'st_blocks', None)  # not on windows
+            if blocks is not None:
+                reserved += max(0, st.st_size - blocks * 512)
+    return reserved
+
+
+def sweep(max_age=STAGING_MAX_AGE):
+    """
+    Removes the staging files of the uploads that haven't received chunks for max_age seconds: abandoned by the client
+    (by default once their control code has expired, they can't be resumed anymore). Returns (uploads removed, bytes
+    freed)
+    """
+    uploads = {}  # key: [last modified, size]
+    try:
+        names = os.listdir(STAGING_DIR)
+    except OSError:
+        return 0, 0  # nothing staged yet
+    for name in names:
+        for suffix in SUFFIXES:
+            if name.endswith(suffix):
+                try:
+                    st = os.stat(os.path.join(STAGING_DIR, name))
+                except OSError:
+                    break
+                upload = uploads.setdefault(name[:-len(suffix)], [0, 0])
+                upload[0] = max(upload[0], st.st_mtime)
+                if suffix == PART_SUFFIX:
+                    upload[1] = st.st_size
+                break
+    removed = freed = 0
+    stale = time.time() - max_age
+    for key, (mtime, size) in uploads.items():
+        if mtime < stale:
+            discard(key)
+            get_backend().discard_result(key)
+            removed += 1
+            freed += size
+    for dirpath, dirnames, filenames in os.walk(OWNERS_DIR, topdown=False):
+        for filename in filenames:
+            try:
+                if os.stat(os.path.join(dirpath, filename)).st_mtime < stale:
+                    os.remove(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+        if dirpath != OWNERS_DIR:
+            try:
+                os.rmdir(dirpath)  # if empty
+            except OSError:
+                pass
+    return removed, freed
+
+
+_sweeper = []
+_sweeper_lock = threading.Lock()
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(STAGING_SWEEP_INTERVAL)
+        try:
+            workers.run_blocking(sweep)
+        except Exception:
+            workers.logger.exception("plupload staging sweep failed")
+
+
+def start_sweeper():
+    """
+    Starts the thread sweeping the staging area every PLUPLOAD_STAGING_SWEEP_INTERVAL seconds, once per process
+    """
+    if not STAGING_SWEEP_INTERVAL or _sweeper:
+        return
+    with _sweeper_lock:
+        if not _sweeper:
+            thread = threading.Thread(target=_sweep_forever, name='plupload-sweeper')
+            thread.daemon = True
+            thread.start()
+            _sweeper.append(thread)
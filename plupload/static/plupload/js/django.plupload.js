@@ -0,0 +1,291 @@
+/*
+ * django-plupload: initializes the plupload widgets rendered by PluploadInputWidget (plupload/widget.html). Loaded once
+ * per page by {% plupload_head_init %}, each widget just calls django_plupload.init with its own id, its configuration
+ * (computed once per field, on the server) and its control code.
+ */
+var django_plupload = (function($) {
+
+    var MAX_RETRIES = 3; // times a failed chunk is retried, but those refused by the rate limits (see retry_delay)
+
+    function storage(method, key, value) {
+        // localStorage might be missing or disabled (private browsing)
+        try { return window.localStorage[method](key, value); } catch (e) { return null; }
+    }
+
+    function element(prefix, id) {
+        return $(document.getElementById(prefix + id)); // ids of formset fields are not valid css selectors
+    }
+
+    function paths(input) {
+        // multi-file widgets: the input holds a JSON list of the uploaded files
+        try { return $.parseJSON(input.val() || '[]') || []; } catch (e) { return []; }
+    }
+
+    // uploaded file removal checkbox
+    $(document).on('click', '.pluploader_remove', function() {
+        var input = element('', $(this).attr('data-target'));
+        var value = $(this).attr('data-value');
+        var removed = $(this).is(':checked');
+        $(this).closest('.pluploader_file').find('.pluploader_uploaded').css('text-decoration',
+                                                                             removed ? 'line-through' : 'none');
+        if ($(this).attr('data-multiple')) {
+            var files = $.grep(paths(input), function(path) { return path != value; });
+            if (!removed) files.push(value);
+            input.val(files.length ? JSON.stringify(files) : '');
+        } else {
+            input.val(removed ? '' : value);
+        }
+    });
+
+    function compressible(config, file) {
+        // files with an extension listed in the field's compress option are gzipped in the browser, if it can
+        var extension = (file.name.match(/\.([^.]+)$/) || ['', ''])[1].toLowerCase();
+        return !!(config.compress && window.CompressionStream && window.Response && file.getNative() &&
+                  file.size == file.origSize && $.inArray(extension, config.compress) >= 0);
+    }
+
+    function gzip(blob) {
+        return new Response(blob.stream().pipeThrough(new CompressionStream('gzip'))).blob();
+    }
+
+    function retry_delay(file, status, response) {
+        // seconds to wait before retrying a failed chunk, null once the file has been retried too many times. Chunks
+        // refused by the server's rate limits (status 429 or 503) wait what the server says, or back off
+        // exponentially; other failures are retried MAX_RETRIES times, after a second
+        if (status != 429 && status != 503) {
+            file.failed_attempts = (file.failed_attempts || 0) + 1;
+            return file.failed_attempts > MAX_RETRIES ? null : 1;
+        }
+        file.backoff_attempts = (file.backoff_attempts || 0) + 1;
+        if (file.backoff_attempts > 8) return null;
+        var j = null;
+        try { j = $.parseJSON(response); } catch (e) {}
+        var retry_after = j && j.result && j.result.retry_after;
+        return (retry_after || Math.pow(2, file.backoff_attempts - 1)) * (1 + Math.random() / 2);
+    }
+
+    function upload_compressed(up, file, url) {
+        // uploads the file chunk by chunk like plupload does, each chunk gzipped: raw request bodies with a
+        // Content-Encoding header, the server decompresses them while writing them to the staging file
+        var native_file = file.getNative();
+        var chunk_size = up.settings.chunk_size || native_file.size;
+        file.loaded = chunk_size * Math.floor((file.loaded || 0) / chunk_size);
+        function next_chunk() {
+            if (file.status !== plupload.UPLOADING || up.state === plupload.STOPPED) return;
+            var offset = file.loaded;
+            var params = $.extend({}, up.settings.multipart_params,
+                                  {name: file.target_name || file.name, offset: offset, total: native_file.size});
+            gzip(native_file.slice(offset, offset + chunk_size)).then(function(body) {
+                return $.ajax({url: url + '?' + $.param(params), type: 'POST', data: body, processData: false,
+                               contentType: 'application/octet-stream', dataType: 'text',
+                               headers: $.extend({'Content-Encoding': 'gzip'}, up.settings.headers)});
+            }).then(function(response) {
+                var j = null;
+                try { j = $.parseJSON(response); } catch (e) {}
+                file.failed_attempts = file.backoff_attempts = 0;
+                file.loaded = Math.min(offset + chunk_size, native_file.size);
+                up.trigger('UploadProgress', file);
+                if (file.loaded >= native_file.size || !j || !j.result || j.result.error) {
+                    file.status = plupload.DONE;
+                    up.trigger('FileUploaded', file, {response: response, status: 200});
+                } else {
+                    up.trigger('ChunkUploaded', file, {offset: file.loaded, total: native_file.size,
+                                                       response: response, status: 200});
+                    next_chunk();
+                }
+            }, function(xhr) {
+                var delay = retry_delay(file, xhr.status, xhr.responseText);
+                if (delay !== null) {
+                    setTimeout(next_chunk, delay * 1000);
+                } else {
+                    up.trigger('Error', {code: plupload.HTTP_ERROR, message: plupload.translate('HTTP Error.'),
+                                         file: file, status: xhr.status, response: xhr.responseText});
+                }
+            });
+        }
+        next_chunk();
+    }
+
+    function poll_status(url, params, done, failures) {
+        // the server finalizes the upload in the background: asking until it's done, then done(result) gets what
+        // the response of the last chunk would have been
+        var again = function(delay) {
+            setTimeout(function() { poll_status(url, params, done, failures); }, delay);
+        };
+        $.ajax({url: url, data: params, dataType: 'json', cache: false})
+            .done(function(j) {
+                if (j.result && j.result.processing) again(1000);
+                else done(j.result && j.result.upload || {error: j.result && j.result.error || 'Upload failed'});
+            })
+            .fail(function() {
+                failures = (failures || 0) + 1;
+                if (failures < 10) again(2000); else done({error: 'Upload status unavailable'});
+            });
+    }
+
+    function init(id, config, control_code) {
+        var div = element('pluploader_div_', id);
+        var msg = element('pluploader_msg_', id);
+        var error = element('pluploader_error_', id);
+        // collecting CSRF token from the form, make sure there is one
+        var csrf_token = div.closest('form').find('input[name=csrfmiddlewaretoken]').val() || '';
+        function uploaded(filename, result) {
+            // shows the uploaded file (or the error) and puts its path in the input
+            if (!config.multiple) msg.html('');
+            error.html('');
+            if (result.error) error.html(result.error);
+            var value = (config.upload_to ? config.upload_to + '/' : '') + (result.filename || filename);
+            if (config.multiple) {
+                msg.find('.pluploader_loading').first().remove();
+                if (!result.error) {
+                    var files = paths(element('', id));
+                    files.push(value);
+                    element('', id).val(JSON.stringify(files));
+                    msg.append($('<span class="pluploader_file"></span>').html(result.msg));
+                }
+            } else {
+                if (result.msg) msg.html(result.msg);
+                element('', id).val(value);
+            }
+        }
+        function use_chunk_size(up, size) {
+            // chunk size of the next file, sent along so that the server knows where each chunk goes
+            if (!config.adaptive_chunk_size || !size) return;
+            up.setOption('chunk_size', size);
+            up.settings.multipart_params.chunk_size = size;
+        }
+        function recommended(response) {
+            // the server recommends a chunk size for the next file from the chunks it has received (see
+            // plupload.chunking), kept for the other widgets and pages too
+            var j = null;
+            try { j = $.parseJSON(response); } catch (e) {}
+            if (j && j.result && j.result.recommended_chunk_size) {
+                storage('setItem', 'plupload_chunk_size', j.result.recommended_chunk_size);
+            }
+        }
+        function upload(up, file) {
+            // the file upload starts: sent by plupload, or compressed
+            file.status = plupload.UPLOADING;
+            if (compressible(config, file)) upload_compressed(up, file, config.raw_upload_url);
+            else up.trigger('UploadFile', file);
+        }
+        var settings = {
+            // using html only; raw chunks (multipart: false, the parameters going in the query string) need html5
+            runtimes: config.multipart ? 'html5,html4' : 'html5',
+            url: config.upload_url,
+            unique_names: config.unique_names,
+            multipart: config.multipart,
+            send_chunk_number: false, // sending 'offset' and 'total' bytes, the server writes each chunk at its offset
+            max_file_count: config.max_files, // max number of files allowed in the upload queue, 0 = no limit
+            max_retries: 0, // failed chunks are retried by Error, 429s only once the backoff has run
+            headers: {'X-Requested-With': 'XMLHttpRequest', 'X-CSRFToken': csrf_token}, // the csrf_token for django
+            multipart_params: {'control_code': control_code, 'show_thumbnail': config.show_thumbnail ? '1' : '',
+                               'upload_chmod': config.upload_chmod}, // extra params
+            // removing 'Start Upload' button in case AUTO_START setting is set to True
+            buttons: {browse: true, start: !config.auto_start, stop: !config.auto_start},
+            init: {
+                BeforeUpload: function(up, file) {
+                    // Called before each file upload starts: the server keys uploads by control code and file id. The
+                    // file id is built from name, size and date of the file, and the control code used for it is kept
+                    // in localStorage, so an interrupted upload can be resumed (even after a page reload) sending just
+                    // the chunks still missing on the server
+                    var native_file = file.getNative() || {};
+                    var file_id = [file.name, file.origSize,
+                                   native_file.lastModified || native_file.lastModifiedDate || ''].join('_');
+                    var resume_key = 'plupload_resume:' + config.upload_to + ':' + file_id;
+                    var resume_code = storage('getItem', resume_key);
+                    var hint = parseInt(storage('getItem', 'plupload_chunk_size'), 10);
+                    up.settings.multipart_params.file_id = file_id;
+                    up.settings.multipart_params.control_code = control_code;
+                    if (hint) { // the chunk size recommended by the server, within the field's bounds
+                        use_chunk_size(up, Math.min(Math.max(hint, config.min_chunk_size), config.max_chunk_size));
+                    }
+                    file.resume_key = resume_key;
+                    if (!resume_code || file.resume_checked) {
+                        storage('setItem', resume_key, control_code);
+                        if (!compressible(config, file)) return true;
+                        upload(up, file);
+                        return false;
+                    }
+                    // asking the server which chunks it is missing, then starting the upload from the first one
+                    file.resume_checked = true;
+                    $.ajax({url: config.status_url, data: {control_code: resume_code, file_id: file_id},
+                            dataType: 'json', cache: false})
+                        .done(function(j) {
+                            if (!j.result || j.result.error) {
+                                storage('setItem', resume_key, control_code);
+                                return;
+                            }
+                            up.settings.multipart_params.control_code = resume_code;
+                            if (j.result.chunks && j.result.missing.length) {
+                                use_chunk_size(up, j.result.chunk_size); // the chunk size the upload started with
+                                if (j.result.chunk_size == up.settings.chunk_size) {
+                                    file.loaded = j.result.missing[0] * j.result.chunk_size;
+                                }
+                            }
+                        })
+                        .always(function() {
+                            upload(up, file);
+                        });
+                    return false; // the upload starts once the server has answered
+                },
+                ChunkUploaded: function(up, file, info) {
+                    file.failed_attempts = file.backoff_attempts = 0; // the server accepts chunks again
+                    recommended(info.response);
+                },
+                FileUploaded: function(up, file, info) {
+                    // Called when a file has finished uploading: info.response is the JSON-RPC response of the upload
+                    // view, {"jsonrpc" : "2.0", "result" : ..., "id" : "id"}
+                    var resp = info.response;
+                    if (!info.status) { // non ajax (html4) responses, wrapped in <pre></pre>
+                        var tmp = document.createElement('div');
+                        tmp.innerHTML = resp;
+                        resp = tmp.textContent || tmp.innerText;
+                    }
+                    var j = $.parseJSON(resp);
+                    recommended(resp);
+                    if (j.result.processing) {
+                        // finalized in the background (PLUPLOAD_BACKGROUND_FINALIZE): the input is filled in once
+                        // the file is ready
+                        poll_status(config.status_url, {control_code: up.settings.multipart_params.control_code,
+                                                        file_id: up.settings.multipart_params.file_id},
+                                    function(result) { uploaded(file.name, result); });
+                    } else {
+                        uploaded(file.name, j.result);
+                    }
+                    storage('removeItem', file.resume_key); // nothing to resume anymore
+                    up.removeFile(file); // removes file from upload queue
+                },
+                FilesAdded: function(up, files) {
+                    // Called when files are added to queue
+                    if (config.auto_start) {
+                        var loading = '<img class="pluploader_loading" src="' + config.loading_image_url +
+                                      '" alt="loading..."/>';
+                        if (config.multiple) msg.append(loading); else msg.html(loading);
+                        up.start(); // auto upload start as soon as a file is added
+                    }
+                },
+                Error: function(up, args) {
+                    // Called when a error has occured: failed chunks are retried here, plupload doesn't retry them
+                    // (a 429 would be sent again straight away), the file is queued again from the chunk that failed
+                    // once retry_delay has passed
+                    var file = args.file;
+                    if (!file || args.code != plupload.HTTP_ERROR) return;
+                    var delay = retry_delay(file, args.status, args.response);
+                    if (delay === null) return;
+                    setTimeout(function() {
+                        file.status = plupload.QUEUED;
+                        if (up.state != plupload.STARTED) up.start();
+                    }, delay * 1000);
+                }
+            }
+        };
+        if (config.max_file_size) settings.max_file_size = config.max_file_size; // a string like 10mb or 100kb
+        if (config.chunk_size) settings.chunk_size = config.chunk_size;
+        if (config.resize) settings.resize = config.resize; // to resize images on client side
+        if (config.extensions) settings.filters = [{title: "Image files", extensions: config.extensions.join(',')}];
+        div.plupload(settings);
+    }
+
+    return {init: init};
+})(jQuery);
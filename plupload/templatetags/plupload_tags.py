@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.template import Library
-from plupload.settings import STATIC_URL, JQUERY_URL, JQUERY_UI_URL, JQUERY_UI_CSS_URL
+from plupload.settings import LAZY_LOAD
+from plupload.assets import head_assets
 
 register = Library()
 
@@ -9,11 +10,9 @@ register = Library()
 def plupload_head_init(context):
     """
     To be added to your template's head section, as {% plupload_head_init %}, it initializes the js needed for plupload
-    to work
+    to work: with PLUPLOAD_LAZY_LOAD, a loader fetching it once a widget is on the page (see plupload.assets)
     """
     return {
-        'STATIC_URL': STATIC_URL,
-        'jquery_url': JQUERY_URL,
-        'jquery_ui_url': JQUERY_UI_URL,
-        'jquery_ui_css_url': JQUERY_UI_CSS_URL,
+        'assets': head_assets(),
+        'lazy_load': LAZY_LOAD,
     }
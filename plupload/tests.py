@@ -0,0 +1,911 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, models
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.state import ProjectState
+from django.template import Context, Template
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.html import escapejs
+from plupload.forms import PluploadFormField
+from plupload.models import PluploadControlCode, PluploadField, PluploadFileInfo, PluploadQuerySet
+from plupload.tokens import issue_control_code, resolve_control_code, InvalidControlCode
+from plupload import (admission, assets, chunking, dedup, download, fileinfo, hashing, metrics, resize, staging,
+                      thumbnails, tokens, upload, workers)
+from unittest import skipIf
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import Queue
+import shutil
+import StringIO
+import subprocess
+import sys
+import threading
+import time
+import urllib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Tests of the upload path (chunks, staging, finalize, control codes), of the widget and of the models. Run them with
+runtests.py, which sets up MEDIA_ROOT and the staging area in a temp directory and 64 Kb chunks.
+
+The plupload settings are read when its modules are imported: tests change them with patched, on the modules using
+them.
+"""
+
+CHUNK = 64 * 1024
+UPLOAD_TO = 'uploads'
+BOUNDARY = 'plupload0tests0boundary'
+
+
+@contextmanager
+def patched(obj, **values):
+    """
+    Sets attributes of obj (i.e. the settings imported by a module) for the duration of the block
+    """
+    saved = dict((name, getattr(obj, name)) for name in values)
+    for name, value in values.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
+
+
+def multipart_body(params, data, filename='file.bin'):
+    """
+    A chunk request as plupload sends it: the parameters (a list of (name, value)), in order, and the 'file' part
+    where ('file', None) is in params, last if it isn't
+    """
+    if ('file', None) not in params:
+        params = list(params) + [('file', None)]
+    lines = []
+    for name, value in params:
+        lines.append('--' + BOUNDARY)
+        if name == 'file' and value is None:
+            lines.extend(['Content-Disposition: form-data; name="file"; filename="%s"' % filename,
+                          'Content-Type: application/octet-stream', '', data])
+        else:
+            lines.extend(['Content-Disposition: form-data; name="%s"' % name, '', str(value)])
+    lines.extend(['--' + BOUNDARY + '--', ''])
+    return '\r\n'.join(lines)
+
+
+def random_data(size):
+    return os.urandom(size)
+
+
+def image_data(size, image_format='JPEG'):
+    """
+    An image of size (width, height), encoded
+    """
+    f = StringIO.StringIO()
+    Image.new('RGB', size, (200, 100, 50)).save(f, image_format)
+    return f.getvalue()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Document(models.Model):
+    """
+    Test model
+    """
+    attachment = PluploadField(upload_to=UPLOAD_TO, blank=True, download_access=True)
+    photos = PluploadField(upload_to=UPLOAD_TO, max_files=3, blank=True,
+                           download_access='plupload.download.authenticated')
+    private = PluploadField(upload_to=UPLOAD_TO, blank=True)
+    shared = PluploadField(upload_to=UPLOAD_TO, blank=True, deduplicate=True)
+
+    objects = PluploadQuerySet.as_manager()
+
+    class Meta:
+        app_label = 'plupload'
+
+
+class PluploadTestCase(TestCase):
+    """
+    Empty MEDIA_ROOT (with an UPLOAD_TO directory) and staging area for each test, and helpers to upload files the
+    way the widget does
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        if Document._meta.db_table not in connection.introspection.table_names():
+            with connection.schema_editor() as editor:
+                editor.create_model(Document)
+        super(PluploadTestCase, cls).setUpClass()
+
+    def setUp(self):
+        for path in (settings.MEDIA_ROOT, settings.PLUPLOAD_STAGING_DIR):
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, UPLOAD_TO))
+        cache.clear()
+        hashing._states.clear()
+
+    def media_path(self, name):
+        return os.path.join(settings.MEDIA_ROOT, UPLOAD_TO, name)
+
+    def read_media(self, name):
+        with open(self.media_path(name), 'rb') as f:
+            return f.read()
+
+    def post_chunk(self, params, data, raw=False, **extra):
+        """
+        Posts a chunk to the multipart upload view (or, with raw, to the raw one), returns the response
+        """
+        if raw:
+            url = '%s?%s' % (reverse('plupload_raw'), urllib.urlencode(params))
+            return self.client.post(url, data=data, content_type='application/octet-stream', **extra)
+        return self.client.post(reverse('plupload'), data=multipart_body(params, data),
+                                content_type='multipart/form-data; boundary=%s' % BOUNDARY, **extra)
+
+    def upload(self, data, name='file.txt', code=None, file_id=None, order=None, raw=False, params=(), **extra):
+        """
+        Uploads data in CHUNK sized chunks (in the given order of chunk indexes, if any), sending offset and total,
+        returns the results of the chunk requests
+        """
+        code = code or issue_control_code(UPLOAD_TO)
+        offsets = range(0, len(data), CHUNK) or [0]
+        if order is not None:
+            offsets = [offsets[i] for i in order]
+        results = []
+        for offset in offsets:
+            chunk_params = [('name', name), ('offset', offset), ('total', len(data)), ('control_code', code),
+                            ('file_id', file_id or name)] + list(params)
+            response = self.post_chunk(chunk_params, data[offset:offset + CHUNK], raw=raw, **extra)
+            results.append(json.loads(response.content)['result'])
+        return results
+
+
+class ChunkAssemblyTest(PluploadTestCase):
+    """
+    Chunks written at their offset, in any order
+    """
+
+    def test_out_of_order_chunks(self):
+        data = random_data(3 * CHUNK + 100)
+        results = self.upload(data, name='out_of_order.bin', order=[3, 1, 0, 2])
+        self.assertEqual([r['error'] for r in results], [''] * 4)
+        self.assertEqual(self.read_media('out_of_order.bin'), data)
+
+    def test_uploads_keyed_by_file_id(self):
+        code = issue_control_code(UPLOAD_TO)
+        first, second = random_data(2 * CHUNK), random_data(2 * CHUNK)
+        self.upload(first, name='a.bin', code=code, order=[0])
+        self.upload(second, name='b.bin', code=code, order=[0])
+        self.upload(first, name='a.bin', code=code, order=[1])
+        self.upload(second, name='b.bin', code=code, order=[1])
+        self.assertEqual(self.read_media('a.bin'), first)
+        self.assertEqual(self.read_media('b.bin'), second)
+
+    def test_staging_file_preallocated(self):
+        if staging.fallocate_function() is None:
+            self.skipTest('posix_fallocate not available')
+        f = staging.open_staging_file(staging.upload_key('code', 'preallocated.bin'), 3 * CHUNK)
+        try:
+            st = os.fstat(f.fileno())
+        finally:
+            f.close()
+        self.assertEqual(st.st_size, 3 * CHUNK)
+        self.assertGreaterEqual(st.st_blocks * 512, 3 * CHUNK)
+        self.assertEqual(staging.unallocated(), 0)
+
+
+class FinalizeTest(PluploadTestCase):
+    """
+    Completed uploads are renamed into place
+    """
+
+    def test_rename(self):
+        code = issue_control_code(UPLOAD_TO)
+        result = self.upload('some content', name='renamed.txt', code=code)[-1]
+        self.assertEqual(result['finalize'], 'rename')
+        self.assertFalse(os.path.exists(staging.staging_path(staging.upload_key(code, 'renamed.txt'))))
+
+    def test_cross_filesystem_copy(self):
+        data = random_data(CHUNK * 3 + 7)
+        src_path, dst_path = os.path.join(settings.MEDIA_ROOT, 'src'), os.path.join(settings.MEDIA_ROOT, 'dst')
+        with open(src_path, 'wb') as f:
+            f.write(data)
+        methods = staging.copy_functions()
+        if sys.platform.startswith('linux'):
+            self.assertIn('sendfile', [method for method, func in methods])
+        for method, func in methods + [('copy', None)]:
+            with patched(staging, _copy_functions=[(method, func)] if func else []):
+                with open(src_path, 'rb') as src:
+                    with open(dst_path, 'wb') as dst:
+                        self.assertEqual(staging.kernel_copy(src, dst, len(data)), method)
+            with open(dst_path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_path_traversal(self):
+        code = issue_control_code(UPLOAD_TO)
+        for raw in (False, True):
+            result = self.upload('evil', name='../../evil_%s.txt' % raw, code=code, raw=raw)[-1]
+            self.assertEqual(result['error'], '')
+            self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, '..', 'evil_%s.txt' % raw)))
+            self.assertEqual(self.read_media('evil_%s.txt' % raw), 'evil')
+        for name in ('..', '/'):
+            result = self.upload('evil', name=name, code=code)[-1]
+            self.assertNotEqual(result['error'], '')
+        os.symlink(os.path.dirname(settings.MEDIA_ROOT), self.media_path('link'))
+        self.assertIsNone(upload.destination(resolve_control_code(code), 'link'))
+        self.assertIsNotNone(upload.destination(resolve_control_code(code), 'file.txt'))
+
+
+class SignedControlCodeTest(PluploadTestCase):
+    """
+    Signed control codes, verified without DB access
+    """
+
+    def test_signed_code(self):
+        with patched(tokens, SIGNED_CONTROL_CODES=True):
+            code = issue_control_code(UPLOAD_TO, max_file_size=1, extensions=['txt'])
+            with self.assertNumQueries(0):
+                ticket = resolve_control_code(code)
+            self.assertEqual((ticket.upload_to, ticket.max_file_size, ticket.extensions), (UPLOAD_TO, 1, ['txt']))
+            self.assertRaises(InvalidControlCode, resolve_control_code, code[:-2] + 'xx')
+            self.assertEqual(PluploadControlCode.objects.count(), 0)
+
+    def test_limits_enforced(self):
+        with patched(tokens, SIGNED_CONTROL_CODES=True):
+            code = issue_control_code(UPLOAD_TO, extensions=['txt'])
+            result = self.upload('data', name='script.exe', code=code)[-1]
+        self.assertIn('extension', result['error'])
+        self.assertFalse(os.path.exists(self.media_path('script.exe')))
+
+
+class ClearCodesTest(PluploadTestCase):
+    """
+    Expired control codes removed in batches by plupload_clearcodes
+    """
+
+    def test_clearcodes(self):
+        for i in range(5):
+            issue_control_code(UPLOAD_TO)
+        old = datetime.timedelta(seconds=tokens.CONTROL_CODE_TTL + 60)
+        expired = list(PluploadControlCode.objects.values_list('pk', flat=True)[:3])
+        PluploadControlCode.objects.filter(pk__in=expired).update(date=timezone.now() - old)
+        code = PluploadControlCode.objects.get(pk=expired[0]).code
+        self.assertRaises(InvalidControlCode, resolve_control_code, code)
+        call_command('plupload_clearcodes', batch_size=2, verbosity=0)
+        self.assertEqual(PluploadControlCode.objects.count(), 2)
+        self.assertFalse(PluploadControlCode.objects.filter(pk__in=expired).exists())
+
+
+class ResumeTest(PluploadTestCase):
+    """
+    The chunks missing from an interrupted upload, from upload_status
+    """
+
+    def status(self, code, file_id):
+        response = self.client.get(reverse('plupload_status'), {'control_code': code, 'file_id': file_id})
+        return json.loads(response.content)['result']
+
+    def test_resume(self):
+        code = issue_control_code(UPLOAD_TO)
+        data = random_data(3 * CHUNK)
+        self.assertEqual(self.status(code, 'resumed.bin')['chunks'], 0)
+        self.upload(data, name='resumed.bin', code=code, order=[0, 2])
+        status = self.status(code, 'resumed.bin')
+        self.assertEqual((status['chunk_size'], status['chunks'], status['missing']), (CHUNK, 3, [1]))
+        self.upload(data, name='resumed.bin', code=code, order=status['missing'])
+        self.assertEqual(self.read_media('resumed.bin'), data)
+
+
+class UploadHandlerTest(PluploadTestCase):
+    """
+    Multipart chunks streamed to the staging file while the request is parsed
+    """
+
+    def test_streamed_to_staging_file(self):
+        code = issue_control_code(UPLOAD_TO)
+        data = random_data(2 * CHUNK)
+        result = self.upload(data, name='streamed.bin', code=code, order=[1])[-1]
+        self.assertEqual(result['error'], '')
+        with open(staging.staging_path(staging.upload_key(code, 'streamed.bin')), 'rb') as f:
+            f.seek(CHUNK)
+            self.assertEqual(f.read(), data[CHUNK:])
+
+    def test_parameters_after_file_part(self):
+        code = issue_control_code(UPLOAD_TO)
+        data = random_data(2 * CHUNK)
+        self.upload(data, name='reordered.bin', code=code, order=[0])
+        for params in ([('control_code', code), ('file_id', 'reordered.bin'), ('name', 'reordered.bin'),
+                        ('total', len(data)), ('file', None), ('offset', CHUNK)],
+                       [('file', None), ('control_code', code), ('file_id', 'reordered.bin'),
+                        ('name', 'reordered.bin'), ('total', len(data)), ('offset', CHUNK)]):
+            staging.discard(staging.upload_key(code, 'reordered.bin'))
+            self.upload(data, name='reordered.bin', code=code, order=[0])
+            response = self.post_chunk(params, data[CHUNK:])
+            self.assertEqual(json.loads(response.content)['result']['error'], '')
+            self.assertEqual(self.read_media('reordered.bin'), data)
+
+
+class HashingTest(PluploadTestCase):
+    """
+    Digests computed while writing, checked against the client's checksum
+    """
+
+    def test_checksums(self):
+        data = random_data(2 * CHUNK + 1)
+        digest = hashlib.sha256(data).hexdigest()
+        result = self.upload(data, name='hashed.bin', order=[1, 0, 2], params=[('checksum', 'sha256:' + digest)])[-1]
+        self.assertEqual(result['error'], '')
+        self.assertEqual(result['checksums'], {'sha256': digest})
+
+    def test_checksum_mismatch(self):
+        result = self.upload('some data', name='corrupted.txt', params=[('checksum', 'sha256:' + '0' * 64)])[-1]
+        self.assertIn('checksum mismatch', result['error'])
+        self.assertFalse(os.path.exists(self.media_path('corrupted.txt')))
+
+
+class DeduplicationTest(PluploadTestCase):
+    """
+    Content addressed storage, a file uploaded twice is stored once
+    """
+
+    def test_deduplicated(self):
+        data = random_data(CHUNK + 10)
+        first = self.upload(data, name='first.bin', code=issue_control_code(UPLOAD_TO, deduplicate=True))[-1]
+        second = self.upload(data, name='second.bin', code=issue_control_code(UPLOAD_TO, deduplicate=True))[-1]
+        self.assertEqual((first['finalize'], second['finalize']), ('rename', 'dedup'))
+        self.assertEqual(os.stat(self.media_path('first.bin')).st_ino, os.stat(self.media_path('second.bin')).st_ino)
+        self.assertTrue(dedup.release(self.media_path('first.bin')))
+        self.assertEqual(self.read_media('second.bin'), data)
+
+    def test_chmod_not_shared(self):
+        data = random_data(10)
+        self.upload(data, name='first.bin', code=issue_control_code(UPLOAD_TO, deduplicate=True))
+        mode = os.stat(self.media_path('first.bin')).st_mode
+        self.upload(data, name='second.bin', code=issue_control_code(UPLOAD_TO, deduplicate=True),
+                    params=[('upload_chmod', '600' if mode & 0777 != 0600 else '644')])
+        self.assertEqual(os.stat(self.media_path('first.bin')).st_mode, mode)
+
+    def test_released_once_unreferenced(self):
+        data = random_data(10)
+        self.upload(data, name='shared.bin', code=issue_control_code(UPLOAD_TO, deduplicate=True))
+        first = Document.objects.create(shared='uploads/shared.bin')
+        second = Document.objects.create(shared='uploads/shared.bin')
+        first.shared = ''
+        first.save()
+        self.assertEqual(self.read_media('shared.bin'), data)  # the second document still refers to it
+        with self.assertNumQueries(1):
+            second = Document.objects.defer('shared').get(pk=second.pk)
+        second.save()  # not loaded, not changed
+        self.assertEqual(self.read_media('shared.bin'), data)
+        second = Document.objects.get(pk=second.pk)
+        second.shared = ''
+        second.save()
+        self.assertFalse(os.path.exists(self.media_path('shared.bin')))
+
+
+class WorkersTest(PluploadTestCase):
+    """
+    Blocking work called straight away without green threads, background work run by a pool
+    """
+
+    def test_run_blocking(self):
+        self.assertEqual(workers.run_blocking(lambda a, b=0: a + b, 1, b=2), 3)
+
+    def test_run_in_background(self):
+        done = threading.Event()
+        workers.run_in_background(done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_os_thread_pool(self):
+        # the background pool used under eventlet, with the modules of the original threads
+        pool = workers.OSThreadPool(2, threading, Queue)
+        release, lock, running, done = threading.Event(), threading.Lock(), [0, 0], []
+
+        def task(i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+                done.append(i)
+        for i in xrange(5):
+            pool.spawn(task, i)
+        self.assertTrue(wait_for(lambda: running[0] == 2))
+        release.set()
+        self.assertTrue(wait_for(lambda: len(done) == 5))
+        self.assertEqual(running[1], 2)
+
+
+class ThumbnailTest(PluploadTestCase):
+    """
+    Cached thumbnails, stale once their image is replaced
+    """
+
+    def test_freshness(self):
+        rel_path = os.path.join(UPLOAD_TO, 'image.jpg')
+        with open(self.media_path('image.jpg'), 'wb') as f:
+            f.write('not really an image')
+        thumbnail_path = os.path.join(settings.MEDIA_ROOT, thumbnails.thumbnail_rel_path(rel_path))
+        os.makedirs(os.path.dirname(thumbnail_path))
+        with open(thumbnail_path, 'wb') as f:
+            f.write('thumbnail')
+        self.assertTrue(thumbnails.is_fresh(rel_path))
+        os.utime(thumbnail_path, (time.time() - 60, time.time() - 60))
+        self.assertFalse(thumbnails.is_fresh(rel_path))
+        thumbnails.invalidate(rel_path)
+        self.assertFalse(os.path.exists(thumbnail_path))
+
+    @skipIf(Image is None, "Pillow not installed")
+    def test_generate(self):
+        rel_path = os.path.join(UPLOAD_TO, 'image.jpg')
+        with open(self.media_path('image.jpg'), 'wb') as f:
+            f.write(image_data((640, 480)))
+        self.assertTrue(thumbnails.generate(rel_path))
+        self.assertTrue(thumbnails.is_fresh(rel_path))
+        thumbnail = Image.open(os.path.join(settings.MEDIA_ROOT, thumbnails.thumbnail_rel_path(rel_path)))
+        self.assertEqual(thumbnail.format, 'JPEG')
+        self.assertEqual(thumbnail.size, (thumbnails.THUMBNAIL_WIDTH, thumbnails.THUMBNAIL_WIDTH * 3 / 4))
+
+    @skipIf(Image is None, "Pillow not installed")
+    def test_not_scheduled_for_other_files(self):
+        queued = []
+        with patched(workers, run_in_background=lambda func, *args: queued.append(args)):
+            with open(self.media_path('notes.txt'), 'wb') as f:
+                f.write('not an image')
+            self.assertFalse(thumbnails.schedule(os.path.join(UPLOAD_TO, 'notes.txt')))
+            # an image Pillow can't read is tried once, then again only once replaced
+            rel_path = os.path.join(UPLOAD_TO, 'broken.jpg')
+            with open(self.media_path('broken.jpg'), 'wb') as f:
+                f.write('not really an image')
+            self.assertTrue(thumbnails.schedule(rel_path))
+            self.assertFalse(thumbnails.generate(rel_path))
+            self.assertFalse(thumbnails.schedule(rel_path))
+            with open(self.media_path('broken.jpg'), 'wb') as f:
+                f.write(image_data((100, 100)))
+            os.utime(self.media_path('broken.jpg'), (time.time() + 60, time.time() + 60))
+            self.assertTrue(thumbnails.schedule(rel_path))
+        self.assertEqual(queued, [(rel_path,), (rel_path,)])
+
+
+class ServerResizeTest(PluploadTestCase):
+    """
+    Images resized on the server once uploaded, the resize parameters travelling with the control code
+    """
+
+    def test_resize_in_control_code(self):
+        for signed in (False, True):
+            with patched(tokens, SIGNED_CONTROL_CODES=signed):
+                code = issue_control_code(UPLOAD_TO, resize=(800, 600, 85))
+                self.assertEqual(tuple(resolve_control_code(code).resize), (800, 600, 85))
+                self.assertEqual(resolve_control_code(issue_control_code(UPLOAD_TO)).resize, None)
+
+    @skipIf(Image is None, "Pillow not installed")
+    def test_resize_image(self):
+        path = self.media_path('large.png')
+        with open(path, 'wb') as f:
+            f.write(image_data((1000, 500), 'PNG'))
+        self.assertTrue(resize.resize_image(path, 800, 600, 85))
+        self.assertEqual((Image.open(path).size, Image.open(path).format), ((800, 400), 'PNG'))
+        self.assertFalse(resize.resize_image(path, 800, 600, 85))  # already within the limits
+        with open(path, 'wb') as f:
+            f.write('not an image')
+        self.assertFalse(resize.resize_image(path, 800, 600, 85))
+
+    @skipIf(Image is None, "Pillow not installed")
+    def test_resized_after_upload(self):
+        refreshed = []
+
+        def refresh(abs_path):
+            # fileinfo.refresh, in the connection of the test (it closes the one of its background thread)
+            refreshed.append(os.path.basename(abs_path))
+            fileinfo.record(os.path.relpath(abs_path, settings.MEDIA_ROOT))
+        with patched(fileinfo, FILE_INFO=True, refresh=refresh), patched(upload, FILE_INFO=True), \
+                patched(workers, run_in_background=lambda func, *args: func(*args)):
+            for name, size in (('large.jpg', (1000, 500)), ('small.jpg', (100, 100))):
+                result = self.upload(image_data(size), name=name,
+                                     code=issue_control_code(UPLOAD_TO, resize=(800, 600, 85)))[-1]
+                self.assertTrue(result['resize'])
+        self.assertEqual(refreshed, ['large.jpg'])  # the small image didn't need resizing
+        self.assertEqual(Image.open(self.media_path('large.jpg')).size, (800, 400))
+        info = PluploadFileInfo.objects.get(path='uploads/large.jpg')
+        self.assertEqual((info.width, info.height), (800, 400))
+        self.assertEqual(info.size, os.path.getsize(self.media_path('large.jpg')))
+
+
+class MetricsTest(PluploadTestCase):
+    """
+    Phases timed in Server-Timing, counters in the Prometheus text
+    """
+
+    def test_server_timing(self):
+        params = [('name', 'timed.txt'), ('offset', 0), ('total', 4),
+                  ('control_code', issue_control_code(UPLOAD_TO)), ('file_id', 'timed.txt')]
+        response = self.post_chunk(params, 'data')
+        phases = [item.split(';')[0].strip() for item in response['Server-Timing'].split(',')]
+        for name in ('parse', 'write', 'finalize', 'total'):
+            self.assertIn(name, phases)
+        self.assertIn('plupload_uploads_completed_total', metrics.prometheus_text())
+
+
+class BenchmarkTest(TestCase):
+    """
+    The load benchmark runs end to end
+    """
+
+    def test_benchmark(self):
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks',
+                              'upload_benchmark.py')
+        output = subprocess.check_output([sys.executable, script, '--clients', '2', '--files', '2', '--file-size',
+                                          '0.2', '--chunk-size', '0.0625', '--renders', '2', '--json'])
+        report = json.loads(output)
+        self.assertEqual(report['files_uploaded'], 4)
+        self.assertEqual(report['errors'], 0)
+
+
+class WidgetTest(PluploadTestCase):
+    """
+    The widget configuration is computed once, each render gets its own control code
+    """
+
+    def test_render(self):
+        field = PluploadFormField(upload_to=UPLOAD_TO, extensions=['jpg'])
+        first = field.widget.render('image', '')
+        second = field.widget.render('image', '')
+        self.assertIs(field.widget.config.js_config(), field.widget.config.js_config())
+        self.assertIn('"extensions": ["jpg", "JPG", "Jpg"]', first)
+        first_code, second_code = PluploadControlCode.objects.order_by('pk').values_list('code', flat=True)
+        self.assertTrue(escapejs(first_code) in first and escapejs(second_code) not in first)
+        self.assertTrue(escapejs(second_code) in second and escapejs(first_code) not in second)
+
+
+class MultiFileTest(PluploadTestCase):
+    """
+    Multi-file fields, and the cap on concurrent uploads per user
+    """
+
+    def test_deconstruct(self):
+        # migrations rebuild the field with all its options: multi-file fields stay text columns
+        field = PluploadField(upload_to='photos/', resize_to='800x600', resize_quality=85, max_files=0,
+                              show_thumbnail=True, server_resize=True, deduplicate=True, compress=['txt'],
+                              download_access='plupload.download.authenticated')
+        name, path, args, kwargs = field.deconstruct()
+        clone = PluploadField(*args, **kwargs)
+        for option in ('upload_to', 'resize_to', 'resize_width', 'resize_height', 'resize_quality', 'max_files',
+                       'show_thumbnail', 'server_resize', 'deduplicate', 'compress', 'download_access'):
+            self.assertEqual(getattr(clone, option), getattr(field, option))
+        self.assertEqual(clone.db_type(connection), 'text')
+        self.assertEqual(PluploadField().deconstruct()[3], {})
+
+    def test_multi_file_field(self):
+        document = Document.objects.create(photos=['uploads/a.jpg', 'uploads/b.jpg'])
+        self.assertEqual(Document.objects.get(pk=document.pk).photos, ['uploads/a.jpg', 'uploads/b.jpg'])
+        field = PluploadFormField(upload_to=UPLOAD_TO, max_files=2)
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            open(self.media_path(name), 'wb').close()
+        self.assertEqual(field.clean('["uploads/a.jpg", "uploads/b.jpg"]'), ['uploads/a.jpg', 'uploads/b.jpg'])
+        self.assertRaises(Exception, field.clean, '["uploads/a.jpg", "uploads/b.jpg", "uploads/c.jpg"]')
+
+    def test_concurrent_uploads(self):
+        code = issue_control_code(UPLOAD_TO)
+        with patched(admission, MAX_CONCURRENT_UPLOADS=1):
+            first = self.upload(random_data(2 * CHUNK), name='first.bin', code=code, order=[0])[-1]
+            second = self.upload(random_data(2 * CHUNK), name='second.bin', code=code, order=[0])[-1]
+        self.assertEqual(first['error'], '')
+        self.assertIn('too many uploads', second['error'])
+
+
+class StagingSweepTest(PluploadTestCase):
+    """
+    Abandoned staging files removed, new uploads refused over the staging quota
+    """
+
+    def test_sweep(self):
+        code = issue_control_code(UPLOAD_TO)
+        self.upload(random_data(2 * CHUNK), name='abandoned.bin', code=code, order=[0])
+        key = staging.upload_key(code, 'abandoned.bin')
+        self.assertEqual(staging.sweep(max_age=60), (0, 0))
+        old = time.time() - 120
+        for suffix in staging.SUFFIXES:
+            if os.path.exists(staging.staging_path(key, suffix)):
+                os.utime(staging.staging_path(key, suffix), (old, old))
+        self.assertEqual(staging.sweep(max_age=60)[0], 1)
+        self.assertFalse(os.path.exists(staging.staging_path(key)))
+
+    def test_quota(self):
+        with patched(admission, STAGING_QUOTA=0.1):
+            result = self.upload(random_data(2 * CHUNK), name='big.bin', order=[0])[-1]
+        self.assertIn('retry later', result['error'])
+
+    def test_sparse_files_count_as_used(self):
+        # an upload in progress whose staging file hasn't been allocated yet
+        staging.make_staging_dir()
+        with open(staging.staging_path(staging.upload_key('code', 'sparse.bin')), 'wb') as f:
+            f.truncate(1 << 30)
+        if staging.unallocated() < 1 << 29:
+            self.skipTest('sparse files not supported')
+        st = os.statvfs(settings.PLUPLOAD_STAGING_DIR)
+        free = st.f_bavail * st.f_frsize
+        with patched(admission, MIN_FREE_SPACE=(free - (1 << 29)) / 1048576.0):
+            self.assertIn('disk space', admission.check_space(CHUNK))
+        with patched(admission, MIN_FREE_SPACE=(free - (3 << 30)) / 1048576.0):
+            self.assertIsNone(admission.check_space(CHUNK))
+
+
+class RawUploadTest(PluploadTestCase):
+    """
+    Chunks sent as raw request bodies
+    """
+
+    def test_raw_upload(self):
+        data = random_data(2 * CHUNK + 3)
+        results = self.upload(data, name='raw.bin', raw=True, order=[2, 0, 1])
+        self.assertEqual([r['error'] for r in results], [''] * 3)
+        self.assertEqual(self.read_media('raw.bin'), data)
+
+    def test_invalid_content_length(self):
+        with patched(admission, RATE_LIMIT=1):
+            response = self.post_chunk([('name', 'raw.bin'), ('control_code', issue_control_code(UPLOAD_TO))], 'data',
+                                       raw=True, CONTENT_LENGTH='abc')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('invalid Content-Length', json.loads(response.content)['result']['error'])
+
+
+class CompressionTest(PluploadTestCase):
+    """
+    Compressed chunks decompressed while written
+    """
+
+    def gzip(self, data):
+        out = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb')
+        f.write(data)
+        f.close()
+        return out.getvalue()
+
+    def test_gzip_chunk(self):
+        data = 'compressible line\n' * 1000
+        params = [('name', 'log.txt'), ('offset', 0), ('total', len(data)),
+                  ('control_code', issue_control_code(UPLOAD_TO)), ('file_id', 'log.txt')]
+        response = self.post_chunk(params, self.gzip(data), raw=True, HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(json.loads(response.content)['result']['error'], '')
+        self.assertEqual(self.read_media('log.txt'), data)
+
+    def test_corrupted_chunk(self):
+        params = [('name', 'log.txt'), ('offset', 0), ('total', 100),
+                  ('control_code', issue_control_code(UPLOAD_TO)), ('file_id', 'log.txt')]
+        response = self.post_chunk(params, 'not gzipped', raw=True, HTTP_CONTENT_ENCODING='gzip')
+        self.assertIn('compressed chunk', json.loads(response.content)['result']['error'])
+        self.assertFalse(os.path.exists(self.media_path('log.txt')))
+
+
+class CacheStagingBackendTest(PluploadTestCase):
+    """
+    Upload bookkeeping in the Django cache
+    """
+
+    def test_cache_backend(self):
+        backend = staging.CacheStagingBackend()
+        with patched(staging, get_backend=lambda: backend):
+            code = issue_control_code(UPLOAD_TO)
+            data = random_data(3 * CHUNK)
+            self.upload(data, name='cached.bin', code=code, order=[2, 0])
+            self.assertEqual(staging.chunk_status(staging.upload_key(code, 'cached.bin')), (CHUNK, 3, [1]))
+            result = self.upload(data, name='cached.bin', code=code, order=[1])[-1]
+        self.assertEqual(result['finalize'], 'rename')
+        self.assertEqual(self.read_media('cached.bin'), data)
+
+    def test_chunks_counted(self):
+        # chunks are counted, not fetched back for each chunk received, but when a chunk is sent again
+        backend = staging.CacheStagingBackend()
+        fetched = []
+
+        class Cache(object):
+            def get_many(self, keys):
+                fetched.append(len(keys))
+                return cache.get_many(keys)
+
+            def __getattr__(self, name):
+                return getattr(cache, name)
+        with patched(staging, get_backend=lambda: backend, get_cache=lambda alias: Cache()):
+            code = issue_control_code(UPLOAD_TO)
+            data = random_data(4 * CHUNK)
+            results = self.upload(data, name='counted.bin', code=code, order=[0, 1, 2])
+            self.assertEqual(fetched, [])
+            results += self.upload(data, name='counted.bin', code=code, order=[1, 3])
+        self.assertEqual(fetched, [4])
+        self.assertEqual([result['error'] for result in results], [''] * 5)
+        self.assertEqual(self.read_media('counted.bin'), data)
+
+
+class BackgroundFinalizeTest(PluploadTestCase):
+    """
+    Finalize in the background, the result polled through upload_status
+    """
+
+    def test_background_finalize(self):
+        with patched(tokens, SIGNED_CONTROL_CODES=True):
+            code = issue_control_code(UPLOAD_TO)
+            with patched(upload, BACKGROUND_FINALIZE=True):
+                result = self.upload('finalized later', name='later.txt', code=code)[-1]
+            self.assertTrue(result['processing'])
+
+            def finalized():
+                response = self.client.get(reverse('plupload_status'), {'control_code': code, 'file_id': 'later.txt'})
+                return json.loads(response.content)['result']['upload']
+            self.assertTrue(wait_for(finalized))
+            self.assertEqual(finalized()['error'], '')
+        self.assertEqual(self.read_media('later.txt'), 'finalized later')
+
+
+class RateLimitTest(PluploadTestCase):
+    """
+    Chunk requests over the rate limit refused with 429 before their body is read
+    """
+
+    def test_rate_limit(self):
+        params = [('name', 'limited.bin'), ('offset', 0), ('total', 2 * CHUNK),
+                  ('control_code', issue_control_code(UPLOAD_TO)), ('file_id', 'limited.bin')]
+        with patched(admission, RATE_LIMIT=0.01, RATE_LIMIT_BURST=None):
+            self.assertEqual(self.post_chunk(params, random_data(CHUNK)).status_code, 200)
+            response = self.post_chunk(params, random_data(CHUNK))
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) >= 1)
+
+
+class AdaptiveChunkSizeTest(PluploadTestCase):
+    """
+    A chunk size recommended from the measured link of the user
+    """
+
+    def test_recommendation(self):
+        result = self.upload(random_data(2 * CHUNK), name='measured.bin')[0]
+        self.assertTrue(result['recommended_chunk_size'] >= CHUNK)
+
+    def test_chunk_number_protocol(self):
+        # send_chunk_number: true, plupload's default: chunk and chunks, no total
+        data = random_data(2 * CHUNK + 5)
+        code = issue_control_code(UPLOAD_TO)
+        for raw in (False, True):
+            name = 'numbered_%s.bin' % raw
+            for chunk in (1, 0, 2):
+                params = [('name', name), ('chunk', chunk), ('chunks', 3), ('control_code', code), ('file_id', name)]
+                response = self.post_chunk(params, data[chunk * CHUNK:(chunk + 1) * CHUNK], raw=raw)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content)['result']['error'], '')
+            self.assertEqual(self.read_media(name), data)
+
+    def test_empty_file(self):
+        for raw in (False, True):
+            result = self.upload('', name='empty_%s.txt' % raw, raw=raw)[-1]
+            self.assertEqual(result['error'], '')
+            self.assertEqual(self.read_media('empty_%s.txt' % raw), '')
+
+    def test_fast_link(self):
+        request = self.client.request().wsgi_request
+        now = time.time()
+        for i in range(5):
+            chunking.record_chunk(request, CHUNK, now + i, now + i + 0.01)  # 6.4 Mb/s
+        self.assertTrue(chunking.recommend(request, CHUNK) > CHUNK)
+        self.assertEqual(chunking.recommend(request, CHUNK) % chunking.ROUNDING, 0)
+
+
+class AssetsTest(PluploadTestCase):
+    """
+    Widget assets through the staticfiles storage, loaded lazily
+    """
+
+    def test_head_init(self):
+        urls = assets.head_assets()
+        self.assertEqual(urls['scripts'][-1], '/static/plupload/js/django.plupload.js')
+        html = Template('{% load plupload_tags %}{% plupload_head_init %}').render(Context({}))
+        self.assertIn('django_plupload', html)
+        self.assertNotIn('<script type="text/javascript" src="/static/plupload/js/django.plupload.js">', html)
+
+
+class FileInfoTest(PluploadTestCase):
+    """
+    Metadata of the uploaded files recorded in the DB, read in bulk
+    """
+
+    def test_migrations(self):
+        # the models of plupload match its migrations (Document, the test model, has none)
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        changes = MigrationAutodetector(loader.project_state(), ProjectState.from_apps(apps)).changes(loader.graph)
+        operations = [operation for migration in changes.get('plupload', []) for operation in migration.operations]
+        self.assertEqual([operation for operation in operations if getattr(operation, 'name', '') != 'Document'], [])
+
+    @skipIf(Image is None, "Pillow not installed")
+    def test_recorded_with_server_resize(self):
+        # recorded at once when the file doesn't get resized (small images, other files), replacing what was
+        # recorded for a file previously uploaded at the same path
+        PluploadFileInfo.objects.create(path='uploads/small.jpg', size=1, mtime=0)
+        with patched(fileinfo, FILE_INFO=True), patched(upload, FILE_INFO=True), \
+                patched(workers, run_in_background=lambda func, *args: func(*args)):
+            for name, data in (('small.jpg', image_data((100, 100))), ('notes.txt', 'not an image')):
+                self.upload(data, name=name, code=issue_control_code(UPLOAD_TO, resize=(800, 600, 85)))
+                self.assertEqual(PluploadFileInfo.objects.get(path='uploads/' + name).size, len(data))
+        info = PluploadFileInfo.objects.get(path='uploads/small.jpg')
+        self.assertEqual((info.width, info.height, info.content_type), (100, 100, 'image/jpeg'))
+
+    def test_recorded_and_prefetched(self):
+        with patched(fileinfo, FILE_INFO=True), patched(upload, FILE_INFO=True):
+            for i in range(3):
+                self.upload('content %s' % i, name='doc%s.txt' % i)
+            self.assertEqual(PluploadFileInfo.objects.get(path='uploads/doc0.txt').size, len('content 0'))
+            for i in range(3):
+                Document.objects.create(attachment='uploads/doc%s.txt' % i, photos=['uploads/doc0.txt'])
+            with CaptureQueriesContext(connection) as queries:
+                documents = list(Document.objects.prefetch_file_info())
+                sizes = [document.attachment_file.size for document in documents]
+                content_types = [f.content_type for document in documents for f in document.photos_files]
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(sizes, [9, 9, 9])
+        self.assertEqual(content_types, ['text/plain'] * 3)
+
+
+class DownloadTest(PluploadTestCase):
+    """
+    Downloads through the view, with ranges and conditional GET
+    """
+
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.data = ''.join(chr(i % 256) for i in range(1000))
+        with open(self.media_path('download.bin'), 'wb') as f:
+            f.write(self.data)
+        self.document = Document.objects.create(attachment='uploads/download.bin', photos=['uploads/download.bin'],
+                                                private='uploads/download.bin')
+
+    def test_download(self):
+        url = self.document.attachment_file.download_url
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual((response.status_code, response['Content-Range']), (206, 'bytes 100-199/1000'))
+        self.assertEqual(''.join(response.streaming_content), self.data[100:200])
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=2000-').status_code, 416)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_sendfile(self):
+        with patched(download, SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.document.attachment_file.download_url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/uploads/download.bin')
+        self.assertEqual(response.content, '')
+
+    def test_access(self):
+        self.assertEqual(self.client.get(self.document.photos_files[0].download_url).status_code, 403)
+        self.assertEqual(self.document.private_file.download_url, None)
+        self.assertEqual(self.client.get('/download/plupload.document/%s/private/' % self.document.pk).status_code,
+                         404)
+
+    def test_outside_upload_dir(self):
+        with open(os.path.join(settings.MEDIA_ROOT, 'other.bin'), 'wb') as f:
+            f.write(self.data)
+        os.symlink(os.path.join(settings.MEDIA_ROOT, 'other.bin'), self.media_path('link.bin'))
+        for path in ('other.bin', 'uploads/../other.bin', 'uploads/link.bin', '../media/other.bin'):
+            Document.objects.filter(pk=self.document.pk).update(attachment=path)
+            url = Document.objects.get(pk=self.document.pk).attachment_file.download_url
+            self.assertEqual(self.client.get(url).status_code, 404)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from plupload.settings import MEDIA_ROOT, MEDIA_URL, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, THUMBNAIL_DIR
+from plupload import staging, workers
+import mimetypes
+import os
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Thumbnails of uploaded images (show_thumbnail), fitting in THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT, so that forms don't
+download full size pictures just to show a small preview.
+
+They are generated once, by Pillow (if installed) in the background, as soon as the upload is complete, and cached in
+THUMBNAIL_DIR (PLUPLOAD_THUMBNAIL_DIR, relative to MEDIA_ROOT) mirroring the path of the uploaded file. A thumbnail
+older than its image is stale: it is regenerated when needed, and removed when the image is replaced or removed.
+Until a thumbnail is ready the widget shows the image itself. Files that aren't images (by their extension) get no
+thumbnail, and neither do files Pillow failed to read, until they are replaced.
+"""
+
+THUMBNAIL_QUALITY = 85
+
+_failed = {}  # rel_path -> mtime of the file Pillow couldn't read, so that it isn't retried on every render
+
+
+def thumbnail_rel_path(rel_path):
+    """
+    Path of the thumbnail of the uploaded file rel_path, both relative to MEDIA_ROOT
+    """
+    return os.path.join(THUMBNAIL_DIR, '%s.%sx%s.jpg' % (rel_path.lstrip('/'), THUMBNAIL_WIDTH or 0,
+                                                         THUMBNAIL_HEIGHT or 0))
+
+
+def thumbnail_url(rel_path):
+    return os.path.join(MEDIA_URL, thumbnail_rel_path(rel_path))
+
+
+def is_fresh(rel_path):
+    """
+    True if the thumbnail of rel_path exists and is not older than the file itself
+    """
+    try:
+        return (os.stat(os.path.join(MEDIA_ROOT, thumbnail_rel_path(rel_path))).st_mtime >=
+                os.stat(os.path.join(MEDIA_ROOT, rel_path.lstrip('/'))).st_mtime)
+    except OSError:
+        return False
+
+
+def generate(rel_path):
+    """
+    Generates the thumbnail of rel_path. JPEGs are decoded in draft mode, straight at the smallest scale that's still
+    larger than the thumbnail, so large pictures are never decoded at full size. Returns False, and remembers it, if
+    Pillow can't read the file
+    """
+    size = (THUMBNAIL_WIDTH or 100000, THUMBNAIL_HEIGHT or 100000)
+    source = os.path.join(MEDIA_ROOT, rel_path.lstrip('/'))
+    try:
+        image = Image.open(source)
+        image.draft('RGB', size)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.thumbnail(size, Image.ANTIALIAS)
+    except IOError:  # not an image Pillow can read, or truncated
+        try:
+            _failed[rel_path] = os.stat(source).st_mtime
+        except OSError:
+            pass
+        return False
+    path = os.path.join(MEDIA_ROOT, thumbnail_rel_path(rel_path))
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(prefix='.plupload.', dir=os.path.dirname(path))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            image.save(f, 'JPEG', quality=THUMBNAIL_QUALITY)
+        finally:
+            f.close()
+        os.chmod(tmp_path, 0644)
+        staging.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def invalidate(rel_path):
+    """
+    Removes the thumbnail of rel_path, i.e. when the file is replaced or removed
+    """
+    try:
+        os.remove(os.path.join(MEDIA_ROOT, thumbnail_rel_path(rel_path)))
+    except OSError:
+        pass
+
+
+def can_have_thumbnail(rel_path):
+    """
+    False for files that aren't images by their extension, or that Pillow couldn't read (unless replaced since)
+    """
+    mimetype = mimetypes.guess_type(rel_path)[0]
+    if not mimetype or not mimetype.startswith('image/'):
+        return False
+    if rel_path in _failed:
+        try:
+            if os.stat(os.path.join(MEDIA_ROOT, rel_path.lstrip('/'))).st_mtime == _failed[rel_path]:
+                return False
+        except OSError:
+            return False
+        _failed.pop(rel_path, None)
+    return True
+
+
+def schedule(rel_path):
+    """
+    Queues the generation of the thumbnail of rel_path, unless a fresh one already exists. Returns False if no
+    thumbnail can be generated: Pillow not installed, not an image, or Pillow already failed to read this version of it
+    """
+    if Image is None or not can_have_thumbnail(rel_path):
+        return False
+    if not is_fresh(rel_path):
+        workers.run_in_background(generate, rel_path)
+    return True
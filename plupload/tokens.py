@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from django.core import signing
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from django.utils.translation import ugettext_lazy as _
+from plupload.settings import SIGNED_CONTROL_CODES, CONTROL_CODE_TTL, TRACK_UPLOADS
+import datetime
+import os
+
+
+"""
+Control codes tie each upload to the widget that was rendered for it: they tell the upload view where to put the file.
+
+By default a control code is a random string saved in the DB (PluploadControlCode), looked up on every chunk. With
+PLUPLOAD_SIGNED_CONTROL_CODES = True the control code is instead a signed, timestamped token carrying upload_to and the
+field limits: it is verified (in constant time, by django.core.signing) without any DB access.
+"""
+
+SALT = 'plupload.control_code'
+
+
+class InvalidControlCode(Exception):
+    pass
+
+
+class UploadTicket(object):
+    """
+    What the upload view knows about a valid control code: where the file goes and the limits to enforce
+    """
+
+    def __init__(self, code, upload_to, max_file_size=None, extensions=None, deduplicate=False, resize=None,
+                 control_code=None, nonce=None):
+        self.code = code
+        self.nonce = nonce  # signed control codes only
+        self.upload_to = upload_to or ''
+        self.max_file_size = max_file_size  # Mb
+        self.extensions = extensions
+        self.deduplicate = deduplicate  # content addressed storage, see plupload.dedup
+        self.resize = resize  # (width, height, quality) for server side resize, see plupload.resize
+        self.control_code = control_code  # PluploadControlCode instance, DB control codes only
+
+    def check_limits(self, filename, size):
+        """
+        Returns an error message if the file breaks the limits carried by the control code, None otherwise
+        """
+        if self.extensions:
+            ext = os.path.splitext(filename)[1].lstrip('.').lower()
+            if ext not in [x.strip().lower() for x in self.extensions if x]:
+                return _(u"file extension not allowed")
+        if self.max_file_size and size > float(self.max_file_size) * 1048576:
+            return _(u"file too large")
+        return None
+
+    def upload_done(self, key=None):
+        """
+        Records a completed upload, key being the upload key (a control code can upload several files)
+        """
+        from plupload.models import PluploadControlCode
+        if self.control_code is not None:
+            if not self.control_code.upload_done:
+                self.control_code.upload_done = True
+                self.control_code.save()
+        elif TRACK_UPLOADS:
+            PluploadControlCode.objects.create(code='%s.%s' % (self.nonce, key) if key else self.nonce,
+                                               upload_to=self.upload_to, upload_done=True)
+
+
+def issue_control_code(upload_to, max_file_size=None, extensions=None, deduplicate=False, resize=None):
+    """
+    Returns a new control code for a widget uploading to upload_to. resize is (width, height, quality) if uploaded
+    images have to be resized on the server
+    """
+    from plupload.models import PluploadControlCode
+    if SIGNED_CONTROL_CODES:
+        return signing.dumps({
+            'n': get_random_string(12),  # makes each token unique, uploads are keyed by control code
+            'u': upload_to,
+            's': max_file_size,
+            'e': list(extensions) if extensions else None,
+            'd': bool(deduplicate),
+            'r': list(resize) if resize else None,
+        }, salt=SALT, compress=True)
+    control_code = PluploadControlCode()
+    control_code.upload_to = upload_to
+    control_code.deduplicate = bool(deduplicate)
+    if resize:
+        control_code.resize_width, control_code.resize_height, control_code.resize_quality = resize
+    control_code.save()
+    return control_code.code
+
+
+def resolve_control_code(code):
+    """
+    Returns the UploadTicket for code, raises InvalidControlCode if code is wrong or expired
+    """
+    from plupload.models import PluploadControlCode
+    if SIGNED_CONTROL_CODES:
+        try:
+            data = signing.loads(code, salt=SALT, max_age=CONTROL_CODE_TTL)
+        except signing.SignatureExpired:
+            raise InvalidControlCode(_(u"expired control code"))
+        except signing.BadSignature:
+            raise InvalidControlCode(_(u"wrong control code"))
+        return UploadTicket(code, data.get('u'), max_file_size=data.get('s'), extensions=data.get('e'),
+                            deduplicate=data.get('d', False), resize=data.get('r'), nonce=data.get('n'))
+    try:
+        control_code = PluploadControlCode.objects.get(
+            code=code, date__gte=timezone.now() - datetime.timedelta(seconds=CONTROL_CODE_TTL)
+        )
+    except PluploadControlCode.DoesNotExist:
+        raise InvalidControlCode(_(u"wrong control code"))
+    resize = None
+    if control_code.resize_width or control_code.resize_height:
+        resize = (control_code.resize_width, control_code.resize_height, control_code.resize_quality)
+    return UploadTicket(code, control_code.upload_to, deduplicate=control_code.deduplicate, resize=resize,
+                        control_code=control_code)
@@ -1,23 +1,217 @@
 # -*- coding: utf-8 -*-
 from django.template import RequestContext
-from plupload.settings import MEDIA_ROOT, MEDIA_URL, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT
-from plupload.models import PluploadControlCode
+from plupload.settings import MEDIA_ROOT, MEDIA_URL, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, BACKGROUND_FINALIZE, FILE_INFO
+from plupload.tokens import resolve_control_code, InvalidControlCode
 from plupload.forms import PluploadForm
-from django.http import HttpResponse
+from plupload.compression import DecompressionError
+from plupload.handlers import PluploadUploadHandler, StagedChunk, stage_chunk
+from plupload import (admission, chunking, compression, dedup, fileinfo, hashing, metrics, resize, signals, staging,
+                      thumbnails, workers)
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.shortcuts import render_to_response
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
-import tempfile
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from functools import wraps
 import os
-import shutil
 import json
+import math
+import time
 
 
-def do_upload(request):
+def json_response(resp):
+    """
+    JSON-RPC response for plupload, never cached; lazy translations are rendered to text
+    """
+    response = HttpResponse(json.dumps(resp, default=force_unicode), content_type='application/json; charset=UTF-8')
+    response['Expires'] = 'Mon, 1 Jan 2000 01:00:00 GMT'
+    response['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'
+    response['Pragma'] = 'no-cache'
+    return response
+
+
+def failed(request, resp, error):
     """
-    This function is called once for each chunk the file is divided into. It uploads the file, chunk by chunk to a
-    temp file, then copies it to its final position. It doesn't resize the image, that's done by plupload client-side
+    Error response of the upload view, the error goes to widget.html -> FileUploaded
+    """
+    resp['result']['error'] = error
+    metrics.count('uploads_failed')
+    timer = metrics.current()
+    signals.upload_failed.send(sender=do_upload, request=request, error=error,
+                               timings=dict(timer.timings) if timer else {})
+    return json_response(resp)
+
+
+def upload_metrics(request):
+    """
+    Upload metrics of the process serving the request, in the Prometheus text format (see plupload.metrics)
+    """
+    return HttpResponse(metrics.prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def upload_status(request):
+    """
+    Returns the chunks of an upload still missing on the server, given the control code and the file id used to upload
+    it, so that the widget can resume an interrupted upload (after a retry or a page reload) skipping the chunks
+    already stored. result.chunks is 0 if nothing has been received yet.
+    With PLUPLOAD_BACKGROUND_FINALIZE, result.processing is true while the upload is being finalized, then
+    result.upload is what the response of the last chunk would have been. result.recommended_chunk_size is the chunk
+    size for the next upload of the user (see plupload.chunking)
     """
     resp = {
+        "jsonrpc": "2.0",
+        "result": {
+            "chunks": 0,
+            "chunk_size": 0,
+            "missing": [],
+            "processing": False,
+            "upload": None,
+            "error": "",
+        },
+        "id": "id",
+    }
+    code = request.REQUEST.get('control_code')
+    file_id = request.REQUEST.get('file_id')
+    if not code or not file_id:
+        resp['result']['error'] = _(u"No control code or file id provided")
+        return json_response(resp)
+    try:
+        resolve_control_code(code)
+    except InvalidControlCode, err:
+        resp['result']['error'] = err.args[0]
+        return json_response(resp)
+    key = staging.upload_key(code, file_id)
+    try:
+        status = staging.chunk_status(key)
+        upload = staging.upload_result(key)
+    except (IOError, OSError), err:
+        resp['result']['error'] = _(u"Server error, unable to read upload status: %s") % err
+        return json_response(resp)
+    if status:
+        resp['result']['chunk_size'], resp['result']['chunks'], resp['result']['missing'] = status
+    resp['result']['recommended_chunk_size'] = chunking.recommend(request)
+    if upload is not None:
+        resp['result']['processing'] = upload.get('processing', False)
+        if not resp['result']['processing']:
+            resp['result']['upload'] = upload
+    return json_response(resp)
+
+
+def throttled(request, err):
+    """
+    Response to a chunk request refused by the rate limits (see plupload.admission): status 429 and a Retry-After
+    header, the widget retries the chunk later
+    """
+    resp = new_response()
+    resp['result']['error'] = err.args[0]
+    resp['result']['retry_after'] = err.retry_after
+    metrics.count('requests_throttled')
+    response = json_response(resp)
+    response.status_code = 429
+    response['Retry-After'] = str(int(math.ceil(err.retry_after)))
+    return response
+
+
+def rate_limited(view):
+    """
+    Checks the limits of chunk requests (see plupload.admission.admit_request) before the view reads the body
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return view(request, *args, **kwargs)
+        try:
+            admission.admit_request(request)
+        except admission.Throttled, err:
+            return throttled(request, err)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            admission.release_request(request)
+    return wrapper
+
+
+@csrf_exempt
+@rate_limited
+def do_upload(request):
+    """
+    This function is called once for each chunk the file is divided into. It writes each chunk at its own offset into
+    a staging file, then moves it to its final position once all the chunks have been received: chunks may come in any
+    order, several at a time. Images are resized by plupload client-side (and on the server too, in the background,
+    with PLUPLOAD_SERVER_RESIZE).
+    PluploadUploadHandler streams the chunk into the staging file while the request is parsed: it has to be installed
+    before the CSRF check reads request.POST, that's why CSRF protection is applied afterwards, in _do_upload.
+    Each phase of the request is timed (see plupload.metrics), timings are sent back in the Server-Timing header
+    """
+    request.upload_handlers.insert(0, PluploadUploadHandler(request))
+    staging.start_sweeper()  # with PLUPLOAD_STAGING_SWEEP_INTERVAL, abandoned uploads are removed in the background
+    timer = metrics.start()
+    try:
+        with metrics.phase('parse'):
+            request.POST  # parsing the body (and streaming the chunk to disk), before the CSRF check does
+        response = _do_upload(request)
+    finally:
+        metrics.stop()
+    response['Server-Timing'] = timer.server_timing()
+    return response
+
+
+def raw_params(request):
+    """
+    Parameters of a raw chunk upload: the query string (where plupload puts them with multipart: false), and
+    X-Plupload-* headers (X-Plupload-Control-Code -> control_code), if a client prefers to send them that way. A
+    Content-Encoding header is the content_encoding of a compressed chunk
+    """
+    params = request.GET.copy()
+    for header, value in request.META.items():
+        if header.startswith('HTTP_X_PLUPLOAD_'):
+            params[header[len('HTTP_X_PLUPLOAD_'):].lower()] = value
+    if request.META.get('HTTP_CONTENT_ENCODING') and 'content_encoding' not in params:
+        params['content_encoding'] = request.META['HTTP_CONTENT_ENCODING']
+    return params
+
+
+@csrf_exempt
+@rate_limited
+def do_upload_raw(request):
+    """
+    Chunk upload view for the widget sending chunks as raw request bodies (multipart: false, see PLUPLOAD_MULTIPART):
+    application/octet-stream content, parameters in the query string. The body is streamed straight into the staging
+    file, there's no multipart parsing and no form to validate, then the chunk goes through upload_chunk like the
+    chunks of do_upload. CSRF protection is applied afterwards, in _do_upload_raw, like in do_upload
+    """
+    staging.start_sweeper()
+    timer = metrics.start()
+    try:
+        response = _do_upload_raw(request)
+    finally:
+        metrics.stop()
+    response['Server-Timing'] = timer.server_timing()
+    return response
+
+
+@csrf_protect
+def _do_upload_raw(request):
+    resp = new_response()
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    params = raw_params(request)
+    if not params.get('name'):
+        return failed(request, resp, _(u"No files uploaded: no file name provided"))
+    content_length = admission.content_length(request)
+    if content_length is None:
+        return failed(request, resp, _(u"No files uploaded: invalid Content-Length"))
+    with metrics.phase('parse'):
+        # reading the body, straight to the staging file
+        body = iter(lambda: request.read(PluploadUploadHandler.chunk_size), b'')
+        uploaded_file = stage_chunk(request, params, params['name'], request.META.get('CONTENT_TYPE', ''), body,
+                                    content_length)
+    return upload_chunk(request, resp, params, uploaded_file)
+
+
+def new_response():
+    return {
         "jsonrpc": "2.0",
         "result": {
             "filename": "",
@@ -26,132 +220,262 @@ def do_upload(request):
         },
         "id": "id",
     }
+
+
+@csrf_protect
+def _do_upload(request):
+    resp = new_response()
     if request.method == 'POST':
         form = PluploadForm(request.POST, request.FILES)
-        if form.is_valid():
-            show_thumbnail = request.POST.get('show_thumbnail', None)  # from widget.html > multipart_params
-            upload_chmod = request.POST.get('upload_chmod', None)  # from widget.html > multipart_params
+        with metrics.phase('validate'):
+            valid = form.is_valid()
+        if valid:
             uploaded_file = request.FILES.get('file')
             if uploaded_file:
-                chunk = request.REQUEST.get('chunk', '0')
-                chunks = request.REQUEST.get('chunks', '0')
-                filename = request.REQUEST.get('name', '')
-                plupload_tmp = request.session.get('plupload_tmp')
-                # checking control code
-                code = request.POST.get('control_code')
-                if code:
-                    try:
-                        control_code = PluploadControlCode.objects.get(code=code)
-                    except PluploadControlCode.DoesNotExist:
-                        resp['result']['error'] = _(u"No files uploaded: wrong control code")
-                        # this goes to pluploader_init.html -> init, FileUploaded
-                        return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                else:
-                    resp['result']['error'] = _(u"No files uploaded: no control code provided")
-                    # this goes to pluploader_init.html -> init, FileUploaded
-                    return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                upload_path = os.path.join(MEDIA_ROOT, control_code.upload_to)
-                upload_url = os.path.join(MEDIA_URL, control_code.upload_to)
-                if not filename:
-                    filename = uploaded_file.name
-                f = None
-                if chunk == '0':
-                    # uploading first chunk of the file, creating a temporary file to host it
-                    try:
-                        f = tempfile.NamedTemporaryFile(mode='wb+', delete=False)  # delete parameter on python >= 2.6
-                        plupload_tmp = request.session['plupload_tmp'] = f.name
-                    except TypeError:
-                        # python <= 2.5
-                        # f = tempfile.NamedTemporaryFile(mode = 'wb+')  # deleted as soon as it is closed, python < 2.6
-                        try:
-                            fd, fpath = tempfile.mkstemp(prefix=filename + '.')  # fd = int
-                            os.chmod(fpath, 640)
-                            os.close(fd)
-                            plupload_tmp = request.session['plupload_tmp'] = fpath
-                            f = open(plupload_tmp, 'ab+')
-                        except Exception, err:
-                            resp['result']['error'] = _(u"Server error, creating temporary file: %s") % err
-                            return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                    except Exception, err:
-                        resp['result']['error'] = _(u"Server error, creating temporary file: %s") % err
-                        return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                elif plupload_tmp:
-                    # uploading other chunks
-                    try:
-                        f = open(plupload_tmp, 'ab+')
-                    except IOError:
-                        resp['result']['error'] = _(u"Unable to (re)open temporary file for upload, chunk %s") % chunk
-                        return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                if f:
-                    # writing the chunk to the temporary file
-                    for content in uploaded_file.chunks():
-                        try:
-                            f.write(content)
-                        except IOError:
-                            resp['result']['error'] = _(u"Unable to write to temporary file, chunk %s") % chunk
-                            return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                    f.close()
-                if int(chunk) + 1 >= int(chunks):
-                    # upload done, all chunks uploaded, copying to final position, removing temp file
-                    if plupload_tmp:
-                        request.session.pop('plupload_tmp')
-                        dest_path = os.path.join(upload_path, filename)
-                        try:
-                            shutil.copy(plupload_tmp, dest_path)
-                        except IOError:
-                            resp['result']['error'] = _(u"Unable to copy temporary file to its final position")
-                            return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                        except Exception, err:
-                            resp['result']['error'] = _(
-                                u"Server error, unable to copy temporary file to its final destination: %s"
-                            ) % err
-                            return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                        if upload_chmod:
-                            # attempting chmod
-                            try:
-                                os.chmod(dest_path, int(upload_chmod, 8))  # converting upload_chmod to octal number
-                            except Exception, err:
-                                resp['result']['error'] = _(
-                                    u"Server error, unable to change permissions to uploadded file: %s"
-                                ) % err
-                                return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                        try:
-                            os.remove(plupload_tmp)
-                        except Exception, err:
-                            resp['result']['error'] = _(u"Server error, unable to remove temporary file: %s") % err
-                            return HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                    control_code.upload_done = True
-                    control_code.save()
-                if show_thumbnail:
-                    # showing a thumbnail of the uploaded file in the message (obviously works just with images)
-                    wh = ''
-                    if THUMBNAIL_WIDTH or THUMBNAIL_HEIGHT:
-                        wh = ' style=\"'
-                        if THUMBNAIL_WIDTH:
-                            wh += 'width:%spx;' % THUMBNAIL_WIDTH
-                        if THUMBNAIL_HEIGHT:
-                            wh += 'height:%spx;' % THUMBNAIL_HEIGHT
-                        wh += '\"'
-                    current_file_html = '<a href=\"%s\" target=\"_blank\"><img src=\"%s\" alt=\"%s\"%s/></a>' % (
-                        os.path.join(upload_url, filename), os.path.join(upload_url, filename), filename, wh)
-                else:
-                    # showing an anchor with the filename
-                    current_file_html = '<a href=\"%s\" target=\"_blank\">%s</a>' % (
-                        os.path.join(upload_url, filename), filename)
-                resp['result']['filename'] = filename
-                resp['result']['msg'] = _(u"Done. File uploaded: %s") % current_file_html
-
-                response = HttpResponse(json.dumps(resp), content_type='application/json; charset=UTF-8')
-                response['Expires'] = 'Mon, 1 Jan 2000 01:00:00 GMT'
-                response['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'
-                response['Pragma'] = 'no-cache'
-                return response
+                return upload_chunk(request, resp, request.REQUEST, uploaded_file)
             else:
-                resp['result']['error'] = _(u"Uploaded file missing.")
-                return response
+                return failed(request, resp, _(u"Uploaded file missing."))
         else:
             # invalid form
             pass
     else:
         form = PluploadForm()
     return render_to_response('plupload/form.html', {'form': form}, context_instance=RequestContext(request))
+
+
+def upload_chunk(request, resp, params, uploaded_file):
+    """
+    Stores a chunk, given the request parameters (from widget.html: control_code, file_id, name, offset and total, and
+    show_thumbnail, upload_chmod) and the uploaded file (a StagedChunk if PluploadUploadHandler or the raw upload view
+    has already written it to the staging file), finalizes the upload once all its chunks have been received. Returns
+    the JSON-RPC response
+    """
+    show_thumbnail = params.get('show_thumbnail', None)  # from widget.html > multipart_params
+    upload_chmod = params.get('upload_chmod', None)  # from widget.html > multipart_params
+    filename = params.get('name', '')
+    file_id = params.get('file_id', '') or filename  # from widget.html > BeforeUpload
+    # checking control code (already resolved if the chunk has been staged by PluploadUploadHandler)
+    code = params.get('control_code')
+    staged = isinstance(uploaded_file, StagedChunk) and uploaded_file.staged
+    if code:
+        try:
+            with metrics.phase('lookup'):
+                ticket = uploaded_file.ticket if staged else resolve_control_code(code)
+        except InvalidControlCode, err:
+            return failed(request, resp, _(u"No files uploaded: %s") % err.args[0])
+    else:
+        return failed(request, resp, _(u"No files uploaded: no control code provided"))
+    try:
+        chunk, chunks, chunk_size, offset, total_size = staging.get_chunk_position(params)
+    except ValueError:
+        return failed(request, resp, _(u"No files uploaded: invalid chunk parameters"))
+    if not filename:
+        filename = uploaded_file.name
+    # just the name, the file goes to upload_to
+    filename = os.path.basename(filename.replace('\\', '/'))
+    if filename in ('', '.', '..'):
+        return failed(request, resp, _(u"No files uploaded: invalid file name"))
+    limits_error = ticket.check_limits(filename, total_size or offset + uploaded_file.size)
+    if limits_error:
+        return failed(request, resp, _(u"No files uploaded: %s") % limits_error)
+    try:
+        encoding = compression.normalize_encoding(params.get('content_encoding'))  # compressed chunk
+    except DecompressionError, err:
+        return failed(request, resp, _(u"No files uploaded: %s") % err.args[0])
+    if encoding and not total_size:
+        return failed(request, resp, _(u"No files uploaded: compressed chunks need the 'total' parameter"))
+    # uploads are keyed by control code and file id, each chunk is written at its own offset into a staging
+    # file preallocated to the total size: chunks can come in any order, even at the same time
+    key = staging.upload_key(code, file_id)
+    if isinstance(uploaded_file, StagedChunk) and uploaded_file.rejected:
+        rejected = uploaded_file.rejected
+    elif not staged:
+        rejected = admission.check_upload(request, key, total_size or offset + uploaded_file.size)
+    else:
+        rejected = None
+    if rejected:
+        return failed(request, resp, _(u"No files uploaded: %s") % rejected)
+    if isinstance(uploaded_file, StagedChunk):
+        # the handler wrote the chunk to the staging file while parsing the request
+        if not staged or uploaded_file.key != key or uploaded_file.offset != offset:
+            return failed(request, resp, _(u"Unable to write to temporary file, chunk %s") % chunk)
+    else:
+        content = uploaded_file.chunks()
+        if encoding:
+            content = compression.decompress(content, encoding,
+                                             compression.chunk_length(chunk_size, offset, total_size))
+        try:
+            # writing the chunk to the temporary file
+            staging.store_chunk(key, offset, total_size, content)
+        except DecompressionError, err:
+            return failed(request, resp, _(u"No files uploaded: %s") % err.args[0])
+        except (IOError, OSError):
+            return failed(request, resp, _(u"Unable to write to temporary file, chunk %s") % chunk)
+    try:
+        with metrics.phase('mark'):
+            upload_complete = (staging.mark_chunk_received(key, chunk, chunks, chunk_size) and
+                               staging.claim_finalize(key))
+    except OSError:
+        return failed(request, resp, _(u"Unable to write to temporary file, chunk %s") % chunk)
+    metrics.count('chunks_received')
+    metrics.count('bytes_received', uploaded_file.size)
+    # the chunk size of a chunked upload, uncompressed; without 'total' (chunk and chunks sent instead, or an empty
+    # file) the size received, compressed chunks require 'total'
+    length = compression.chunk_length(chunk_size, offset, total_size) if total_size else uploaded_file.size
+    if chunk_size and length == chunk_size:
+        # full chunks measure the link of the user, a short last chunk would mostly measure latency
+        chunking.record_chunk(request, admission.content_length(request) or uploaded_file.size,
+                              metrics.current().start, time.time())
+    resp['result']['recommended_chunk_size'] = chunking.recommend(request, chunk_size)
+    signals.chunk_received.send(sender=do_upload, request=request, chunk=chunk, chunks=chunks,
+                                size=uploaded_file.size, timings=dict(metrics.current().timings))
+    if upload_complete:
+        admission.release_upload(request, key)
+        size = total_size or offset + uploaded_file.size
+        checksum = params.get('checksum')  # optional, '<algorithm>:<hex digest>'
+        if BACKGROUND_FINALIZE:
+            # not waiting for it: the widget polls upload_status until the upload is finalized
+            staging.set_upload_result(key, {'processing': True})
+            workers.run_in_background(finalize_in_background, request, key, ticket, filename, size, checksum,
+                                      upload_chmod, show_thumbnail)
+            resp['result']['processing'] = True
+            resp['result']['filename'] = filename
+            resp['result']['msg'] = _(u"Processing the uploaded file...")
+            return json_response(resp)
+        try:
+            resp['result'].update(finalize_upload(request, key, ticket, filename, size, checksum, upload_chmod))
+        except FinalizeError, err:
+            return failed(request, resp, err.args[0])
+    resp['result']['filename'] = filename
+    resp['result']['msg'] = _(u"Done. File uploaded: %s") % uploaded_file_html(ticket, filename, show_thumbnail,
+                                                                               upload_complete)
+    return json_response(resp)
+
+
+class FinalizeError(Exception):
+    pass
+
+
+def destination(ticket, filename):
+    """
+    Final path of the uploaded file filename, None if it isn't a file name or the path isn't under the upload_to
+    directory of the ticket (i.e. '../../evil.txt', or a symlink)
+    """
+    filename = os.path.basename(filename)
+    if filename in ('', '.', '..'):
+        return None
+    upload_dir = os.path.join(MEDIA_ROOT, ticket.upload_to or '')
+    dest_path = os.path.join(upload_dir, filename)
+    if not os.path.realpath(dest_path).startswith(os.path.join(os.path.realpath(upload_dir), '')):
+        return None
+    return dest_path
+
+
+def finalize_upload(request, key, ticket, filename, size, checksum=None, upload_chmod=None):
+    """
+    Once all the chunks have been received: checks digests, moves the staging file to its final position. Returns the
+    results to add to the response ('checksums', 'finalize', 'resize'), raises FinalizeError with the error message
+    """
+    result = {}
+    try:
+        # just what hasn't been hashed while writing the chunks is read from disk
+        with metrics.phase('hash'):
+            result['checksums'] = workers.run_blocking(hashing.digests, key, staging.staging_path(key))
+    except (IOError, OSError), err:
+        staging.discard(key)
+        raise FinalizeError(_(u"Server error, unable to compute checksums: %s") % err)
+    if checksum and not hashing.check_checksum(checksum, result['checksums']):
+        staging.discard(key)
+        raise FinalizeError(_(u"Upload failed: checksum mismatch, the file got corrupted"))
+    dest_path = destination(ticket, filename)
+    if dest_path is None:
+        staging.discard(key)
+        raise FinalizeError(_(u"Upload failed: invalid file name"))
+    digest = result['checksums'].get('sha256')
+    try:
+        with metrics.phase('finalize'):
+            if ticket.deduplicate and digest:
+                # content addressed storage: dest_path is a link to the blob, stored just once
+                result['finalize'] = workers.run_blocking(dedup.store, key, digest, dest_path)
+            else:
+                # 'rename' or the copy method
+                result['finalize'] = workers.run_blocking(staging.finalize, key, dest_path)
+    except (IOError, OSError):
+        raise FinalizeError(_(u"Unable to copy temporary file to its final position"))
+    except Exception, err:
+        raise FinalizeError(_(u"Server error, unable to copy temporary file to its final destination: %s") % err)
+    with metrics.phase('cleanup'):
+        staging.discard(key)
+    if upload_chmod and not (ticket.deduplicate and dedup.is_linked(dest_path)):
+        # attempting chmod, but not on deduplicated files: the mode belongs to the blob, shared by other uploads
+        try:
+            with metrics.phase('chmod'):
+                os.chmod(dest_path, int(upload_chmod, 8))  # converting upload_chmod to octal number
+        except Exception, err:
+            raise FinalizeError(_(u"Server error, unable to change permissions to uploadded file: %s") % err)
+    thumbnails.invalidate(os.path.join(ticket.upload_to, filename))  # the file might have been replaced
+    if FILE_INFO:
+        # replacing what was recorded for a file previously uploaded to the same path
+        with metrics.phase('metadata'):
+            info = workers.run_blocking(fileinfo.read_metadata, os.path.join(ticket.upload_to, filename),
+                                        result['checksums'])
+            if info is not None:
+                fileinfo.save(info)
+    if ticket.resize:
+        # resize_to enforced on the server too, in the process pool: the response doesn't wait for it (the metadata
+        # of the file are recorded again if it gets resized)
+        result['resize'] = resize.schedule(dest_path, *ticket.resize, callback=fileinfo.refresh if FILE_INFO else None)
+    with metrics.phase('track'):
+        ticket.upload_done(key)
+    metrics.count('uploads_completed')
+    timer = metrics.current()
+    signals.upload_complete.send(sender=do_upload, request=request, path=dest_path, size=size,
+                                 timings=dict(timer.timings) if timer else {})
+    return result
+
+
+def finalize_in_background(request, key, ticket, filename, size, checksum, upload_chmod, show_thumbnail):
+    """
+    finalize_upload run by a background thread (PLUPLOAD_BACKGROUND_FINALIZE): the result, what the response of the
+    last chunk would have been, is kept by the staging backend for upload_status
+    """
+    resp = new_response()
+    try:
+        try:
+            resp['result'].update(finalize_upload(request, key, ticket, filename, size, checksum, upload_chmod))
+        except FinalizeError, err:
+            failed(request, resp, err.args[0])
+        else:
+            resp['result']['filename'] = filename
+            resp['result']['msg'] = _(u"Done. File uploaded: %s") % uploaded_file_html(ticket, filename,
+                                                                                       show_thumbnail, True)
+        staging.set_upload_result(key, resp['result'])
+    finally:
+        connection.close()  # this thread's own connection
+
+
+def uploaded_file_html(ticket, filename, show_thumbnail, complete):
+    """
+    The uploaded file in the message of the response: an anchor with the filename, or a thumbnail
+    """
+    upload_url = os.path.join(MEDIA_URL, ticket.upload_to)
+    if show_thumbnail:
+        # showing a thumbnail of the uploaded file in the message (obviously works just with images): it is
+        # generated in the background, until it is ready the image itself is shown
+        src = os.path.join(upload_url, filename)
+        if complete and thumbnails.schedule(os.path.join(ticket.upload_to, filename)):
+            src = thumbnails.thumbnail_url(os.path.join(ticket.upload_to, filename))
+        wh = ''
+        if THUMBNAIL_WIDTH or THUMBNAIL_HEIGHT:
+            wh = ' style=\"'
+            if THUMBNAIL_WIDTH:
+                wh += 'max-width:%spx;' % THUMBNAIL_WIDTH
+            if THUMBNAIL_HEIGHT:
+                wh += 'max-height:%spx;' % THUMBNAIL_HEIGHT
+            wh += '\"'
+        return (
+            '<a href=\"%s\" target=\"_blank\"><img src=\"%s\" alt=\"%s\"%s'
+            ' onerror=\"this.onerror=null;this.src=\'%s\';\"/></a>'
+        ) % (os.path.join(upload_url, filename), src, filename, wh, os.path.join(upload_url, filename))
+    # showing an anchor with the filename
+    return '<a href=\"%s\" target=\"_blank\">%s</a>' % (os.path.join(upload_url, filename), filename)
@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls import patterns, url
-from plupload.upload import do_upload
+from plupload.settings import METRICS
+from plupload.download import download
+from plupload.upload import do_upload, do_upload_raw, upload_status, upload_metrics
 
 urlpatterns = patterns(
     '',
     url(r'^upload/$', do_upload, name='plupload'),
+    url(r'^upload/raw/$', do_upload_raw, name='plupload_raw'),
+    url(r'^upload/status/$', upload_status, name='plupload_status'),
+    url(r'^download/(?P<model>\w+\.\w+)/(?P<pk>[^/]+)/(?P<field_name>\w+)/(?:(?P<index>\d+)/)?$', download,
+        name='plupload_download'),
 )
+
+if METRICS:
+    urlpatterns += patterns(
+        '',
+        url(r'^metrics/$', upload_metrics, name='plupload_metrics'),
+    )
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.utils.translation import ugettext_lazy as _
+import json
 import re
 from types import StringType, IntType
 
@@ -27,3 +28,21 @@ def split_resize_to(resize_to):
             width, height = (int(resize_to), int(resize_to))
         assert resize_to == '' or resize_to > 0, _("Resize parameters must be positive numbers")
     return (width, height)
+
+
+def split_paths(value):
+    """
+    The list of uploaded files of a multi-file field, given a list, a JSON list (the widget input) or a string with a
+    path per line (the DB column)
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [path for path in value if path]
+    value = value.strip()
+    if value.startswith('['):
+        try:
+            return [path for path in json.loads(value) if path]
+        except ValueError:
+            pass
+    return [path.strip() for path in value.splitlines() if path.strip()]
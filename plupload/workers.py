@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import Pool, ThreadPool
+from plupload.settings import IO_THREADS, BACKGROUND_THREADS, PROCESSES
+import logging
+import threading
+
+
+"""
+Running blocking work out of the request handling (green) thread.
+
+Django (up to 1.8) has no async views: to keep thousands of slow clients uploading chunks at the same time, serve the
+upload view with green thread workers (i.e. gunicorn -k gevent or -k eventlet), where each request in flight costs a
+greenlet instead of an OS thread and reading the request body yields to the other requests while waiting for the
+client. Disk I/O though doesn't yield: a slow write would stall every request of the worker. run_blocking hands it to
+a bounded pool of real OS threads (PLUPLOAD_IO_THREADS) when the server runs green threads, and just calls it
+otherwise.
+
+Work that doesn't need to complete before responding (i.e. generating thumbnails) is queued with run_in_background, to
+its own pool of PLUPLOAD_BACKGROUND_THREADS OS threads, so that it never takes the threads of run_blocking from the
+requests; CPU bound work (i.e. resizing images) with run_in_process, so it doesn't hold the GIL of the worker serving
+requests.
+"""
+
+logger = logging.getLogger('plupload')
+
+
+def _gevent_hub():
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('socket'):
+        return None
+    hub = get_hub()
+    if hub.threadpool.maxsize != IO_THREADS:
+        hub.threadpool.maxsize = IO_THREADS
+    return hub
+
+
+def _eventlet_tpool():
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return None
+    if not patcher.is_monkey_patched('socket'):
+        return None
+    return tpool  # its size is set by the EVENTLET_THREADPOOL_SIZE environment variable
+
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) in a real OS thread if running green threads (gevent or eventlet, monkey patched),
+    waiting for the result without blocking the other green threads; calls it straight away otherwise
+    """
+    if IO_THREADS:
+        hub = _gevent_hub()
+        if hub is not None:
+            return hub.threadpool.apply(func, args, kwargs)
+        tpool = _eventlet_tpool()
+        if tpool is not None:
+            return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+_pool = None
+_green_pool = None
+_pool_lock = threading.Lock()
+
+
+def _run_logged(func, args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("plupload background task %r failed", func)
+
+
+class OSThreadPool(object):
+    """
+    size OS threads running the tasks of a queue (spawn, like the gevent ThreadPool), given the threading and Queue
+    modules to use: the original ones under eventlet (monkey patched, they would make green threads)
+    """
+
+    def __init__(self, size, threading_module, queue_module):
+        self.queue = queue_module.Queue()
+        for i in xrange(size):
+            thread = threading_module.Thread(target=self.work, name='plupload-background-%s' % i)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            func, args = self.queue.get()
+            func(*args)
+
+    def spawn(self, func, *args):
+        self.queue.put((func, args))
+
+
+def _get_green_pool(gevent):
+    """
+    The pool of background threads when running green threads: not the threads of run_blocking (hub.threadpool,
+    eventlet.tpool), so background work never delays the disk I/O of the requests
+    """
+    global _green_pool
+    with _pool_lock:
+        if _green_pool is None:
+            if gevent:
+                from gevent.threadpool import ThreadPool as GeventThreadPool
+                _green_pool = GeventThreadPool(BACKGROUND_THREADS)
+            else:
+                from eventlet import patcher
+                _green_pool = OSThreadPool(BACKGROUND_THREADS, patcher.original('threading'),
+                                           patcher.original('Queue'))
+    return _green_pool
+
+
+def run_in_background(func, *args):
+    """
+    Runs func(*args) later, in a pool of PLUPLOAD_BACKGROUND_THREADS threads (real OS threads under gevent or eventlet
+    too, apart from those of run_blocking), without waiting for it. Errors are logged to the 'plupload' logger
+    """
+    global _pool
+    if _gevent_hub() is not None:
+        _get_green_pool(gevent=True).spawn(_run_logged, func, args)
+        return
+    if _eventlet_tpool() is not None:
+        _get_green_pool(gevent=False).spawn(_run_logged, func, args)
+        return
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(BACKGROUND_THREADS)
+    _pool.apply_async(_run_logged, (func, args))
+
+
+_process_pool = None
+
+
+def _get_process_pool():
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            _process_pool = Pool(PROCESSES, maxtasksperchild=100)  # recycled, big images fragment the heap
+    return _process_pool
+
+
+def run_in_process(func, *args):
+    """
+    Runs func(*args) later in a pool of PLUPLOAD_PROCESSES worker processes, without waiting for it. func must be a
+    module level function and args picklable. With PLUPLOAD_PROCESSES = 0, or when running green threads (forking a
+    gevent or eventlet hub is not safe), it is run by run_in_background instead. Errors are logged to the 'plupload'
+    logger
+    """
+    if not PROCESSES or _gevent_hub() is not None or _eventlet_tpool() is not None:
+        return run_in_background(func, *args)
+    _get_process_pool().apply_async(_run_logged, (func, args))
+
+
+def call_in_process(func, *args):
+    """
+    Calls func(*args) in the pool of worker processes, like run_in_process, waiting for its result: for background
+    tasks (see run_in_background), not for request handling threads. Straight away where run_in_process would use
+    background threads
+    """
+    if not PROCESSES or _gevent_hub() is not None or _eventlet_tpool() is not None:
+        return func(*args)
+    return _get_process_pool().apply(func, args)
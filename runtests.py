@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+
+
+"""
+Runs the tests of plupload (plupload/tests.py) with throwaway settings: a sqlite DB in memory, MEDIA_ROOT and the
+staging area in a temp directory. Requires Django 1.8.
+
+    python runtests.py [test labels, i.e. plupload.tests.ChunkAssemblyTest]
+"""
+
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix='plupload-tests-')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from django.conf import settings
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='plupload-tests',
+        ALLOWED_HOSTS=['*'],
+        # not serialized: the test models (plupload.tests) have no migration, their tables are created by the tests
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:', 'TEST': {'SERIALIZE': False},
+        }},
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.staticfiles',
+            'plupload',
+        ),
+        MIDDLEWARE_CLASSES=(
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        ),
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+            'OPTIONS': {'context_processors': ['django.core.context_processors.csrf']},
+        }],
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        ROOT_URLCONF='plupload.urls',
+        MEDIA_ROOT=os.path.join(work_dir, 'media'),
+        MEDIA_URL='/media/',
+        STATIC_URL='/static/',
+        PLUPLOAD_STAGING_DIR=os.path.join(work_dir, 'staging'),
+        PLUPLOAD_CHUNK_SIZE=0.0625,  # 64 Kb chunks, small test files
+        PLUPLOAD_MIN_CHUNK_SIZE=0.0625,
+        PLUPLOAD_PROCESSES=0,
+    )
+    import django
+    django.setup()
+    from django.test.utils import get_runner
+    try:
+        failures = get_runner(settings)(verbosity=1).run_tests(sys.argv[1:] or ['plupload'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 import os
-from setuptools import setup
+from setuptools import find_packages, setup
 
 # run python setup.py sdist
 # check out MANIFEST.in for files to include
@@ -13,8 +13,9 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django-plupload',
     version='1.0.1',
-    packages=['plupload'],
+    packages=find_packages(exclude=['benchmarks']),  # plupload and its subpackages: migrations, management commands
     include_package_data=True,
+    install_requires=['Django>=1.8'],
     license='BSD License',
     description='An integration of Plupload with Django, for use with file-based model and form fields.',
     long_description=README,
@@ -29,9 +30,6 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         # Replace these appropriately if you are stuck on Python 2.
-        'Programming Language :: Python :: 2.4',
-        'Programming Language :: Python :: 2.5',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',